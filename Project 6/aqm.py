@@ -0,0 +1,295 @@
+'''
+Active queue management for the router's queues.
+
+Each queue gets its own AQM instance.  CoDel (RFC 8289, the default) looks
+at how long the packet being sent sat in the queue: once that's been above
+target for a whole interval it starts dropping, more often the longer it
+stays above.  RED drops arriving packets with a probability that grows with
+the average queue length.  Either way a packet that is ECN-capable gets
+Congestion Experienced marked instead of dropped, if aqm_ecn is on.
+
+Queues call admit() when a packet arrives and drop() as one leaves; both
+return True for "get rid of this one" and the queue then tries mark().
+Queues that just hold frames as they were given (the pipeline and rss
+hand-off queues) call arrive() and leave(), which do both steps.
+'''
+
+import math
+import random
+import struct
+
+_ETH_LEN = 14
+MTU = 1514 #Largest frame; a backlog of at most this much is never a standing queue
+TOS = _ETH_LEN + 1
+CHECKSUM = _ETH_LEN + 10
+
+def mark_ce(raw):
+    '''
+    Copy of frame bytes raw with ECN set to Congestion Experienced,
+    None if the packet isn't IPv4 with an ECN-capable transport
+    '''
+    if len(raw) < _ETH_LEN + 20 or struct.unpack_from('!H', raw, 12)[0] != 0x0800:
+        return None
+    buf = bytearray(raw)
+    tos = buf[TOS]
+    if tos & 3 == 0: #Not-ECT
+        return None
+    if tos & 3 == 3: #Already marked
+        return raw
+
+    old = (buf[_ETH_LEN] << 8) | tos #Version/IHL shares a 16 bit word with the TOS
+    new = old | 3
+    buf[TOS] = tos | 3
+    check = (buf[CHECKSUM] << 8) | buf[CHECKSUM + 1]
+    total = (~check & 0xFFFF) + (~old & 0xFFFF) + new #RFC 1624 eqn. 3
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    check = ~total & 0xFFFF
+    buf[CHECKSUM] = check >> 8
+    buf[CHECKSUM + 1] = check & 0xFF
+    return bytes(buf)
+
+class Aqm(object):
+    '''
+    No AQM at all; also the counters the real ones share
+    '''
+    def __init__(self, ecn):
+        self.ecn = ecn
+        self.drops = 0
+        self.marks = 0
+
+    def admit(self, length, now):
+        return False
+
+    def drop(self, sojourn, backlog_bytes, now):
+        return False
+
+    def mark(self, raw):
+        '''
+        ECN-marked copy of raw instead of dropping it, None if it has to be dropped
+        '''
+        marked = mark_ce(raw) if self.ecn else None
+        if marked is None:
+            self.drops += 1
+        else:
+            self.marks += 1
+        return marked
+
+    def arrive(self, frame, length, now):
+        '''
+        admit() then mark() for frame (bytes, or anything with pack()) joining
+        a queue of length packets: the frame to queue, None if it's dropped
+        '''
+        if not self.admit(length, now):
+            return frame
+        return self.mark(frame if isinstance(frame, str) else frame.pack())
+
+    def leave(self, frame, sojourn, backlog_bytes, now):
+        '''
+        drop() then mark() for frame leaving a queue after sojourn seconds:
+        the frame to pass on, None if it's dropped
+        '''
+        if not self.drop(sojourn, backlog_bytes, now):
+            return frame
+        return self.mark(frame if isinstance(frame, str) else frame.pack())
+
+    def markObject(self, ether):
+        '''
+        mark() for a pox ethernet object, marks its IPv4 payload in place.
+        False if it has to be dropped.
+        '''
+        if self.ecn and ether.type == 0x0800 and ether.payload.tos & 3:
+            ether.payload.tos |= 3
+            self.marks += 1
+            return True
+        self.drops += 1
+        return False
+
+class CoDel(Aqm):
+    def __init__(self, target, interval, ecn, mtu=MTU):
+        Aqm.__init__(self, ecn)
+        self.target = target #Acceptable standing sojourn time (seconds)
+        self.interval = interval #How long it may stay above target (seconds)
+        self.mtu = mtu
+
+        self.first_above_time = 0.0
+        self.drop_next = 0.0
+        self.count = 0
+        self.lastcount = 0
+        self.dropping = False
+
+    def controlLaw(self, when):
+        return when + self.interval / math.sqrt(self.count)
+
+    def drop(self, sojourn, backlog_bytes, now):
+        ok_to_drop = False
+        if sojourn < self.target or backlog_bytes <= self.mtu: #Good queue
+            self.first_above_time = 0.0
+        elif self.first_above_time == 0.0:
+            self.first_above_time = now + self.interval
+        elif now >= self.first_above_time:
+            ok_to_drop = True
+
+        if self.dropping:
+            if not ok_to_drop:
+                self.dropping = False
+                return False
+            if now >= self.drop_next:
+                self.count += 1
+                self.drop_next = self.controlLaw(self.drop_next)
+                return True
+            return False
+
+        if ok_to_drop:
+            self.dropping = True
+            delta = self.count - self.lastcount
+            if delta > 1 and now - self.drop_next < 16 * self.interval: #Came back soon, pick up where we were
+                self.count = delta
+            else:
+                self.count = 1
+            self.drop_next = self.controlLaw(now)
+            self.lastcount = self.count
+            return True
+        return False
+
+class Red(Aqm):
+    def __init__(self, min_th, max_th, max_p, weight, ecn):
+        Aqm.__init__(self, ecn)
+        self.min_th = min_th #Average queue length (packets) where early drops start
+        self.max_th = max_th #and where everything gets dropped
+        self.max_p = max_p
+        self.weight = weight
+        self.avg = 0.0
+
+    def admit(self, length, now):
+        self.avg += self.weight * (length - self.avg)
+        if self.avg < self.min_th:
+            return False
+        if self.avg >= self.max_th:
+            return True
+        return random.random() < self.max_p * (self.avg - self.min_th) / (self.max_th - self.min_th)
+
+def aqm_factory(config, queue="aqm"):
+    '''
+    Function making a fresh AQM instance per queue, as set up in router_config.txt.
+    queue is the setting naming the kind ("aqm", or "pending_aqm" for the ARP
+    queues), whose _target and _interval settings are CoDel's.
+    '''
+    kind = config[queue]
+    ecn = bool(config["aqm_ecn"])
+    if kind == "codel":
+        return lambda: CoDel(config[queue + "_target"], config[queue + "_interval"], ecn)
+    if kind == "red":
+        return lambda: Red(config["red_min"], config["red_max"], config["red_max_p"], config["red_weight"], ecn)
+    if kind == "none":
+        return lambda: Aqm(ecn)
+    raise ValueError("Unknown aqm '%s'" % kind)
+
+def tests():
+    def ip_frame(tos, ethertype=0x0800):
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, tos, 28, 1, 0, 64, 17, 0, '\xac\x10\x2a\x01', '\xc0\xa8\x2a\x05')
+        check = sum(struct.unpack('!10H', header))
+        check = (check & 0xFFFF) + (check >> 16)
+        check = (check & 0xFFFF) + (check >> 16)
+        header = header[:10] + struct.pack('!H', ~check & 0xFFFF) + header[12:]
+        return '\x00' * 12 + struct.pack('!H', ethertype) + header + '\x00' * 8
+
+    def checksum_ok(raw):
+        total = sum(struct.unpack_from('!10H', raw, _ETH_LEN))
+        total = (total & 0xFFFF) + (total >> 16)
+        total = (total & 0xFFFF) + (total >> 16)
+        return total == 0xFFFF
+
+    #mark_ce: only ECT(0)/ECT(1) IPv4 gets CE, DSCP kept and the checksum still right
+    for dscp in (0, 0xb8):
+        assert mark_ce(ip_frame(dscp)) is None
+        for ect in (1, 2):
+            raw = ip_frame(dscp | ect)
+            marked = mark_ce(raw)
+            assert ord(marked[TOS]) == dscp | 3 and checksum_ok(marked)
+            assert marked[:TOS] == raw[:TOS] and marked[CHECKSUM + 2:] == raw[CHECKSUM + 2:]
+        raw = ip_frame(dscp | 3)
+        assert mark_ce(raw) is raw
+    assert mark_ce(ip_frame(2, 0x0806)) is None
+    assert mark_ce(ip_frame(2)[:_ETH_LEN + 19]) is None
+
+    #mark(): CE instead of a drop only with ECN on and an ECT packet
+    aqm = Aqm(True)
+    assert aqm.mark(ip_frame(0)) is None and aqm.mark(ip_frame(2)) is not None
+    assert (aqm.drops, aqm.marks) == (1, 1)
+    aqm = Aqm(False)
+    assert aqm.mark(ip_frame(2)) is None and (aqm.drops, aqm.marks) == (1, 0)
+
+    #CoDel, standing queue from t=0: first drop an interval later, then interval/sqrt(count) apart
+    codel = CoDel(0.005, 0.1, False)
+    drops = [i / 1000.0 for i in range(1000) if codel.drop(0.02, 10 * MTU, i / 1000.0)]
+    expected = [0.1]
+    while expected[-1] < 1.0:
+        expected.append(expected[-1] + 0.1 / math.sqrt(len(expected)))
+    expected = expected[:-1]
+    assert len(drops) == len(expected), (drops, expected)
+    for when, due in zip(drops, expected):
+        assert due <= when < due + 0.001, (drops, expected)
+    count = codel.count
+    assert count == len(drops)
+
+    #Sojourn back under target, or no more than an MTU queued: good queue, stops dropping
+    assert not codel.drop(0.001, 10 * MTU, 1.0) and not codel.dropping
+    assert not any(codel.drop(0.02, MTU, 1.0 + i / 1000.0) for i in range(500))
+
+    #Bad again soon after: drops an interval later but carries on from about where it stopped
+    assert not codel.drop(0.02, 10 * MTU, 1.5)
+    assert not codel.drop(0.02, 10 * MTU, 1.59)
+    assert codel.drop(0.02, 10 * MTU, 1.6) and codel.count == count - 1
+    assert abs(codel.drop_next - (1.6 + 0.1 / math.sqrt(count - 1))) < 1e-9
+
+    #Much later it starts over, however many it dropped last time
+    for i in range(1601, 2500):
+        codel.drop(0.02, 10 * MTU, i / 1000.0)
+    assert codel.count - codel.lastcount > 1
+    assert not codel.drop(0.001, 10 * MTU, 2.5)
+    assert not codel.drop(0.02, 10 * MTU, 10.0)
+    assert codel.drop(0.02, 10 * MTU, 10.1) and codel.count == 1
+
+    #RED: nothing below min_th, everything from max_th, a straight ramp up to max_p between
+    state = random.getstate()
+    random.seed(465)
+    red = Red(5, 15, 0.1, 1.0, False) #weight 1: the average is the current length
+    assert not any(red.admit(4, 0.0) for i in range(1000))
+    assert all(red.admit(15, 0.0) for i in range(1000))
+    for length, probability in ((5, 0.0), (7.5, 0.025), (10, 0.05), (12.5, 0.075)):
+        dropped = sum(red.admit(length, 0.0) for i in range(20000)) / 20000.0
+        assert abs(dropped - probability) < 0.006, (length, dropped)
+    random.setstate(state)
+    red = Red(5, 15, 0.1, 0.5, False)
+    red.admit(10, 0.0)
+    red.admit(10, 0.0)
+    assert red.avg == 7.5
+
+    #arrive/leave: the frame itself, its marked bytes, or None
+    class Packed(object):
+        def __init__(self, raw):
+            self.raw = raw
+        def pack(self):
+            return self.raw
+    frame = ip_frame(2)
+    assert Aqm(True).arrive(frame, 1000, 0.0) is frame
+    red = Red(0, 1, 1.0, 1.0, True)
+    assert red.arrive(ip_frame(0), 1, 0.0) is None
+    assert red.arrive(Packed(frame), 1, 0.0) == mark_ce(frame)
+    assert (red.drops, red.marks) == (1, 1)
+    codel = CoDel(0.005, 0.1, True)
+    assert codel.leave(frame, 0.02, 10 * MTU, 0.0) is frame
+    assert codel.leave(Packed(frame), 0.02, 10 * MTU, 0.1) == mark_ce(frame)
+    assert codel.leave(ip_frame(0), 0.02, 10 * MTU, 0.2) is None
+    assert (codel.drops, codel.marks) == (1, 1)
+
+    config = {"aqm": "codel", "aqm_target": 0.005, "aqm_interval": 0.1, "aqm_ecn": 1,
+              "pending_aqm": "codel", "pending_aqm_target": 1.0, "pending_aqm_interval": 2.0}
+    assert aqm_factory(config)().target == 0.005
+    make = aqm_factory(config, "pending_aqm")
+    assert make() is not make() and make().interval == 2.0
+    print "aqm: ok"
+
+if __name__ == '__main__':
+    tests()
@@ -0,0 +1,150 @@
+'''
+Pre-serialised ARP frames.
+
+For each router interface the request and reply frames are packed once, with
+everything but the per-packet fields already in place.  Building an ARP is
+then a copy of the template with the target address (and for replies the
+requester's MAC) patched in.  Frames come back as RawFrames, so a waiter
+retransmits the exact same bytes every time.
+'''
+
+import struct
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+from pox.lib.packet import ETHER_BROADCAST
+
+from rawframe import RawFrame
+
+_HEADER = struct.Struct('!6s6sHHHBBH') #Ethernet dst/src/type, then htype/ptype/hlen/plen/opcode
+_NO_ETH = '\x00' * 6
+
+ETH_DST = slice(0, 6)
+TARGET_ETH = slice(32, 38)
+TARGET_IP = slice(38, 42)
+
+def arp_frame(opcode, eth_dst, eth_src, sender_eth, sender_ip, target_eth, target_ip):
+    '''
+    Packs a whole Ethernet+ARP frame from raw (byte string) addresses
+    '''
+    return (_HEADER.pack(eth_dst, eth_src, 0x0806, 1, 0x0800, 6, 4, opcode) +
+            sender_eth + sender_ip + target_eth + target_ip)
+
+class ArpTemplates(object):
+    def __init__(self):
+        self.requests = {} #our ip -> request template (target ip still blank)
+        self.replies = {} #our ip -> reply template (requester still blank)
+
+        self.broadcast = ETHER_BROADCAST.toRaw()
+
+    def addInterface(self, eth, ip):
+        eth = eth.toRaw()
+        raw_ip = ip.toRaw()
+        self.requests[ip] = bytearray(arp_frame(1, self.broadcast, eth, eth, raw_ip, self.broadcast, '\x00' * 4))
+        self.replies[ip] = bytearray(arp_frame(2, _NO_ETH, eth, eth, raw_ip, _NO_ETH, '\x00' * 4))
+
+    def removeInterface(self, ip):
+        self.requests.pop(ip, None)
+        self.replies.pop(ip, None)
+
+    def request(self, dst_ip, src_ip, src_eth, unicast=None):
+        '''
+        ARP request from src_ip/src_eth asking for dst_ip, broadcast unless
+        unicast gives the MAC to send it to
+        '''
+        template = self.requests.get(src_ip)
+        if template is None: #Not one of our interfaces, build it from scratch
+            template = bytearray(arp_frame(1, self.broadcast, src_eth.toRaw(), src_eth.toRaw(),
+                                           src_ip.toRaw(), self.broadcast, '\x00' * 4))
+        buf = bytearray(template)
+        buf[TARGET_IP] = dst_ip.toRaw()
+        if unicast is not None:
+            buf[ETH_DST] = unicast.toRaw()
+        return RawFrame(bytes(buf))
+
+    def reply(self, dst_ip, src_ip, hwdst, src_eth):
+        '''
+        Same arguments as Router.makeReply: dst_ip/hwdst is the address being
+        answered for, src_ip/src_eth whoever asked
+        '''
+        template = self.replies.get(dst_ip)
+        if template is None or template[6:12] != hwdst.toRaw(): #Answering for someone else
+            template = arp_frame(2, _NO_ETH, hwdst.toRaw(), hwdst.toRaw(), dst_ip.toRaw(), _NO_ETH, '\x00' * 4)
+        buf = bytearray(template)
+        requester = src_eth.toRaw()
+        buf[ETH_DST] = requester
+        buf[TARGET_ETH] = requester
+        buf[TARGET_IP] = src_ip.toRaw()
+        return RawFrame(bytes(buf))
+
+def tests():
+    from pox.lib.packet import ethernet, arp
+    from pox.lib.addresses import EthAddr, IPAddr
+    from topology import INTERFACES
+
+    def pox_arp(opcode, eth_dst, eth_src, sender_eth, sender_ip, target_eth, target_ip):
+        #How the router built them before the templates
+        arp_pkt = arp()
+        arp_pkt.opcode = opcode
+        arp_pkt.protosrc = sender_ip
+        arp_pkt.protodst = target_ip
+        arp_pkt.hwsrc = sender_eth
+        arp_pkt.hwdst = target_eth
+        ether = ethernet()
+        ether.type = ether.ARP_TYPE
+        ether.set_payload(arp_pkt)
+        ether.src = eth_src
+        ether.dst = eth_dst
+        return ether.pack()
+
+    templates = ArpTemplates()
+    for intf in INTERFACES:
+        templates.addInterface(intf.ethaddr, intf.ipaddr)
+    hosts = [(IPAddr("10.%d.%d.%d" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF)),
+              EthAddr("02:00:00:%02x:%02x:%02x" % (i >> 16, (i >> 8) & 0xFF, i & 0xFF)))
+             for i in range(1, 2000, 7)]
+
+    for intf in INTERFACES:
+        for ip, eth in hosts:
+            frame = templates.request(ip, intf.ipaddr, intf.ethaddr)
+            assert frame.pack() == pox_arp(arp.REQUEST, ETHER_BROADCAST, intf.ethaddr, intf.ethaddr,
+                                           intf.ipaddr, ETHER_BROADCAST, ip)
+            frame = templates.request(ip, intf.ipaddr, intf.ethaddr, unicast=eth) #Probing a stale entry
+            assert frame.pack() == pox_arp(arp.REQUEST, eth, intf.ethaddr, intf.ethaddr,
+                                           intf.ipaddr, ETHER_BROADCAST, ip)
+            frame = templates.reply(intf.ipaddr, ip, intf.ethaddr, eth)
+            assert frame.pack() == pox_arp(arp.REPLY, eth, intf.ethaddr, intf.ethaddr, intf.ipaddr, eth, ip)
+
+    #Each call hands out its own bytes, the templates themselves stay blank
+    first = templates.request(hosts[0][0], INTERFACES[0].ipaddr, INTERFACES[0].ethaddr)
+    templates.request(hosts[1][0], INTERFACES[0].ipaddr, INTERFACES[0].ethaddr)
+    assert first.pack()[TARGET_IP] == hosts[0][0].toRaw()
+    assert str(templates.requests[INTERFACES[0].ipaddr][TARGET_IP]) == '\x00' * 4
+
+    #Not one of our addresses, or a MAC that isn't that interface's: built from scratch
+    other_ip, other_eth = IPAddr("172.16.42.200"), EthAddr("02:00:00:00:00:c8")
+    ip, eth = hosts[0]
+    assert templates.request(ip, other_ip, other_eth).pack() == \
+        pox_arp(arp.REQUEST, ETHER_BROADCAST, other_eth, other_eth, other_ip, ETHER_BROADCAST, ip)
+    assert templates.reply(other_ip, ip, other_eth, eth).pack() == \
+        pox_arp(arp.REPLY, eth, other_eth, other_eth, other_ip, eth, ip)
+    intf = INTERFACES[1]
+    assert templates.reply(intf.ipaddr, ip, other_eth, eth).pack() == \
+        pox_arp(arp.REPLY, eth, other_eth, other_eth, intf.ipaddr, eth, ip)
+    templates.removeInterface(intf.ipaddr)
+    assert intf.ipaddr not in templates.requests and intf.ipaddr not in templates.replies
+    assert templates.reply(intf.ipaddr, ip, intf.ethaddr, eth).pack() == \
+        pox_arp(arp.REPLY, eth, intf.ethaddr, intf.ethaddr, intf.ipaddr, eth, ip)
+
+    #And a pox parse of the bytes sees the same fields
+    parsed = ethernet(raw=templates.reply(INTERFACES[0].ipaddr, ip, INTERFACES[0].ethaddr, eth).pack())
+    assert parsed.type == parsed.ARP_TYPE and parsed.dst == eth
+    reply = parsed.payload
+    assert (reply.opcode, reply.protosrc, reply.protodst, reply.hwsrc, reply.hwdst) == \
+        (arp.REPLY, INTERFACES[0].ipaddr, ip, INTERFACES[0].ethaddr, eth)
+    print "arptemplates: ok"
+
+if __name__ == '__main__':
+    tests()
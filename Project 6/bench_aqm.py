@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+'''
+Bufferbloat on a paced egress queue: a few TCP-like (AIMD) bulk flows fill
+the link while a ping every 10ms measures queueing delay, with no AQM,
+CoDel and RED on the queue
+
+Usage: python bench_aqm.py [seconds] [link Mbit/s] [flows] [queue limit]
+
+Runs on simulated time through EgressScheduler, same as the router's
+egress_qos path.  Base RTT is 20ms; senders halve their window once per
+window when they see a loss.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import heapq
+import itertools
+from collections import OrderedDict
+
+from qos import QosPolicy, EgressScheduler
+from aqm import aqm_factory
+from routerconfig import RouterConfig
+from rawframe import RawFrame
+from topology import udp_frame
+
+LINK = "router-eth1"
+RTT = 0.02
+
+BULK = udp_frame(5001, 1514)
+PING = udp_frame(7, 98)
+
+class Flow(object):
+    def __init__(self):
+        self.cwnd = 10.0
+        self.next_seq = 0
+        self.outstanding = OrderedDict() #seq -> time sent, oldest first
+        self.recover = -1 #No more halving until seqs past this are lost
+
+class Simulation(object):
+    def __init__(self, aqm, rate, flows, limit):
+        policy = QosPolicy(["class all 0 1514 %d" % limit, "default all", "rate %s %f" % (LINK, rate)])
+        self.scheduler = EgressScheduler(policy, [LINK], aqm)
+        self.flows = [Flow() for i in range(flows)]
+        self.events = [] #(time, seq, callback, args)
+        self.order = itertools.count()
+        self.now = 0.0
+        self.wake = None #Pending link wake-up
+
+        self.frames = {} #id(frame) -> (flow, seq), or None for pings
+        self.ping_sent = {}
+        self.latencies = []
+        self.delivered = 0
+        self.tail_drops = 0
+
+    def at(self, when, callback, *args):
+        heapq.heappush(self.events, (when, next(self.order), callback, args))
+
+    def enqueue(self, frame):
+        if not self.scheduler.enqueue(LINK, frame, self.now):
+            self.tail_drops += 1
+            return False
+        self.service()
+        return True
+
+    def service(self):
+        wake = self.scheduler.service(self.now, self.transmit)
+        if wake is not None and (self.wake is None or wake < self.wake):
+            self.wake = wake
+            self.at(wake, self.linkFree)
+
+    def linkFree(self):
+        self.wake = None
+        self.service()
+
+    def transmit(self, name, frame):
+        info = self.frames.pop(id(frame))
+        if info is None: #A ping
+            self.latencies.append(self.now - self.ping_sent.pop(id(frame)))
+            return
+        self.delivered += len(BULK)
+        self.at(self.now + RTT, self.ack, *info)
+
+    def sendMore(self, flow):
+        while len(flow.outstanding) < int(flow.cwnd):
+            seq = flow.next_seq
+            flow.next_seq += 1
+            frame = RawFrame(BULK)
+            self.frames[id(frame)] = (flow, seq)
+            flow.outstanding[seq] = self.now
+            if not self.enqueue(frame):
+                del self.frames[id(frame)]
+                self.at(self.now + RTT, self.loss, flow, seq)
+
+    def lost(self, flow, seq):
+        if seq > flow.recover: #Once per window
+            flow.cwnd = max(1.0, flow.cwnd / 2)
+            flow.recover = flow.next_seq
+
+    def ack(self, flow, seq):
+        if flow.outstanding.pop(seq, None) is None:
+            return
+        flow.cwnd += 1.0 / flow.cwnd
+        for missing in list(flow.outstanding): #Three later packets got through, it's gone
+            if missing >= seq - 3:
+                break
+            del flow.outstanding[missing]
+            self.lost(flow, missing)
+        self.sendMore(flow)
+
+    def loss(self, flow, seq):
+        if flow.outstanding.pop(seq, None) is not None:
+            self.lost(flow, seq)
+            self.sendMore(flow)
+
+    def ping(self):
+        frame = RawFrame(PING)
+        self.frames[id(frame)] = None
+        self.ping_sent[id(frame)] = self.now
+        if not self.enqueue(frame):
+            del self.ping_sent[id(frame)]
+        self.at(self.now + 0.01, self.ping)
+
+    def run(self, seconds):
+        for flow in self.flows:
+            self.at(0.0, self.sendMore, flow)
+        self.at(0.005, self.ping)
+        while self.events and self.events[0][0] <= seconds:
+            self.now, order, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        self.latencies.sort()
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    rate = float(sys.argv[2]) * 1e6 if len(sys.argv) > 2 else 10e6
+    flows = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    limit = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+
+    print("%.0f Mbit/s link, %d flows, %d packet queue, %d s" % (rate / 1e6, flows, limit, seconds))
+    print("%-6s %10s %10s %10s %12s %10s %10s" % ("aqm", "goodput", "ping p50", "ping p99", "ping max ms",
+                                                  "aqm drops", "tail drops"))
+    for kind in ("none", "codel", "red"):
+        config = RouterConfig()
+        config["aqm"] = kind
+        sim = Simulation(aqm_factory(config), rate, flows, limit)
+        sim.run(seconds)
+        queue = sim.scheduler.interfaces[LINK].queues[0]
+        print("%-6s %8.2fMb %8.2fms %8.2fms %12.2f %10d %10d" % (kind, sim.delivered * 8 / seconds / 1e6,
+              percentile(sim.latencies, 0.5) * 1e3, percentile(sim.latencies, 0.99) * 1e3,
+              sim.latencies[-1] * 1e3, queue.aqm.drops, sim.tail_drops))
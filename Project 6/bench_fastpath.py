@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+Packets/sec of the pox object forwarding path vs. the raw-bytes fast path
+
+Usage: python bench_fastpath.py [packets] [payload bytes]
+
+Both paths start from a frame pox has already parsed (that's what srpy hands the
+router) and end with the bytes send_packet puts on the wire.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+from pox.lib.packet import ethernet, ipv4, udp
+from pox.lib.addresses import EthAddr, IPAddr
+
+from rawframe import forward_raw
+
+SRC_ETH = EthAddr("00:00:00:00:0b:02")
+DST_ETH = EthAddr("00:00:00:00:10:01")
+
+def make_frame(size):
+    xudp = udp()
+    xudp.srcport = 5353
+    xudp.dstport = 53
+    xudp.payload = "x" * size
+    xudp.len = 8 + size
+
+    ip = ipv4()
+    ip.srcip = IPAddr("172.16.42.1")
+    ip.dstip = IPAddr("192.168.42.5")
+    ip.protocol = ip.UDP_PROTOCOL
+    ip.ttl = 64
+    ip.payload = xudp
+
+    ether = ethernet()
+    ether.type = ether.IP_TYPE
+    ether.src = EthAddr("00:00:00:00:01:01")
+    ether.dst = EthAddr("00:00:00:00:0b:01")
+    ether.payload = ip
+    return ether.pack()
+
+def object_path(frames):
+    '''
+    What forward_packet does: decrement TTL, wrap the ipv4 in a new ethernet, pack
+    '''
+    for pkt in frames:
+        payload = pkt.payload
+        payload.ttl -= 1
+        ether = ethernet()
+        ether.type = ether.IP_TYPE
+        ether.set_payload(payload)
+        ether.src = SRC_ETH
+        ether.dst = DST_ETH
+        ether.pack()
+
+def raw_path(frames):
+    macs = DST_ETH.toRaw() + SRC_ETH.toRaw()
+    for pkt in frames:
+        forward_raw(pkt.raw, macs).pack()
+
+def run(name, path, raw, count):
+    frames = [ethernet(raw=raw) for i in range(count)] #Parsing is srpy's cost either way
+    start = time.time()
+    path(frames)
+    elapsed = time.time() - start
+    print("%-8s %9.0f pps  (%.2f us/packet)" % (name, count / elapsed, elapsed / count * 1e6))
+    return elapsed
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    raw = make_frame(size)
+    slow = run("object", object_path, raw, count)
+    fast = run("raw", raw_path, raw, count)
+    print("speedup  %.1fx" % (slow / fast))
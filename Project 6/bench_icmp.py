@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+'''
+ICMP time exceeded errors per second: the old makeICMP/makeIP objects (body
+from ippkt.dump()) vs. the header-byte templates in icmpfast
+
+Usage: python bench_icmp.py [errors]
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+import struct
+import pox.lib.packet as pktlib
+from pox.lib.addresses import IPAddr
+
+from icmpfast import IcmpErrors
+
+ROUTER_IP = IPAddr("172.16.42.254")
+
+def expired(i):
+    '''
+    A TTL 1 UDP packet from a different traceroute port each time
+    '''
+    src = IPAddr("172.16.42.%d" % (i % 250 + 1)).toRaw()
+    dst = IPAddr("192.168.200.2").toRaw()
+    return (struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, i & 0xFFFF, 0, 1, 17, 0, src, dst) +
+            struct.pack('!HHHH', 33434 + i % 100, 33434, 20, 0) + '\x00' * 12)
+
+def object_error(original):
+    ippkt = pktlib.ipv4(raw=original)
+    icmppkt = pktlib.icmp()
+    icmppkt.type = pktlib.TYPE_TIME_EXCEED
+    icmppkt.payload = pktlib.unreach()
+    icmppkt.payload.payload = ippkt.dump()[:28]
+
+    reply = pktlib.ipv4()
+    reply.srcip = ROUTER_IP
+    reply.dstip = ippkt.srcip
+    reply.ttl = 64
+    reply.protocol = reply.ICMP_PROTOCOL
+    reply.payload = icmppkt
+    return reply.pack()
+
+def rate(name, build, packets):
+    start = time.time()
+    for original in packets:
+        build(original)
+    elapsed = time.time() - start
+    print("%-18s %9.0f errors/sec" % (name, len(packets) / elapsed))
+    return elapsed
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    errors = IcmpErrors()
+    errors.addSource(ROUTER_IP)
+    packets = [expired(i) for i in range(count)]
+
+    slow = rate("objects", object_error, packets)
+    fast = rate("template", lambda original: errors.build(pktlib.TYPE_TIME_EXCEED, 0, ROUTER_IP, original),
+                packets)
+    print("%-18s %9.1fx" % ("", slow / fast))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+'''
+Lookup microbenchmark: PrefixTrie and Dir248Table vs. the old linear scan in Router.matchPrefix
+
+Usage: python bench_lpm.py [size ...]    (defaults to 10 1000 100000 1000000)
+
+The scan is reproduced on plain unsigned ints (no pox needed) but keeps the old
+shape: walk every entry, mask the address, and count mask bits twice on a hit.
+'''
+
+import random
+import sys
+import time
+
+from lpm import PrefixTrie, prefix_mask
+from dir248 import Dir248Table
+
+def netmask_to_cidr(mask):
+    '''
+    Same job as pox's netmask_to_cidr, on an unsigned mask
+    '''
+    bits = 0
+    while mask & 0x80000000:
+        bits += 1
+        mask = (mask << 1) & 0xFFFFFFFF
+    return bits
+
+def random_routes(count, rng):
+    '''
+    count distinct prefixes, mostly /16-/24 like a real table, with a default route
+    '''
+    lengths = [8, 12, 16, 18, 20, 22, 23, 24, 24, 24, 24, 28, 32]
+    routes = {(0, 0): (0, None, "eth0")}
+    while len(routes) < count:
+        length = rng.choice(lengths)
+        key = rng.getrandbits(32) & prefix_mask(length)
+        routes[(key, length)] = (prefix_mask(length), None, "eth%d" % (len(routes) % 4))
+    return routes
+
+def scan_lookup(table, addr):
+    best_prefix = None
+    best_match = -1
+    for prefix in table:
+        netmask = table[prefix][0]
+        if prefix == (addr & netmask):
+            if best_match == -1 or best_match < netmask_to_cidr(netmask):
+                best_prefix = prefix
+                best_match = netmask_to_cidr(netmask)
+    if best_prefix == None:
+        return None
+    return table[best_prefix]
+
+def time_lookups(lookup, table, addrs):
+    start = time.time()
+    for addr in addrs:
+        lookup(table, addr)
+    return (time.time() - start) / len(addrs)
+
+def run(size, rng):
+    routes = random_routes(size, rng)
+
+    scan_table = {} #Old layout: keyed by prefix only
+    for (key, length), value in routes.items():
+        scan_table[key] = value
+
+    start = time.time()
+    trie = PrefixTrie()
+    for (key, length), value in routes.items():
+        trie.insert(key, length, value)
+    build = time.time() - start
+
+    start = time.time()
+    compiled = Dir248Table.fromRoutes(trie.items())
+    compile_time = time.time() - start
+
+    keys = list(routes.keys())
+    addrs = []
+    for i in range(20000):
+        key, length = rng.choice(keys) #Mostly hits, with random host bits
+        addrs.append(key | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF))
+
+    scan_count = max(5, min(len(addrs), 200000 // size)) #The scan gets too slow to run them all
+    scan = time_lookups(scan_lookup, scan_table, addrs[:scan_count])
+    trie_time = time_lookups(lambda t, a: t.lookup(a), trie, addrs)
+    dir_time = time_lookups(lambda t, a: t.lookup(a), compiled, addrs)
+
+    print("%8d prefixes  build %6.2fs/%6.2fs  scan %10.2f us  trie %6.2f us  dir248 %5.2f us  (%d MB)" %
+          (size, build, compile_time, scan * 1e6, trie_time * 1e6, dir_time * 1e6,
+           compiled.memoryFootprint() >> 20))
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 1000, 100000, 1000000]
+    rng = random.Random(465)
+    for size in sizes:
+        run(size, rng)
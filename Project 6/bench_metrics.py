@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+'''
+Forwarding throughput with metrics off and on, against an uninstrumented router
+
+Usage: python bench_metrics.py [packets] [flows] [rounds]
+
+Same traffic and scratch directory set-up as bench_rss.py (UDP flows that
+are fast-path work after their first packet), run through router_main.
+The baseline is myrouter4.py with every "if self.metrics is not None:"
+block cut out, so metrics off against it is what the hooks cost when
+they're disabled.  Each setting is run rounds times, alternating, and the
+best run is kept.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+import shutil
+import tempfile
+
+from myrouter4 import Router
+from routerconfig import RouterConfig
+from bench_rss import BenchNet, arp_reply, udp_frame
+
+def uninstrumented(path, scratch):
+    '''
+    Writes myrouter4.py without its metrics blocks into scratch as
+    myrouter4_baseline.py and returns its Router
+    '''
+    lines = []
+    block = None #Indentation of the "if" being cut out
+    for line in open(path):
+        indent = len(line) - len(line.lstrip())
+        if block is not None and (not line.strip() or indent > block):
+            continue
+        block = None
+        if line.strip().startswith("if self.metrics is not None:"):
+            block = indent
+            continue
+        lines.append(line)
+    open(os.path.join(scratch, "myrouter4_baseline.py"), "w").writelines(lines)
+    sys.path.insert(0, scratch)
+    from myrouter4_baseline import Router as Baseline
+    return Baseline
+
+def run(frames, metrics, router_class=Router):
+    config = RouterConfig()
+    config["metrics"] = metrics
+    config["metrics_socket"] = "none"
+    router = router_class(BenchNet(frames), config)
+    start = time.time()
+    router.router_main()
+    return time.time() - start
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    flows = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    frames = [("router-eth1", arp_reply())]
+    flow_frames = [udp_frame(flow) for flow in range(flows)]
+    frames += [("router-eth0", flow_frames[i % flows]) for i in range(count)]
+
+    routes = os.path.abspath("forwarding_table.txt")
+    source = os.path.abspath("myrouter4.py")
+    scratch = tempfile.mkdtemp()
+    shutil.copy(routes, scratch)
+    open(os.path.join(scratch, "firewall_rules.txt"), "w").close()
+    os.chdir(scratch)
+    try:
+        settings = (("baseline", 0, uninstrumented(source, scratch)), ("metrics 0", 0, Router),
+                    ("metrics 1", 1, Router))
+        best = {}
+        for i in range(rounds):
+            for name, metrics, router_class in settings:
+                elapsed = run(frames, metrics, router_class)
+                if name not in best or elapsed < best[name]:
+                    best[name] = elapsed
+    finally:
+        shutil.rmtree(scratch)
+
+    for name, metrics, router_class in settings:
+        print("%-9s %9.0f pps  (%.2f us/packet)" % (name, len(frames) / best[name],
+                                                     best[name] / len(frames) * 1e6))
+    print("cost of metrics off: %.1f%%" % ((best["metrics 0"] / best["baseline"] - 1) * 100))
+    print("cost of metrics on: %.1f%%" % ((best["metrics 1"] / best["metrics 0"] - 1) * 100))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+Latency of small DNS packets sharing a paced link with bulk traffic that
+overloads it: one FIFO vs. the class queues from qos_config.txt
+
+Usage: python bench_qos.py [seconds] [link Mbit/s] [bulk load, fraction of link]
+
+Runs on simulated time (no sleeping), sending through EgressScheduler
+exactly as the router does with egress_qos on.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+
+from qos import QosPolicy, EgressScheduler
+from rawframe import RawFrame
+from topology import udp_frame
+
+LINK = "router-eth1"
+FIFO = ["class all 0 1514 1024", "default all"]
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def simulate(policy, seconds, rate, load):
+    bulk = RawFrame(udp_frame(5001, 1514))
+    dns = RawFrame(udp_frame(53, 80))
+    arrivals = [] #(time, frame, is it a probe)
+    gap = 1514 * 8.0 / (rate * load)
+    arrivals += [(i * gap, bulk, False) for i in range(int(seconds / gap))]
+    arrivals += [(i * 0.01 + 0.005, dns, True) for i in range(int(seconds / 0.01))] #100 DNS packets/sec
+    arrivals.sort(key=lambda arrival: arrival[0])
+
+    scheduler = EgressScheduler(policy, [LINK])
+    clock = [0.0]
+    queued = {} #id(probe in flight) -> arrival time
+    latencies = []
+    def send(name, pkt):
+        if id(pkt) in queued:
+            latencies.append(clock[0] - queued.pop(id(pkt)))
+
+    wake = None
+    dropped = 0
+    for when, frame, probe in arrivals:
+        while wake is not None and wake <= when: #Link frees up before this arrival
+            clock[0] = wake
+            wake = scheduler.service(wake, send)
+        if probe:
+            frame = RawFrame(frame.buf) #Own object so we can tell it apart
+            queued[id(frame)] = when
+        if not scheduler.enqueue(LINK, frame, when) and probe:
+            del queued[id(frame)]
+            dropped += 1
+        clock[0] = when
+        wake = scheduler.service(when, send)
+    while wake is not None:
+        clock[0] = wake
+        wake = scheduler.service(wake, send)
+
+    latencies.sort()
+    return latencies, dropped
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    rate = float(sys.argv[2]) * 1e6 if len(sys.argv) > 2 else 10e6
+    load = float(sys.argv[3]) if len(sys.argv) > 3 else 1.2
+
+    rate_line = "rate %s %f" % (LINK, rate)
+    print("%.0f Mbit/s link, bulk at %.0f%%, %d s" % (rate / 1e6, load * 100, seconds))
+    print("%-6s %10s %10s %10s %10s %8s" % ("", "p50 ms", "p99 ms", "p99.9 ms", "max ms", "dropped"))
+    for name, policy in (("fifo", QosPolicy(FIFO + [rate_line])),
+                         ("qos", QosPolicy(list(open("qos_config.txt")) + [rate_line]))):
+        latencies, dropped = simulate(policy, seconds, rate, load)
+        print("%-6s %10.3f %10.3f %10.3f %10.3f %8d" % (name, percentile(latencies, 0.5) * 1e3,
+              percentile(latencies, 0.99) * 1e3, percentile(latencies, 0.999) * 1e3,
+              latencies[-1] * 1e3, dropped))
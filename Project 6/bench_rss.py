@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+'''
+Forwarding throughput with flows spread over 1..N worker processes (rss.py),
+against the plain single-process router
+
+Usage: python bench_rss.py [packets] [max workers] [flows]
+
+Runs in a scratch directory with an empty firewall and the routes from
+forwarding_table.txt.  Every packet is a UDP packet from 172.16.42.0/24 to
+192.168.42.0/24, so after the first packet of each flow it's fast-path work.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+import struct
+import shutil
+import tempfile
+import multiprocessing
+from pox.lib.addresses import EthAddr, IPAddr
+from srpy_common import SrpyShutdown
+
+from myrouter4 import Router
+from routerconfig import RouterConfig
+from rss import RssDispatcher
+from icmpfast import fold, word_sum
+from topology import INTERFACES
+
+NEXTHOP_ETH = EthAddr("00:00:00:00:10:01")
+
+class BenchNet(object):
+    '''
+    Hands out the prepared frames as fast as they're asked for, then shuts down
+    '''
+    def __init__(self, frames):
+        self.frames = frames
+        self.position = 0
+        self.sent = 0
+
+    def interfaces(self):
+        return INTERFACES
+
+    def recv_packet(self, timeout=None):
+        if self.position == len(self.frames):
+            raise SrpyShutdown()
+        dev, frame = self.frames[self.position]
+        self.position += 1
+        return dev, time.time(), frame
+
+    def send_packet(self, name, pkt):
+        pkt.pack()
+        self.sent += 1
+
+    def shutdown(self):
+        pass
+
+def arp_reply():
+    '''
+    Next hop 192.168.100.2 announcing itself, so nothing waits on ARP
+    '''
+    return (INTERFACES[1].ethaddr.toRaw() + NEXTHOP_ETH.toRaw() +
+            struct.pack('!HHHBBH', 0x0806, 1, 0x0800, 6, 4, 2) + NEXTHOP_ETH.toRaw() +
+            IPAddr("192.168.100.2").toRaw() + INTERFACES[1].ethaddr.toRaw() + INTERFACES[1].ipaddr.toRaw())
+
+def udp_frame(flow):
+    src = IPAddr("172.16.42.%d" % (flow % 250 + 1)).toRaw()
+    dst = IPAddr("192.168.42.%d" % (flow // 250 % 250 + 1)).toRaw()
+    payload = struct.pack('!HHHH', 1024 + flow, 53, 8 + 18, 0) + 'x' * 18
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64, 17, 0, src, dst)
+    header = header[:10] + struct.pack('!H', fold(word_sum(header))) + header[12:]
+    return (INTERFACES[0].ethaddr.toRaw() + EthAddr("00:00:00:00:01:01").toRaw() + '\x08\x00' +
+            header + payload)
+
+def run(name, workers, frames):
+    config = RouterConfig()
+    config["rss_workers"] = workers
+    config["rss_queue_depth"] = len(frames)
+    config["aqm"] = "none" #Every frame is queued at once on purpose; bench_aqm.py is for AQM
+    net = BenchNet(frames)
+    if workers:
+        dispatcher = RssDispatcher(net, Router, config)
+        start = time.time()
+        dispatcher.run()
+    else:
+        router = Router(net, config)
+        start = time.time()
+        router.router_main()
+    elapsed = time.time() - start
+    print("%-10s %9.0f pps  (%d/%d forwarded)" % (name, len(frames) / elapsed, net.sent, len(frames) - 1))
+    return elapsed
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    most = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    flows = int(sys.argv[3]) if len(sys.argv) > 3 else 1024
+
+    frames = [("router-eth1", arp_reply())]
+    flow_frames = [udp_frame(flow) for flow in range(flows)]
+    frames += [("router-eth0", flow_frames[i % flows]) for i in range(count)]
+
+    routes = os.path.abspath("forwarding_table.txt")
+    scratch = tempfile.mkdtemp()
+    shutil.copy(routes, scratch)
+    open(os.path.join(scratch, "firewall_rules.txt"), "w").close()
+    os.chdir(scratch)
+    try:
+        single = run("single", 0, frames)
+        workers = 1
+        while workers <= most:
+            elapsed = run("%d worker%s" % (workers, "s" if workers > 1 else ""), workers, frames)
+            print("%-10s %9.2fx single" % ("", single / elapsed))
+            workers *= 2
+    finally:
+        shutil.rmtree(scratch)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+Load time and memory of the forwarding table (buildMappings) and the
+firewall (Firewall.__init__) at scale, from the text files and from a
+table snapshot
+
+Usage: python bench_scale.py [routes] [rules] [lookup]
+
+Generates routes and rules with gen_scale.py in a scratch directory (or
+uses forwarding_table.txt and firewall_rules.txt from the directory given
+as routes, e.g. "python bench_scale.py scale"), then builds a Router (whose
+constructor runs buildMappings, with lookup trie or dir248) and a Firewall,
+each in a fresh process.  Then compiles a snapshot with snapshot.py and
+loads both again from it.  Memory is the growth in resident set while
+loading, and the process's peak.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+from myrouter4 import Router
+from firewall import Firewall
+from routerconfig import RouterConfig
+from bench_rss import BenchNet
+from gen_scale import write_routes, write_rules
+from snapshot import write_snapshot, TableSnapshot
+
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+def resident():
+    f = open('/proc/self/statm')
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * PAGE
+
+def measure(load, conn):
+    before = resident()
+    start = time.time()
+    loaded = load()
+    elapsed = time.time() - start
+    conn.send((elapsed, resident() - before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+    conn.close()
+
+def in_child(load):
+    ours, theirs = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=measure, args=(load, theirs))
+    child.start()
+    result = ours.recv()
+    child.join()
+    return result
+
+SNAPSHOT = "router_tables.snap"
+
+def load_router(lookup, snapshot="none"):
+    config = RouterConfig()
+    config["lookup"] = lookup
+    config["metrics_socket"] = "none"
+    config["table_snapshot"] = snapshot
+    return Router(BenchNet([]), config)
+
+def load_snapshot_rules():
+    return Firewall(rules=TableSnapshot(SNAPSHOT).rules())
+
+def count_lines(path):
+    f = open(path)
+    lines = sum(1 for line in f)
+    f.close()
+    return lines
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    rules = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    lookup = sys.argv[3] if len(sys.argv) > 3 else "trie"
+
+    scratch = tempfile.mkdtemp()
+    try:
+        if os.path.isdir(source):
+            for name in ("forwarding_table.txt", "firewall_rules.txt"):
+                shutil.copy(os.path.join(source, name), scratch)
+        else:
+            write_routes(os.path.join(scratch, "forwarding_table.txt"), int(source))
+            write_rules(os.path.join(scratch, "firewall_rules.txt"), rules)
+        os.chdir(scratch)
+        route_count = count_lines("forwarding_table.txt")
+        rule_count = count_lines("firewall_rules.txt")
+
+        results = [("buildMappings (%s)" % lookup, route_count, "routes", in_child(lambda: load_router(lookup))),
+                   ("Firewall.__init__", rule_count, "rules", in_child(Firewall)),
+                   ("snapshot.py", route_count, "routes", in_child(lambda: write_snapshot(SNAPSHOT))),
+                   ("buildMappings (snapshot)", route_count, "routes",
+                    in_child(lambda: load_router(lookup, SNAPSHOT))),
+                   ("Firewall (snapshot)", rule_count, "rules", in_child(load_snapshot_rules))]
+        snapshot_size = os.path.getsize(SNAPSHOT)
+    finally:
+        shutil.rmtree(scratch)
+
+    for name, count, unit, (elapsed, grown, peak) in results:
+        print("%-24s %8d %-6s %7.2f s %9.0f %s/s  +%6.1f MB (%5.0f bytes each)  peak %6.1f MB" % (name, count, unit,
+              elapsed, count / elapsed, unit, grown / 1e6, float(grown) / count, peak / 1e6))
+    print("snapshot %.1f MB" % (snapshot_size / 1e6))
@@ -0,0 +1,243 @@
+'''
+DIR-24-8 compiled forwarding table.
+
+Routes are expanded into flat arrays so a lookup is one index into a 2^24 entry
+first-level table (the top 24 bits of the address) and, only for /24's that
+hold a /25-/32 route, one more index into a 256 entry second-level block.
+No Python objects are created per lookup.
+
+Entries are indexes into self.nexthops; a negative first-level entry -(b+1)
+points at second-level block b.  The per-entry prefix length is kept in
+parallel byte arrays.  Adding or removing a route rewrites just the range it
+covers, with array slice assignments.
+'''
+
+from array import array
+
+from lpm import PrefixTrie, prefix_mask
+
+TBL24_SIZE = 1 << 24
+BLOCK_SIZE = 256
+
+def available_memory():
+    '''
+    MemAvailable from /proc/meminfo in bytes, None if we can't tell
+    '''
+    try:
+        meminfo = open("/proc/meminfo", "r")
+    except IOError:
+        return None
+    try:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    finally:
+        meminfo.close()
+    return None
+
+class Dir248Table(object):
+    '''
+    Same interface as PrefixTrie (insert/delete/lookup/items/len) but compiled.
+    A PrefixTrie copy of the routes is kept for deletes, which need the next
+    shorter covering route to fill the hole back in.
+    '''
+
+    def __init__(self):
+        self.trie = PrefixTrie()
+        self.nexthops = [None] #Index 0 means no route
+        self.nexthop_index = {}
+
+        self.tbl24 = array('i', [0]) * TBL24_SIZE
+        self.depth24 = array('B', [0]) * TBL24_SIZE
+        self.tbl8 = array('i')
+        self.depth8 = array('B')
+        self.blocks = {} #First-level slot -> its second-level block number
+
+    @staticmethod
+    def estimateFootprint(routes):
+        '''
+        Bytes a table holding routes (key, length, value) would need, without building it
+        '''
+        long_slots = set()
+        for key, length, value in routes:
+            if length > 24:
+                long_slots.add(key >> 8)
+        entry = array('i').itemsize + array('B').itemsize
+        return TBL24_SIZE * entry + len(long_slots) * BLOCK_SIZE * entry
+
+    @classmethod
+    def fromRoutes(cls, routes):
+        '''
+        Bulk compile: shortest prefixes first, so each longer prefix simply
+        overwrites the slice it covers
+        '''
+        table = cls()
+        for key, length, value in sorted(routes, key=lambda route: route[1]):
+            key &= prefix_mask(length)
+            table.trie.insert(key, length, value)
+            table._set(key, length, table._index(value), length)
+        return table
+
+    def __len__(self):
+        return len(self.trie)
+
+    def items(self):
+        return self.trie.items()
+
+    def memoryFootprint(self):
+        '''
+        Bytes held by the lookup arrays
+        '''
+        return (len(self.tbl24) * self.tbl24.itemsize + len(self.depth24) * self.depth24.itemsize +
+                len(self.tbl8) * self.tbl8.itemsize + len(self.depth8) * self.depth8.itemsize)
+
+    def _index(self, value):
+        index = self.nexthop_index.get(value)
+        if index is None:
+            index = len(self.nexthops)
+            self.nexthops.append(value)
+            self.nexthop_index[value] = index
+        return index
+
+    def _block(self, slot):
+        '''
+        Base offset of slot's second-level block, splitting the /24 out of the
+        first-level table if it doesn't have one yet
+        '''
+        entry = self.tbl24[slot]
+        if entry < 0:
+            return (-entry - 1) * BLOCK_SIZE
+
+        block = len(self.tbl8) // BLOCK_SIZE
+        self.tbl8.extend(array('i', [entry]) * BLOCK_SIZE) #Inherit whatever covered the /24
+        self.depth8.extend(array('B', [self.depth24[slot]]) * BLOCK_SIZE)
+        self.tbl24[slot] = -(block + 1)
+        self.blocks[slot] = block
+        return block * BLOCK_SIZE
+
+    def _set(self, key, length, index, depth):
+        '''
+        Points every entry key/length covers at index, a slice assignment per table
+        '''
+        if length > 24:
+            start = self._block(key >> 8) + (key & 0xFF)
+            count = 1 << (32 - length)
+            self.tbl8[start:start + count] = array('i', [index]) * count
+            self.depth8[start:start + count] = array('B', [depth]) * count
+        else:
+            start = key >> 8
+            count = 1 << (24 - length)
+            self.tbl24[start:start + count] = array('i', [index]) * count
+            self.depth24[start:start + count] = array('B', [depth]) * count
+
+    def _rebuild(self, key, length):
+        '''
+        Rewrites everything key/length covers from the trie (already updated):
+        the covering route first, then each route inside it, shortest first so
+        longer ones land on top.  Costs a slice per route inside key/length,
+        never a loop over the entries.
+        '''
+        key &= prefix_mask(length)
+        cover = self.trie.covering(key, length)
+        if cover is None:
+            index, depth = 0, 0
+        else:
+            index, depth = self._index(cover[1]), cover[0]
+        inside = sorted(self.trie.within(key, length), key=lambda route: route[1])
+
+        if length > 24:
+            self._set(key, length, index, depth)
+            for route_key, route_length, value in inside:
+                self._set(route_key, route_length, self._index(value), route_length)
+            return
+
+        start = key >> 8
+        end = start + (1 << (24 - length))
+        if len(self.blocks) < end - start:
+            blocks = [(slot, block) for slot, block in self.blocks.items() if start <= slot < end]
+        else:
+            blocks = [(slot, self.blocks[slot]) for slot in range(start, end) if slot in self.blocks]
+
+        #First level as if there were no second-level blocks...
+        self._set(key, length, index, depth)
+        for route_key, route_length, value in inside:
+            if route_length <= 24:
+                self._set(route_key, route_length, self._index(value), route_length)
+
+        #...then each block inherits what its /24 got, and its own routes go back on top
+        for slot, block in blocks:
+            base = block * BLOCK_SIZE
+            self.tbl8[base:base + BLOCK_SIZE] = array('i', [self.tbl24[slot]]) * BLOCK_SIZE
+            self.depth8[base:base + BLOCK_SIZE] = array('B', [self.depth24[slot]]) * BLOCK_SIZE
+            self.tbl24[slot] = -(block + 1)
+        for route_key, route_length, value in inside:
+            if route_length > 24:
+                self._set(route_key, route_length, self._index(value), route_length)
+
+    def insert(self, key, length, value):
+        key &= prefix_mask(length)
+        self.trie.insert(key, length, value)
+        self._rebuild(key, length)
+
+    def delete(self, key, length):
+        key &= prefix_mask(length)
+        if not self.trie.delete(key, length):
+            return False
+        self._rebuild(key, length)
+        return True
+
+    def lookup(self, addr):
+        entry = self.tbl24[addr >> 8]
+        if entry < 0:
+            entry = self.tbl8[(-entry - 1) * BLOCK_SIZE + (addr & 0xFF)]
+        return self.nexthops[entry]
+
+def tests():
+    '''
+    Random inserts/deletes, looked up in both a Dir248Table and a PrefixTrie
+    '''
+    import random
+    rng = random.Random(0)
+    table = Dir248Table()
+    trie = PrefixTrie()
+    live = []
+
+    def check(count):
+        for i in range(count):
+            if live and rng.random() < 0.7:
+                key, length = rng.choice(live)
+                addr = key | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF)
+            else:
+                addr = (rng.choice((0x0A000000, 0x0A010200, 0xC0A80000)) | rng.getrandbits(16)
+                        if rng.random() < 0.8 else rng.getrandbits(32))
+            assert table.lookup(addr) == trie.lookup(addr), hex(addr)
+
+    for step in range(1500):
+        if live and rng.random() < 0.35:
+            key, length = live.pop(rng.randrange(len(live)))
+            assert table.delete(key, length) == trie.delete(key, length)
+        else:
+            length = rng.choice((8, 12, 16, 20, 23, 24, 24, 25, 26, 28, 30, 32))
+            base = rng.choice((0x0A000000, 0x0A010200, 0xC0A80000))
+            key = (base | (rng.getrandbits(16) if length > 16 else rng.getrandbits(24))) & prefix_mask(length)
+            table.insert(key, length, (key, length, step))
+            trie.insert(key, length, (key, length, step))
+            live.append((key, length))
+        check(20)
+    assert len(table) == len(trie)
+
+    for table_route in ((0, 0), (0x0A000000, 8)): #Default route and a /8 over everything above
+        table.insert(table_route[0], table_route[1], "cover")
+        trie.insert(table_route[0], table_route[1], "cover")
+        check(2000)
+        assert table.delete(*table_route) and trie.delete(*table_route)
+        check(2000)
+
+    compiled = Dir248Table.fromRoutes(trie.items())
+    for i in range(5000):
+        addr = rng.getrandbits(32)
+        assert compiled.lookup(addr) == table.lookup(addr)
+    print("dir248: ok")
+
+if __name__ == '__main__':
+    tests()
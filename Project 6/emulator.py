@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+'''
+In-process stand-in for start_mininet.py's network: the router's three
+links and the hosts on them, all in memory, with traffic generators
+
+Usage: python emulator.py [seconds] [mix file] [link delay ms] [drain seconds]
+       python emulator.py test
+
+Emulator is the router's net (interfaces(), recv_packet(), send_packet()),
+so a Router runs against it unmodified; no root, Mininet or pox switch is
+needed.  The topology is start_mininet's: hint1 and hint2 behind sw1 on
+router-eth0, hext1 on router-eth1 and hext2 on router-eth2, with the same
+addresses and MACs.  Hosts know the router's MAC up front (the script's
+staticArp), answer ARP for their own address, answer pings and DNS queries,
+and hext1/hext2 stand in for everything the forwarding table sends them.
+Each router port takes up to ring frames at a time, like a NIC's receive
+ring; frames arriving at a full ring are lost.  Given a clock and sleep
+from simulate.VirtualClock the whole run happens in simulated time, see
+simulate.py.
+
+The traffic mix is one flow per line, "kind host destination pps [size]
+[burst]" with # comments:
+
+    ping  hint1 192.168.100.2 1          ICMP echo, replies counted
+    dns   hint2 192.168.42.53 50 80      UDP to port 53, replies counted
+    tcp80 hint1 192.168.42.80 200 1514 10   TCP bursts of burst packets
+    tcp443 hint2 192.168.1.10 200 1514 10
+    scan  hext1 172.16.42.100-199 20     TCP SYNs to hosts nobody answers ARP for
+
+size is the Ethernet frame length.  Per flow we report packets sent and
+delivered to the far host, loss, goodput (payload delivered per second),
+replies that made it back and ICMP errors the source got.  The run lasts
+seconds, then generators stop and the network is left drain seconds for
+packets waiting on ARP to be given up on (5 tries, a second apart).
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import time
+import socket
+import struct
+from collections import deque, defaultdict
+
+from pox.lib.packet import ethernet
+from pox.lib.addresses import EthAddr
+from srpy_common import SrpyShutdown, SrpyNoPackets
+
+from scheduler import EventScheduler
+from icmpfast import fold, word_sum
+from topology import INTERFACES, ip_value
+
+IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+ARP_HEADER = struct.Struct('!HHBBH6s4s6s4s')
+BROADCAST = '\xff' * 6
+ARP_TYPE = '\x08\x06'
+IP_TYPE = '\x08\x00'
+ETH_LEN = 14
+
+KINDS = { #kind -> (protocol, destination port, default frame size, default burst)
+    "ping": (1, 0, 98, 1),
+    "dns": (17, 53, 80, 1),
+    "tcp80": (6, 80, 1514, 10),
+    "tcp443": (6, 443, 1514, 10),
+    "scan": (6, 443, 60, 1),
+}
+
+DEFAULT_MIX = [
+    "ping hint1 192.168.100.2 1",
+    "dns hint1 192.168.42.53 50",
+    "dns hint2 192.168.1.53 50",
+    "tcp80 hint1 192.168.42.80 200",
+    "tcp443 hint2 192.168.1.10 200",
+    "scan hext1 172.16.42.100-199 10",
+]
+
+#name, router port, mac, ip, networks it stands in for (its routes in forwarding_table.txt)
+HOSTS = [("hint1", "router-eth0", "00:00:00:00:01:01", "172.16.42.1", []),
+         ("hint2", "router-eth0", "00:00:00:00:02:01", "172.16.42.2", []),
+         ("hext1", "router-eth1", "00:00:00:00:10:01", "192.168.100.2", ["192.168.42.0/24"]),
+         ("hext2", "router-eth2", "00:00:00:00:20:01", "192.168.200.2", ["192.168.0.0/16"])]
+
+def prefix(text):
+    '''
+    "a.b.c.d/n" -> (network, mask) as unsigned ints
+    '''
+    address, length = text.split('/')
+    mask = (0xFFFFFFFF << (32 - int(length))) & 0xFFFFFFFF
+    return ip_value(address) & mask, mask
+
+def with_checksum(header, offset):
+    '''
+    header with the 16-bit internet checksum over all of it put in at offset
+    '''
+    return header[:offset] + struct.pack('!H', fold(word_sum(header))) + header[offset + 2:]
+
+class Host(object):
+    def __init__(self, net, name, port, eth, ip, behind):
+        self.net = net
+        self.name = name
+        self.port = port
+        self.eth = EthAddr(eth).toRaw()
+        self.ip = socket.inet_aton(ip)
+        self.gateway_eth = net.router[port].ethaddr.toRaw()
+        self.behind = [prefix(text) for text in behind]
+        self.ident = 0 #IP ID of the last packet sent
+
+    def owns(self, raw_ip):
+        if raw_ip == self.ip:
+            return True
+        value = struct.unpack('!I', raw_ip)[0]
+        for network, mask in self.behind:
+            if value & mask == network:
+                return True
+        return False
+
+    def sendIp(self, src, dst, protocol, l4):
+        self.ident = (self.ident + 1) & 0xFFFF
+        header = with_checksum(IP_HEADER.pack(0x45, 0, 20 + len(l4), self.ident, 0, 64, protocol, 0, src, dst), 10)
+        self.net.toRouter(self.port, self.gateway_eth + self.eth + IP_TYPE + header + l4)
+
+    def receive(self, data):
+        if data[:6] != self.eth and data[:6] != BROADCAST:
+            return
+        ethertype = data[12:14]
+        if ethertype == ARP_TYPE:
+            self.receiveArp(data)
+        elif ethertype == IP_TYPE and self.owns(data[30:34]):
+            self.receiveIp(data)
+
+    def receiveArp(self, data):
+        hw, proto, hlen, plen, opcode, sender_eth, sender_ip, target_eth, target_ip = ARP_HEADER.unpack_from(data, ETH_LEN)
+        if opcode != 1 or target_ip != self.ip:
+            return
+        reply = ARP_HEADER.pack(1, 0x0800, 6, 4, 2, self.eth, self.ip, sender_eth, sender_ip)
+        self.net.toRouter(self.port, sender_eth + self.eth + ARP_TYPE + reply)
+
+    def receiveIp(self, data):
+        ihl = (ord(data[ETH_LEN]) & 0x0F) * 4
+        protocol = ord(data[ETH_LEN + 9])
+        src, dst = data[26:30], data[30:34]
+        l4 = data[ETH_LEN + ihl:]
+        if protocol == 1:
+            icmp_type = ord(l4[0])
+            if icmp_type == 8:
+                flow = self.net.echo_flows.get(struct.unpack_from('!H', l4, 4)[0])
+                reply = with_checksum('\x00\x00\x00\x00' + l4[4:], 2)
+                self.sendIp(dst, src, 1, reply)
+                if flow is not None:
+                    flow.arrived(len(l4) - 8)
+            elif icmp_type == 0:
+                flow = self.net.echo_flows.get(struct.unpack_from('!H', l4, 4)[0])
+                if flow is not None:
+                    flow.replies += 1
+            elif icmp_type in (3, 11): #Error about something we sent, find its flow from the quoted header
+                quoted = l4[8:]
+                flow = self.net.flowFor(ord(quoted[9]), quoted[(ord(quoted[0]) & 0x0F) * 4:])
+                if flow is not None:
+                    flow.errors += 1
+        elif protocol in (6, 17):
+            src_port, dst_port = struct.unpack_from('!HH', l4)
+            header = 8 if protocol == 17 else (ord(l4[12]) >> 4) * 4
+            flow = self.net.port_flows.get(src_port)
+            if flow is not None:
+                flow.arrived(len(l4) - header)
+                if flow.kind == "dns": #Answer with the same size back
+                    self.sendIp(dst, src, 17, struct.pack('!HHHH', dst_port, src_port, len(l4), 0) + l4[8:])
+                return
+            flow = self.net.port_flows.get(dst_port)
+            if flow is not None:
+                flow.replies += 1
+
+class Flow(object):
+    def __init__(self, index, kind, host, dst, pps, size, burst):
+        self.index = index
+        self.kind = kind
+        self.host = host
+        self.destinations = destinations(dst) #Raw addresses, sent to in turn
+        self.pps = pps
+        self.size = size
+        self.burst = burst
+        self.protocol, self.dst_port = KINDS[kind][:2]
+        self.port = 20000 + index #Source port (echo ID for pings) the flow is known by
+        self.name = "%s %s->%s" % (kind, host.name, dst)
+
+        self.sent = 0
+        self.delivered = 0
+        self.delivered_bytes = 0 #Payload past the UDP/TCP/ICMP header
+        self.replies = 0
+        self.errors = 0
+
+    def l4(self, seq):
+        padding = '\x00' * max(0, self.size - ETH_LEN - 20 - (8 if self.protocol != 6 else 20))
+        if self.protocol == 1:
+            return with_checksum(struct.pack('!BBHHH', 8, 0, 0, self.port, seq & 0xFFFF) + padding, 2)
+        if self.protocol == 17:
+            return struct.pack('!HHHH', self.port, self.dst_port, 8 + len(padding), 0) + padding
+        flags = 0x02 if self.kind == "scan" else 0x18 #SYN, or PSH+ACK for data
+        return struct.pack('!HHIIBBHHH', self.port, self.dst_port, seq, 0, 0x50, flags, 65535, 0, 0) + padding
+
+    def tick(self, when):
+        net = self.host.net
+        for i in range(self.burst):
+            dst = self.destinations[self.sent % len(self.destinations)]
+            self.host.sendIp(self.host.ip, dst, self.protocol, self.l4(self.sent))
+            self.sent += 1
+        next_tick = when + self.burst / self.pps
+        if next_tick < net.stop:
+            net.scheduler.schedule(next_tick, self.tick, next_tick)
+
+    def arrived(self, payload):
+        self.delivered += 1
+        self.delivered_bytes += payload
+
+def destinations(text):
+    '''
+    "a.b.c.d" or "a.b.c.d-e" (a range of the last byte) -> raw addresses
+    '''
+    if '-' not in text:
+        return [socket.inet_aton(text)]
+    first, last = text.split('-')
+    base = first.rsplit('.', 1)[0]
+    return [socket.inet_aton("%s.%d" % (base, n)) for n in range(int(first.rsplit('.', 1)[1]), int(last) + 1)]
+
+def read_mix(path):
+    lines = []
+    f = open(path, 'r')
+    for line in f:
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#':
+            continue
+        lines.append(line)
+    f.close()
+    return lines
+
+class Emulator(object):
+    def __init__(self, mix, seconds, delay=0.0, ring=1024, drain=6.0, clock=time.time, sleep=time.sleep,
+                 service=0.0):
+        self.clock = clock
+        self.sleep = sleep
+        self.scheduler = EventScheduler(clock)
+        self.delay = delay
+        self.ring = ring
+        self.service = service #Simulated seconds the router takes per frame (virtual clocks only)
+        self.router = dict((intf.name, intf) for intf in INTERFACES)
+
+        self.hosts = {}
+        self.links = defaultdict(list) #router port -> hosts on it
+        for name, port, eth, ip, behind in HOSTS:
+            host = Host(self, name, port, eth, ip, behind)
+            self.hosts[name] = host
+            self.links[port].append(host)
+
+        self.rx = deque() #(port, arrival time, frame bytes) waiting for the router
+        self.queued = defaultdict(int) #Frames in rx per port
+        self.ring_drops = defaultdict(int)
+
+        self.started = clock()
+        self.stop = self.started + seconds #Generators stop here
+        self.end = self.stop + drain #and the router is shut down here
+        self.seconds = seconds
+
+        self.flows = []
+        self.port_flows = {} #Source port -> flow, for TCP/UDP
+        self.echo_flows = {} #Echo ID -> flow
+        for index, line in enumerate(mix):
+            fields = line.split()
+            kind, host, dst, pps = fields[0], self.hosts[fields[1]], fields[2], float(fields[3])
+            if kind not in KINDS:
+                raise ValueError("Unknown traffic kind '%s'" % kind)
+            size = int(fields[4]) if len(fields) > 4 else KINDS[kind][2]
+            burst = int(fields[5]) if len(fields) > 5 else KINDS[kind][3]
+            flow = Flow(index, kind, host, dst, pps, size, burst)
+            self.flows.append(flow)
+            if flow.protocol == 1:
+                self.echo_flows[flow.port] = flow
+            else:
+                self.port_flows[flow.port] = flow
+            self.scheduler.schedule(self.started, flow.tick, self.started)
+
+    def flowFor(self, protocol, l4):
+        '''
+        Flow a packet belongs to, from its protocol and the start of its L4 header
+        '''
+        if protocol == 1 and len(l4) >= 6:
+            return self.echo_flows.get(struct.unpack_from('!H', l4, 4)[0])
+        if protocol in (6, 17) and len(l4) >= 2:
+            return self.port_flows.get(struct.unpack_from('!H', l4)[0])
+        return None
+
+    def toRouter(self, port, data):
+        if self.delay:
+            self.scheduler.schedule(self.clock() + self.delay, self.arrive, port, data)
+        else:
+            self.arrive(port, data)
+
+    def arrive(self, port, data):
+        if self.queued[port] >= self.ring:
+            self.ring_drops[port] += 1
+            return
+        self.queued[port] += 1
+        self.rx.append((port, self.clock(), data))
+
+    def deliver(self, port, data):
+        for host in self.links[port]: #sw1 floods, the hosts pick out what's theirs
+            host.receive(data)
+
+    #The router's side
+
+    def interfaces(self):
+        return INTERFACES
+
+    def recv_packet(self, timeout=None):
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            self.scheduler.runDue()
+            if self.rx:
+                port, ts, data = self.rx.popleft()
+                self.queued[port] -= 1
+                if self.service:
+                    self.sleep(self.service)
+                return port, ts, ethernet(raw=data)
+            now = self.clock()
+            if now >= self.end:
+                raise SrpyShutdown()
+            if deadline is not None and now >= deadline:
+                raise SrpyNoPackets()
+            wake = min(when for when in (self.scheduler.nextDeadline(), deadline, self.end) if when is not None)
+            if wake > now:
+                self.sleep(wake - now)
+
+    def send_packet(self, name, pkt):
+        data = pkt.pack()
+        if self.delay:
+            self.scheduler.schedule(self.clock() + self.delay, self.deliver, name, data)
+        else:
+            self.deliver(name, data)
+
+    def shutdown(self):
+        pass
+
+    def report(self):
+        lines = ["%-34s %8s %9s %6s %12s %8s %7s" % ("flow", "sent", "delivered", "loss", "goodput", "replies", "errors")]
+        for flow in self.flows:
+            loss = 100.0 * (flow.sent - flow.delivered) / flow.sent if flow.sent else 0.0
+            lines.append("%-34s %8d %9d %5.1f%% %8.3fMb/s %8d %7d" % (flow.name, flow.sent, flow.delivered, loss,
+                         flow.delivered_bytes * 8 / self.seconds / 1e6, flow.replies, flow.errors))
+        for port in sorted(self.ring_drops):
+            lines.append("%s receive ring full: %d frames lost" % (port, self.ring_drops[port]))
+        return "\n".join(lines)
+
+def tests():
+    '''
+    The default mix for 3 seconds on simulated time, against the shipped
+    forwarding_table.txt and firewall_rules.txt, with the router on its
+    default settings.  Simulated runs are deterministic, so every flow's
+    counts have to come out exactly the same each time.
+    '''
+    from simulate import simulate
+    from myrouter4 import Router
+    from routerconfig import RouterConfig
+
+    config = RouterConfig(os.devnull) #Defaults, whatever router_config.txt says
+    config["table_snapshot"] = "none"
+    config["metrics_socket"] = "none"
+    net = simulate(Router, config, DEFAULT_MIX, 3.0)
+
+    expected = { #flow -> (sent, delivered, replies, errors)
+        "ping hint1->192.168.100.2": (3, 3, 1, 0), #Echo replies share the 100 byte/s ICMP limit with the requests
+        "dns hint1->192.168.42.53": (151, 151, 0, 0), #Replies come from 192.168.42.0/24, which is denied
+        "dns hint2->192.168.1.53": (151, 151, 151, 0),
+        "tcp80 hint1->192.168.42.80": (610, 41, 0, 0), #12500 byte/s limit on port 80
+        "tcp443 hint2->192.168.1.10": (610, 610, 0, 0),
+        "scan hext1->172.16.42.100-199": (30, 0, 0, 30), #Nobody answers ARP, host unreachable
+    }
+    counts = dict((flow.name, (flow.sent, flow.delivered, flow.replies, flow.errors)) for flow in net.flows)
+    if counts != expected:
+        print(net.report())
+    assert counts == expected
+    assert not net.ring_drops
+
+    #A flood at a host nobody answers ARP for: every packet over the pending cap
+    #is reported unreachable, as far as the per-source ICMP limit (10 back to
+    #back, then 10/s) lets it
+    config["pending_packets"] = 4
+    net = simulate(Router, config, ["scan hext1 172.16.42.100-100 200"], 1.0)
+    flow = net.flows[0]
+    assert (flow.sent, flow.delivered, flow.errors) == (201, 0, 20)
+    print("emulator: ok")
+
+if __name__ == '__main__' and sys.argv[1:] == ["test"]:
+    tests()
+elif __name__ == '__main__':
+    from myrouter4 import Router
+    from routerconfig import RouterConfig
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    mix = read_mix(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] != "default" else DEFAULT_MIX
+    delay = float(sys.argv[3]) / 1e3 if len(sys.argv) > 3 else 0.0
+    drain = float(sys.argv[4]) if len(sys.argv) > 4 else 6.0
+
+    net = Emulator(mix, seconds, delay, drain=drain)
+    Router(net, RouterConfig()).router_main()
+    print(net.report())
@@ -0,0 +1,272 @@
+'''
+Callback event loop front end for the Router.
+
+Python 2 has no asyncio, so this is the small piece of it the router needs:
+timers come from the router's own EventScheduler, and the loop sleeps in one
+blocking call until either a packet arrives or the next timer is due.  ARP
+retries and neighbor aging are timers (firewall buckets refill from the clock
+as packets use them), so nothing wakes up on a fixed poll interval and an
+idle router sleeps until there's work.
+
+The timers that do repeat only run while there are neighbors: the neighbor
+sweep every arp_age_interval and the interface check every
+interface_check_interval.  Neighbors nothing is sent to expire
+arp_stale_time after they go stale, and then both stop; the first packet
+after that checks the interfaces before it's handled.
+
+Packets come in through a transport that calls the router for each frame:
+-SrpyTransport wraps an srpy net object (blocking recv_packet with the time
+    to the next timer as its timeout)
+-RawSocketNet reads AF_PACKET sockets on local interfaces, registered with
+    the loop's select(); it's also a net object the Router can send on
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+from pox.lib.addresses import EthAddr, IPAddr
+from srpy_common import log_info, SrpyShutdown, SrpyNoPackets
+from topology import Interface
+import errno
+import select
+import socket
+import struct
+import fcntl
+import time
+
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+SIOCGIFHWADDR = 0x8927
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4 #sll_pkttype of frames we sent ourselves
+
+class EventLoop(object):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.readers = {} #fd -> callback
+        self.poll = self.select #Replaced by transports that can't give us an fd
+        self.running = False
+
+    def callAt(self, when, callback, *args):
+        return self.scheduler.schedule(when, callback, *args)
+
+    def callLater(self, delay, callback, *args):
+        return self.scheduler.schedule(self.scheduler.clock() + delay, callback, *args)
+
+    def addReader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def removeReader(self, fd):
+        self.readers.pop(fd, None)
+
+    def select(self, timeout):
+        try:
+            ready = select.select(list(self.readers), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return #A signal (metrics or profiling) woke us, its timer runs next time round
+        for fd in ready:
+            self.readers[fd]()
+
+    def stop(self):
+        self.running = False
+
+    def runForever(self):
+        self.running = True
+        while self.running:
+            self.scheduler.runDue()
+            deadline = self.scheduler.nextDeadline()
+            if deadline is None: #No timers at all, sleep until a packet shows up
+                timeout = None
+            else:
+                timeout = max(0.0, deadline - self.scheduler.clock())
+            self.poll(timeout)
+
+class SrpyTransport(object):
+    '''
+    Feeds an srpy net's packets to on_packet(dev, ts, frame)
+    '''
+    def __init__(self, net, loop, on_packet):
+        self.net = net
+        self.loop = loop
+        self.on_packet = on_packet
+        loop.poll = self.poll
+
+    def poll(self, timeout):
+        try:
+            dev, ts, frame = self.net.recv_packet(timeout=timeout)
+        except SrpyNoPackets:
+            return
+        except SrpyShutdown:
+            self.loop.stop()
+            return
+        self.on_packet(dev, ts, frame)
+
+def _ioctl(sock, request, name):
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name[:15]))
+
+class RawSocketNet(object):
+    '''
+    Net object over AF_PACKET sockets bound to local interfaces (needs root).
+    register() hooks the sockets up to an EventLoop.
+    '''
+    def __init__(self, names):
+        self.sockets = {}
+        self.intfs = []
+        for name in names:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+            sock.bind((name, 0))
+            sock.setblocking(False)
+            self.sockets[name] = sock
+            self.intfs.append(self.describe(name, sock))
+
+    def describe(self, name, sock):
+        eth = EthAddr(_ioctl(sock, SIOCGIFHWADDR, name)[18:24])
+        ip = IPAddr(_ioctl(sock, SIOCGIFADDR, name)[20:24])
+        mask = IPAddr(_ioctl(sock, SIOCGIFNETMASK, name)[20:24])
+        return Interface(name, eth, ip, mask)
+
+    def interfaces(self):
+        '''
+        Current addresses (the router checks back for changes); an interface
+        that has lost its address keeps the last one it had
+        '''
+        for i, intf in enumerate(self.intfs):
+            try:
+                self.intfs[i] = self.describe(intf.name, self.sockets[intf.name])
+            except IOError:
+                pass
+        return self.intfs
+
+    def register(self, loop, on_packet):
+        for name, sock in self.sockets.items():
+            loop.addReader(sock.fileno(), lambda name=name, sock=sock: self.receive(name, sock, on_packet))
+
+    def receive(self, name, sock, on_packet):
+        while True: #Drain everything that's there, the socket is non-blocking
+            try:
+                frame, address = sock.recvfrom(65535)
+            except socket.error:
+                return
+            if address[2] != PACKET_OUTGOING: #Skip our own sends
+                on_packet(name, time.time(), frame)
+
+    def send_packet(self, name, pkt):
+        self.sockets[name].send(pkt.pack())
+
+    def shutdown(self):
+        for sock in self.sockets.values():
+            sock.close()
+
+def run_event_loop(router):
+    '''
+    Runs router on an EventLoop until the net shuts down (or ^C for raw sockets)
+    '''
+    loop = EventLoop(router.scheduler)
+
+    def on_packet(dev, ts, frame):
+        if router.interfacesIdle:
+            router.resumeInterfaceChecks()
+        router.handlePacket(dev, frame, ts) #Firewall buckets top themselves up by the clock
+
+    if isinstance(router.net, RawSocketNet):
+        router.net.register(loop, on_packet)
+    else:
+        SrpyTransport(router.net, loop, on_packet)
+
+    router.startLoop()
+    try:
+        loop.runForever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.stopLoop()
+
+
+def tests():
+    from myrouter4 import Router
+    from routerconfig import RouterConfig
+    from arptemplates import arp_frame
+    from icmpfast import fold, word_sum
+    from topology import INTERFACES
+
+    now = [0.0]
+    host_ip, host_eth = IPAddr("172.16.42.1"), EthAddr("02:00:00:00:00:01")
+    moved = list(INTERFACES)
+    moved[0] = Interface("router-eth0", INTERFACES[0].ethaddr, "172.16.42.253", "255.255.255.0")
+
+    def arp_request(ip):
+        return arp_frame(1, '\xff' * 6, host_eth.toRaw(), host_eth.toRaw(), host_ip.toRaw(), '\x00' * 6, ip.toRaw())
+
+    def dns_reply(): #192.168.100.2:53 to the host
+        udp = struct.pack('!HHHH', 53, 5000, 8, 0)
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28, 0, 0, 64, 17, 0,
+                             IPAddr("192.168.100.2").toRaw(), host_ip.toRaw())
+        header = header[:10] + struct.pack('!H', fold(word_sum(header))) + header[12:]
+        return INTERFACES[1].ethaddr.toRaw() + '\x02' + '\x00' * 5 + '\x08\x00' + header + udp
+
+    class ScriptNet(object):
+        '''
+        srpy net on a fake clock: packets come in at the given times, the
+        address of router-eth0 changes at 500 s
+        '''
+        def __init__(self, script):
+            self.script = list(script)
+            self.wakeups = [] #Clock at every timeout with no packet
+            self.sleeps = [] #Clock at every wait with no timeout at all
+            self.sent = []
+        def interfaces(self):
+            return INTERFACES if now[0] < 500.0 else moved
+        def recv_packet(self, timeout=None):
+            if timeout is None:
+                self.sleeps.append(now[0])
+            if self.script and (timeout is None or self.script[0][0] <= now[0] + timeout):
+                when, dev, frame = self.script.pop(0)
+                now[0] = max(now[0], when)
+                return dev, when, frame
+            if timeout is None or now[0] > 2000.0: #Would sleep forever, or never goes quiet
+                raise SrpyShutdown()
+            now[0] += timeout
+            self.wakeups.append(now[0])
+            raise SrpyNoPackets()
+        def send_packet(self, name, pkt):
+            self.sent.append((now[0], name, pkt.pack()))
+
+    config = RouterConfig()
+    config["lookup"] = "trie"
+    config["table_snapshot"] = "none"
+    net = ScriptNet([(0.0, "router-eth0", arp_request(INTERFACES[0].ipaddr)),
+                     (0.5, "router-eth1", dns_reply()),
+                     (20.0, "router-eth0", arp_request(INTERFACES[0].ipaddr)),
+                     (1000.0, "router-eth0", arp_request(moved[0].ipaddr))])
+    run_event_loop(Router(net, config, clock=lambda: now[0]))
+
+    #The host is sent to once and heard from again at 20 s.  Its cached flow has
+    #been idle since, so it isn't probed: it's swept until it expires, and then
+    #there are no wakeups at all until the next packet.
+    quiet = config["arp_stale_time"] + config["arp_age_interval"] + config["interface_check_interval"]
+    first = [when for when in net.wakeups if when < 1000.0]
+    second = [when for when in net.wakeups if when > 1000.0]
+    assert first and second and len(first) + len(second) == len(net.wakeups)
+    assert max(first) <= 20.0 + quiet and max(second) <= 1000.0 + quiet, net.wakeups
+    assert net.sleeps == [max(first), max(second)], net.sleeps
+
+    #ARP requests answered (the last from the address router-eth0 got while
+    #nothing was checking), the packet forwarded, and no probes
+    assert [(when, name) for when, name, raw in net.sent] == \
+        [(0.0, "router-eth0"), (0.5, "router-eth0"), (20.0, "router-eth0"), (1000.0, "router-eth0")]
+    assert net.sent[1][2][:6] == host_eth.toRaw() and net.sent[1][2][12:14] == '\x08\x00'
+    assert net.sent[3][2][28:32] == moved[0].ipaddr.toRaw()
+    print "eventloop: ok"
+
+if __name__ == '__main__' and sys.argv[1:] == ["test"]:
+    tests()
+elif __name__ == '__main__':
+    #Route between local interfaces: python eventloop.py eth0 eth1 ...
+    from myrouter4 import Router
+    net = RawSocketNet(sys.argv[1:])
+    run_event_loop(Router(net))
+    net.shutdown()
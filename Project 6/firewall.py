@@ -15,15 +15,21 @@ from sets import Set
 #4/3/2014
 
 class Firewall(object):
-    def __init__(self):
-        f = open("firewall_rules.txt",'r')
-        
+    def __init__(self, clock=time.time, rules=None):
         protocols = {"ip": -1, "icmp": 1, "tcp": 6, "udp": 17} #mappings from names to protocol number
         #"ip" is a wildcard for any protocol, so -1
         
         self.rule_set = [] #Empty list for Rule objects        
         self.buckets = Set() #Empty set to store buckets for easy update
         
+        if rules is not None: #Already built (from a table snapshot), nothing to parse
+            for rule in rules:
+                self.rule_set.append(rule)
+                if rule.bucket != None:
+                    self.buckets.add(rule.bucket)
+            return
+        
+        f = open("firewall_rules.txt",'r')
         for line in f:
             line = line.strip()
             if len(line) == 0 or line[0] == '#': #Skip comments and empty lines
@@ -52,13 +58,13 @@ class Firewall(object):
                 dst_port = self.get_port(rule_list[9])
                 
                 if permit and len(rule_list) == 12: #Rate lmt exists
-                    token_bucket = TokenBucket(int(rule_list[11]))
+                    token_bucket = TokenBucket(int(rule_list[11]), clock)
                     self.buckets.add(token_bucket) #Track all the buckets we have on hand for easy-updating
             else:
                 dst_mask = self.get_mask(rule_list[5])
                 
                 if permit and len(rule_list) == 8: #We have a rate limit in place
-                    token_bucket = TokenBucket(int(rule_list[7]))
+                    token_bucket = TokenBucket(int(rule_list[7]), clock)
                     self.buckets.add(token_bucket)
               
             new_rule = Rule(permit, protocol_num, src_mask, dst_mask, src_port, dst_port, token_bucket)      
@@ -90,30 +96,59 @@ class Firewall(object):
         else:
             return int(port_num)
         
-    def update_token_buckets(self):
-        '''
-        Update all the buckets.
-        '''
-        for bucket in self.buckets:
-            bucket.increment()
-        
     def allow(self, pkt): #Amusingly, I called this "allow" before seeing your test() code
         '''
         Does the meat and potatoes checking of packets
         Takes an ip packet as input
         '''
         
+        src_port = -1
+        dst_port = -1
         if pkt.protocol > 1: #Means pkt is TCP or UDP, in this implementation environment
             src_port = pkt.payload.srcport
             dst_port = pkt.payload.dstport
             
-        src_ip = pkt.srcip.toUnsigned()
-        dst_ip = pkt.dstip.toUnsigned()
+        rule = self.match(pkt.protocol, pkt.srcip.toUnsigned(), pkt.dstip.toUnsigned(), src_port, dst_port)
+        if rule is None:
+            return True #Default to letting packets through
+        if rule.bucket != None: #There won't be a bucket unless it's permitted
+            return rule.bucket.decrement(len(pkt.pack())) #Count the number of bytes directly
+        return rule.permitted
         
+    def allowView(self, view):
+        '''
+        Same check as allow, on an ingress.FrameView: fields come straight out of
+        the header bytes and the byte count is the IP total length
+        '''
+        src_port, dst_port = view.ports()
+        rule = self.match(view.protocol, view.srcip, view.dstip, src_port, dst_port)
+        if rule is None:
+            return True
+        if rule.bucket != None:
+            return rule.bucket.decrement(view.length)
+        return rule.permitted
+
+    def checkView(self, view):
+        '''
+        allowView, but returns (allowed, rate_limited) where rate_limited says
+        the packet went through a rule with a token bucket
+        '''
+        src_port, dst_port = view.ports()
+        rule = self.match(view.protocol, view.srcip, view.dstip, src_port, dst_port)
+        if rule is None:
+            return True, False
+        if rule.bucket != None:
+            return rule.bucket.decrement(view.length), True
+        return rule.permitted, False
+
+    def match(self, protocol, src_ip, dst_ip, src_port, dst_port):
+        '''
+        First rule matching the packet's fields (addresses unsigned, ports -1 if none), or None
+        '''
         #I do believe we managed to scrimp by with 1 real if-statement. Huzzah.
         for rule in self.rule_set:
             #Wildcard on "ip" rules
-            if rule.protocol != -1 and rule.protocol != pkt.protocol: continue
+            if rule.protocol != -1 and rule.protocol != protocol: continue
             
             #-1 for both no port # and any port #
             if rule.dst_port != -1 and rule.dst_port != dst_port: continue
@@ -127,11 +162,9 @@ class Firewall(object):
             #everything despite the fact that we failed the Xth test already
                     
             #Passed all the checks, this packet has met the rule
-            if rule.bucket != None: #There won't be a bucket unless it's permitted
-                return rule.bucket.decrement(pkt)
-            return rule.permitted
+            return rule
             
-        return True #Default to letting packets through
+        return None
         
 class Rule(object):
     '''
@@ -154,22 +187,31 @@ class Rule(object):
 class TokenBucket(object):
     '''
     Easily manage tokens for a single flow.
+    rate_limit bytes a second, up to two seconds' worth banked.
     '''
     
-    def __init__(self, rate_limit):
+    def __init__(self, rate_limit, clock=time.time):
+        self.rate = rate_limit
         self.max_tokens = rate_limit*2
-        self.add_tokens = rate_limit/2
         self.num_tokens = self.max_tokens #Start with the bucket full
+        self.clock = clock
+        self.last = clock() #When tokens were last added
         
     def increment(self):
-        if self.num_tokens < self.max_tokens:
-            self.num_tokens = (self.num_tokens + self.add_tokens) % (self.max_tokens + 1)
+        '''
+        Adds the tokens earned since the last call
+        '''
+        now = self.clock()
+        elapsed = now - self.last
+        self.last = now
+        if elapsed > 0 and self.num_tokens < self.max_tokens:
+            self.num_tokens = min(self.max_tokens, self.num_tokens + elapsed * self.rate)
             
-    def decrement(self, ip_packet):
+    def decrement(self, num_bytes):
         '''
         Return True and decrement tokens if can manage it, False otherwise
         '''
-        num_bytes = len(ip_packet.pack()) #Count the number of bytes directly
+        self.increment()
         if num_bytes <= self.num_tokens:
             self.num_tokens -= num_bytes
             return True
@@ -190,17 +232,14 @@ def tests():
      xudp.len = 8 + len(xudp.payload)
      ip.payload = xudp
      print len(ip) # print the length of the packet, just for fun
-     # you can name this method what ever you like, but you'll
-     # need some method that gets periodically invoked for updating
-     # token bucket state for any rules with rate limits
-     f.update_token_buckets()
+     # token buckets top themselves up from the clock whenever a packet
+     # is checked against them, so there's nothing to call periodically
      # again, you can name your "checker" as you want, but the
      # idea here is that we call some method on the firewall to
      # test whether a given packet should be permitted or denied.
      assert(f.allow(ip) == True) #if you want to simulate a time delay and updating token buckets,
-     #you can just call time.sleep and then update the buckets.
+     #you can just call time.sleep, the buckets catch up on their own.
      ##time.sleep(0.5)
-     ##f.update_token_buckets()
      
      ####
      
@@ -263,9 +302,6 @@ def tests():
         
      #####
      
-     time.sleep(0.5)
-     f.update_token_buckets()
-     
      
      
  
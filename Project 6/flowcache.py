@@ -0,0 +1,166 @@
+'''
+Destination flow cache for the forwarding path.
+
+Maps a destination IP (unsigned) to the fully resolved egress tuple
+(interface name, source MAC, next hop MAC, the two MACs as the 12 raw bytes
+that start an Ethernet header) so a hit skips the route lookup,
+the nameMap lookups and the ARP table check.  Entries are dropped exactly when
+something they were built from changes: a route covering the destination,
+the ARP entry of the next hop, or the egress interface.
+'''
+
+from collections import OrderedDict
+import time
+
+from lpm import prefix_mask
+
+class FlowCache(object):
+    def __init__(self, capacity, clock=time.time):
+        self.capacity = capacity #0 turns the cache off
+        self.clock = clock
+        self.entries = OrderedDict() #dst -> egress tuple, least recently used first
+        self.last_hit = {} #dst -> when its entry was put or last hit
+        self.nexthops = {} #dst -> next hop IP the entry was resolved through
+        self.by_nexthop = {} #next hop IP -> set of dsts resolved through it
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, dst):
+        entry = self.entries.pop(dst, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[dst] = entry #Back to most recently used
+        self.last_hit[dst] = self.clock()
+        self.hits += 1
+        return entry
+
+    def probe(self, dst):
+        '''
+        Like get(), but a miss isn't counted: the caller falls back to a path
+        that calls get() itself
+        '''
+        entry = self.entries.pop(dst, None)
+        if entry is None:
+            return None
+        self.entries[dst] = entry
+        self.last_hit[dst] = self.clock()
+        self.hits += 1
+        return entry
+
+    def put(self, dst, nexthop, entry):
+        if self.capacity <= 0:
+            return
+        if dst in self.entries:
+            self._remove(dst)
+        elif len(self.entries) >= self.capacity:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        self.entries[dst] = entry
+        self.last_hit[dst] = self.clock()
+        self.nexthops[dst] = nexthop
+        self.by_nexthop.setdefault(nexthop, set()).add(dst)
+
+    def _remove(self, dst):
+        del self.entries[dst]
+        del self.last_hit[dst]
+        nexthop = self.nexthops.pop(dst)
+        dsts = self.by_nexthop[nexthop]
+        dsts.discard(dst)
+        if not dsts:
+            del self.by_nexthop[nexthop]
+
+    def usedSince(self, nexthop, since):
+        '''
+        True if a flow through nexthop was cached or hit at or after since
+        '''
+        last_hit = self.last_hit
+        for dst in self.by_nexthop.get(nexthop, ()):
+            if last_hit[dst] >= since:
+                return True
+        return False
+
+    def invalidateNexthop(self, nexthop):
+        '''
+        ARP entry for nexthop changed
+        '''
+        for dst in list(self.by_nexthop.get(nexthop, ())):
+            self._remove(dst)
+            self.invalidations += 1
+
+    def invalidatePrefix(self, key, length):
+        '''
+        A route for key/length was added, changed or removed
+        '''
+        mask = prefix_mask(length)
+        for dst in [dst for dst in self.entries if dst & mask == key]:
+            self._remove(dst)
+            self.invalidations += 1
+
+    def invalidateInterface(self, name):
+        '''
+        Addresses on interface name changed
+        '''
+        for dst in [dst for dst, entry in self.entries.items() if entry[0] == name]:
+            self._remove(dst)
+            self.invalidations += 1
+
+    def stats(self):
+        return {"size": len(self.entries), "capacity": self.capacity, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations}
+
+def tests():
+    cache = FlowCache(3)
+    for dst, nexthop, intf in ((1, "gw1", "eth0"), (2, "gw1", "eth0"), (3, "gw2", "eth1")):
+        cache.put(dst, nexthop, (intf, dst))
+    assert cache.get(1) == ("eth0", 1) #1 is now the most recently used
+    cache.put(4, "gw2", ("eth1", 4)) #Full, 2 was least recently used
+    assert cache.get(2) is None and cache.evictions == 1
+    assert [dst for dst in cache.entries] == [3, 1, 4]
+    assert cache.probe(5) is None and cache.misses == 1 #probe doesn't count misses
+
+    cache.invalidateNexthop("gw2")
+    assert list(cache.entries) == [1] and "gw2" not in cache.by_nexthop
+
+    cache.capacity = 8 #Room for the rest without evictions
+    prefix = 0x0A000000
+    for offset, intf in ((1, "eth0"), (2, "eth0"), (0x010000, "eth1")):
+        cache.put(prefix | offset, "gw3", (intf, offset))
+    cache.invalidatePrefix(prefix, 24) #10.0.0.0/24 holds .1 and .2, not 10.1.0.0
+    assert set(cache.entries) == set([1, prefix | 0x010000])
+    cache.invalidateInterface("eth1")
+    assert list(cache.entries) == [1]
+    assert cache.by_nexthop == {"gw1": set([1])}
+    assert cache.invalidations == 5
+
+    #Only flows hit lately make a next hop busy, not just having some
+    now = [0.0]
+    cache = FlowCache(8, lambda: now[0])
+    cache.put(1, "gw1", ("eth0", 1))
+    cache.put(2, "gw1", ("eth0", 2))
+    cache.put(3, "gw2", ("eth1", 3))
+    now[0] = 20.0
+    cache.probe(2)
+    now[0] = 40.0
+    assert cache.usedSince("gw1", 10.0) and not cache.usedSince("gw1", 25.0)
+    assert cache.usedSince("gw2", 0.0) and not cache.usedSince("gw2", 10.0) and not cache.usedSince("gw3", 0.0)
+    cache.get(3)
+    assert cache.usedSince("gw2", 40.0)
+    cache.invalidateNexthop("gw1")
+    assert sorted(cache.last_hit) == [3]
+
+    off = FlowCache(0)
+    off.put(1, "gw1", ("eth0", 1))
+    assert len(off) == 0
+    print("flowcache: ok")
+
+if __name__ == '__main__':
+    tests()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+'''
+Large synthetic forwarding tables and firewall rule sets, in the same
+formats as forwarding_table.txt and firewall_rules.txt, plus traffic that
+exercises them
+
+Usage: python gen_scale.py [routes] [rules] [packets] [directory]
+
+Writes directory/forwarding_table.txt, directory/firewall_rules.txt,
+directory/routes.pcap and directory/acl.pcap (defaults: 1000000 routes,
+10000 rules, 100000 packets each, "scale").  Everything comes from a fixed
+seed, so the same arguments give the same files.
+
+Routes: distinct prefixes with lengths spread like the IPv4 BGP table
+(about 60% /24s, then /22, /23, /21, /20...; nothing longer than /24),
+none inside 10/8, 127/8, 172.16/12, 192.168/16 or multicast, so the
+emulated topology's own addresses still go where they did.  Next hops are
+the hosts on the router's three links.
+
+Rules: drawn from 64 /16 "sites" at /16, /20, /24, /28 and /32, so
+prefixes overlap and nest the way they do in real ACLs, and 15% are "any".
+Most TCP/UDP rules are for a well-known port; the rule format only takes a
+single port, so a port range is written as one rule per port (15% of the
+time, 2-16 ports).  5% of permits have a rate limit.  The last rule is
+"deny ip src any dst any" like the shipped file.
+
+routes.pcap: UDP port 53 from hint1 to addresses inside random routes, so
+the shipped firewall lets it through.  acl.pcap: for each packet a random
+rule (not the last) and a packet that rule matches.  Both come in on
+router-eth0; use them with replay.py --tables directory.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import bisect
+import random
+import socket
+import struct
+from pox.lib.addresses import EthAddr
+
+from lpm import prefix_mask
+from emulator import IP_HEADER, IP_TYPE, HOSTS, with_checksum
+from topology import INTERFACES, ip_value
+from replay import PcapWriter
+
+#Prefix length -> routes per million, roughly the IPv4 default-free zone
+LENGTHS = [(8, 20), (9, 50), (10, 150), (11, 400), (12, 1200), (13, 2500), (14, 5000), (15, 9000),
+           (16, 13000), (17, 9000), (18, 15000), (19, 30000), (20, 45000), (21, 50000), (22, 120000),
+           (23, 100000), (24, 600000)]
+RESERVED = [("0.0.0.0", 8), ("10.0.0.0", 8), ("127.0.0.0", 8), ("172.16.0.0", 12), ("192.168.0.0", 16),
+            ("224.0.0.0", 3)]
+NEXTHOPS = [("192.168.100.2", "router-eth1"), ("192.168.200.2", "router-eth2"),
+            ("172.16.42.1", "router-eth0"), ("172.16.42.2", "router-eth0")]
+
+PROTOCOLS = [("tcp", 45), ("udp", 30), ("icmp", 10), ("ip", 15)]
+SERVICES = [22, 25, 53, 80, 110, 123, 143, 443, 445, 993, 1433, 3306, 3389, 5432, 8080, 8443]
+RATES = [12500, 125000, 1250000] #100kbit/s, 1Mbit/s, 10Mbit/s
+SITES = 64
+KEEP = 10000 #Routes kept aside to aim traffic at
+
+def dotted(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+_RESERVED = [(ip_value(address), length) for address, length in RESERVED]
+
+def reserved(key, length):
+    for other, other_length in _RESERVED:
+        mask = prefix_mask(min(length, other_length))
+        if key & mask == other & mask:
+            return True
+    return False
+
+def weighted(rng, choices):
+    '''
+    rng.choice over (value, weight) pairs
+    '''
+    total = sum(weight for value, weight in choices)
+    pick = rng.random() * total
+    for value, weight in choices:
+        pick -= weight
+        if pick < 0:
+            return value
+    return choices[-1][0]
+
+def routes(count, seed=0):
+    '''
+    (key, length, nexthop, name) for count distinct prefixes
+    '''
+    rng = random.Random(seed)
+    lengths = [length for length, weight in LENGTHS]
+    cumulative = []
+    total = 0
+    for length, weight in LENGTHS:
+        total += weight
+        cumulative.append(total)
+    seen = set()
+    while len(seen) < count:
+        length = lengths[bisect.bisect_right(cumulative, rng.random() * total)]
+        key = rng.getrandbits(32) & prefix_mask(length)
+        if (key << 6 | length) in seen or reserved(key, length):
+            continue
+        seen.add(key << 6 | length)
+        nexthop, name = rng.choice(NEXTHOPS)
+        yield key, length, nexthop, name
+
+def write_routes(path, count, seed=0):
+    '''
+    Writes count routes to path, returns a sample of up to KEEP of them
+    '''
+    rng = random.Random(seed + 1)
+    sample = []
+    f = open(path, 'w')
+    for seen, (key, length, nexthop, name) in enumerate(routes(count, seed)):
+        f.write("%s %s %s %s\n" % (dotted(key), dotted(prefix_mask(length)), nexthop, name))
+        if len(sample) < KEEP: #Reservoir sample
+            sample.append((key, length))
+        else:
+            slot = rng.randint(0, seen)
+            if slot < KEEP:
+                sample[slot] = (key, length)
+    f.close()
+    return sample
+
+def acl_rules(count, seed=0):
+    '''
+    count rules as (action, protocol, src, src_port, dst, dst_port, rate);
+    addresses are (key, length) or None for any, ports and rate None if unset
+    '''
+    rng = random.Random(seed)
+    sites = []
+    while len(sites) < SITES:
+        site = rng.getrandbits(16) << 16
+        if not reserved(site, 16):
+            sites.append(site)
+
+    def address():
+        if rng.random() < 0.15:
+            return None
+        length = rng.choice((16, 20, 24, 24, 28, 32))
+        return (rng.choice(sites) | rng.getrandbits(16)) & prefix_mask(length), length
+
+    rules = []
+    while len(rules) < count - 1:
+        action = "permit" if rng.random() < 0.7 else "deny"
+        protocol = weighted(rng, PROTOCOLS)
+        src, dst = address(), address()
+        rate = rng.choice(RATES) if action == "permit" and rng.random() < 0.05 else None
+        if protocol in ("tcp", "udp"):
+            src_port = rng.choice(SERVICES) if rng.random() < 0.1 else None
+            if rng.random() < 0.15:
+                first = rng.randint(1024, 65000)
+                ports = range(first, first + rng.randint(2, 16))
+            elif rng.random() < 0.9:
+                ports = [rng.choice(SERVICES)]
+            else:
+                ports = [None]
+            for port in ports:
+                rules.append((action, protocol, src, src_port, dst, port, rate))
+        else:
+            rules.append((action, protocol, src, None, dst, None, rate))
+    rules = rules[:count - 1]
+    rules.append(("deny", "ip", None, None, None, None, None))
+    return rules
+
+def rule_line(rule):
+    action, protocol, src, src_port, dst, dst_port, rate = rule
+    def address(value):
+        return "any" if value is None else "%s/%d" % (dotted(value[0]), value[1])
+    def port(value):
+        return "any" if value is None else str(value)
+    if protocol in ("tcp", "udp"):
+        line = "%s %s src %s srcport %s dst %s dstport %s" % (action, protocol, address(src), port(src_port),
+                                                              address(dst), port(dst_port))
+    else:
+        line = "%s %s src %s dst %s" % (action, protocol, address(src), address(dst))
+    if rate is not None:
+        line += " ratelimit %d" % rate
+    return line + "\n"
+
+def write_rules(path, count, seed=0):
+    rules = acl_rules(count, seed)
+    f = open(path, 'w')
+    for rule in rules:
+        f.write(rule_line(rule))
+    f.close()
+    return rules
+
+ROUTER_ETH = INTERFACES[0].ethaddr.toRaw()
+HINT1_ETH = EthAddr(HOSTS[0][2]).toRaw()
+PROTOCOL_NUMBERS = {"icmp": 1, "tcp": 6, "udp": 17}
+
+def frame(src, dst, protocol, src_port, dst_port, payload=18):
+    '''
+    Ethernet frame from hint1 to the router carrying an IP packet (addresses
+    unsigned); ICMP is an echo request
+    '''
+    if protocol == 1:
+        l4 = with_checksum(struct.pack('!BBHHH', 8, 0, 0, src_port, 1) + '\x00' * payload, 2)
+    elif protocol == 17:
+        l4 = struct.pack('!HHHH', src_port, dst_port, 8 + payload, 0) + '\x00' * payload
+    else:
+        l4 = struct.pack('!HHIIBBHHH', src_port, dst_port, 1, 0, 0x50, 0x18, 65535, 0, 0) + '\x00' * payload
+    header = with_checksum(IP_HEADER.pack(0x45, 0, 20 + len(l4), 0, 0, 64, protocol, 0,
+                                          struct.pack('!I', src), struct.pack('!I', dst)), 10)
+    return ROUTER_ETH + HINT1_ETH + IP_TYPE + header + l4
+
+def inside(rng, prefix):
+    '''
+    Random address in (key, length), or anywhere outside the reserved ranges for None
+    '''
+    if prefix is None:
+        while True:
+            value = rng.getrandbits(32)
+            if not reserved(value, 32):
+                return value
+    key, length = prefix
+    return key | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF)
+
+def write_route_traffic(path, sample, count, seed=0):
+    rng = random.Random(seed)
+    writer = PcapWriter(path)
+    for i in range(count):
+        src = ip_value("172.16.42.%d" % rng.randint(1, 250))
+        dst = inside(rng, rng.choice(sample))
+        writer.write(i * 1e-5, frame(src, dst, 17, rng.randint(1024, 65535), 53))
+    writer.close()
+
+def write_acl_traffic(path, rules, count, seed=0):
+    rng = random.Random(seed)
+    writer = PcapWriter(path)
+    for i in range(count):
+        action, protocol, src, src_port, dst, dst_port, rate = rng.choice(rules[:-1])
+        if protocol == "ip":
+            protocol = rng.choice(("tcp", "udp", "icmp"))
+        if src_port is None:
+            src_port = rng.randint(1024, 65535)
+        if dst_port is None:
+            dst_port = rng.randint(1, 65535)
+        writer.write(i * 1e-5, frame(inside(rng, src), inside(rng, dst), PROTOCOL_NUMBERS[protocol],
+                                     src_port, dst_port))
+    writer.close()
+
+if __name__ == '__main__':
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rule_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    packets = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    directory = sys.argv[4] if len(sys.argv) > 4 else "scale"
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    sample = write_routes(os.path.join(directory, "forwarding_table.txt"), route_count)
+    rules = write_rules(os.path.join(directory, "firewall_rules.txt"), rule_count)
+    write_route_traffic(os.path.join(directory, "routes.pcap"), sample, packets)
+    write_acl_traffic(os.path.join(directory, "acl.pcap"), rules, packets)
+    print("%d routes, %d rules, %d + %d packets in %s" % (route_count, len(rules), packets, packets, directory))
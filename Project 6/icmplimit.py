@@ -0,0 +1,119 @@
+'''
+Rate limits on the ICMP the router generates itself (RFC 1812 4.3.2.8).
+
+Every error and echo reply has to get a token from a global bucket and from
+a bucket for the source it's going back to, so one host pinging or
+tracerouting hard can't use up the whole budget.  Buckets refill with
+elapsed time; per-source buckets are kept for the most recently seen
+max_sources sources.  Whatever is turned down is counted per ICMP type.
+'''
+
+import time
+from collections import OrderedDict
+
+TYPE_NAMES = {0: "echo_reply", 3: "unreachable", 11: "time_exceeded"}
+
+class _Bucket(object):
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.last = now
+
+    def take(self, rate, burst, now):
+        '''
+        Refills for the time since the last call, then takes a token if there is one
+        '''
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class IcmpLimiter(object):
+    def __init__(self, rate, burst, source_rate, source_burst, max_sources, clock=time.time):
+        self.rate = rate #Messages/sec overall, 0 for no limit
+        self.burst = burst
+        self.source_rate = source_rate #Messages/sec to any one source, 0 for no limit
+        self.source_burst = source_burst
+        self.max_sources = max_sources
+        self.clock = clock
+
+        self.bucket = _Bucket(burst, clock())
+        self.sources = OrderedDict() #source ip (unsigned) -> _Bucket, least recently used first
+
+        self.sent = {}
+        self.suppressed = {} #ICMP type -> messages turned down
+
+    def allow(self, src, icmp_type):
+        '''
+        True if an ICMP icmp_type message may go to src (unsigned) right now
+        '''
+        now = self.clock()
+        if self.source_rate and not self.sourceBucket(src, now).take(self.source_rate, self.source_burst, now):
+            self.suppressed[icmp_type] = self.suppressed.get(icmp_type, 0) + 1
+            return False
+        if self.rate and not self.bucket.take(self.rate, self.burst, now):
+            self.suppressed[icmp_type] = self.suppressed.get(icmp_type, 0) + 1
+            return False
+        self.sent[icmp_type] = self.sent.get(icmp_type, 0) + 1
+        return True
+
+    def sourceBucket(self, src, now):
+        bucket = self.sources.pop(src, None)
+        if bucket is None:
+            bucket = _Bucket(self.source_burst, now)
+            if self.sources and len(self.sources) >= self.max_sources:
+                self.sources.popitem(last=False)
+        self.sources[src] = bucket
+        return bucket
+
+    def stats(self):
+        names = lambda counts: dict((TYPE_NAMES.get(t, t), n) for t, n in counts.items())
+        return {"sent": names(self.sent), "suppressed": names(self.suppressed),
+                "sources": len(self.sources)}
+
+def tests():
+    '''
+    Bursts, refill and per-source isolation on a fake clock
+    '''
+    now = [100.0]
+    clock = lambda: now[0]
+    a, b, c = 0x0A000001, 0x0A000002, 0x0A000003
+
+    #Per source: a burst, then one per 1/rate seconds, and nobody else is affected
+    limiter = IcmpLimiter(0, 0, 2.0, 3, 8, clock)
+    assert [limiter.allow(a, 11) for i in range(4)] == [True, True, True, False]
+    assert limiter.allow(b, 11) and limiter.allow(b, 3)
+    now[0] += 0.25 #Half a token
+    assert not limiter.allow(a, 11)
+    now[0] += 0.25
+    assert limiter.allow(a, 11) and not limiter.allow(a, 11)
+    now[0] += 60.0 #Refills only up to the burst
+    assert [limiter.allow(a, 0) for i in range(4)] == [True, True, True, False]
+    assert limiter.stats() == {"sent": {"time_exceeded": 5, "unreachable": 1, "echo_reply": 3},
+                               "suppressed": {"time_exceeded": 3, "echo_reply": 1}, "sources": 2}
+
+    #Overall: shared by every source
+    limiter = IcmpLimiter(10.0, 4, 0, 0, 8, clock)
+    assert [limiter.allow(src, 3) for src in (a, b, c, a, b)] == [True, True, True, True, False]
+    now[0] += 0.15 #1.5 tokens
+    assert limiter.allow(c, 3) and not limiter.allow(a, 3)
+    assert limiter.stats()["sources"] == 0 #No per-source limit, no per-source state
+
+    #Only the max_sources most recent sources keep a bucket; a forgotten one starts full
+    limiter = IcmpLimiter(0, 0, 1.0, 1, 2, clock)
+    assert limiter.allow(a, 11) and limiter.allow(b, 11)
+    assert not limiter.allow(a, 11) #a is now the most recent
+    assert limiter.allow(c, 11) #Evicts b
+    assert list(limiter.sources) == [a, c]
+    assert limiter.allow(b, 11)
+
+    #Both limits off
+    limiter = IcmpLimiter(0, 0, 0, 0, 8, clock)
+    assert all(limiter.allow(a, 11) for i in range(1000))
+    print("icmplimit: ok")
+
+if __name__ == '__main__':
+    tests()
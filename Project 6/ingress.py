@@ -0,0 +1,123 @@
+'''
+Header-only ingress parsing.
+
+FrameView reads just the fields the router decides on straight out of the
+received bytes with struct.unpack_from on a memoryview: the Ethernet type
+first, then the IPv4 header and L4 ports only if someone asks.  A pox
+ethernet object is only built (or reused, if srpy already made one) when a
+packet has to go down the regular object path.
+'''
+
+import struct
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+from pox.lib.packet import ethernet
+
+ETH_LEN = 14
+IP_TYPE = 0x0800
+ARP_TYPE = 0x0806
+
+_ETHERTYPE = struct.Struct('!H')
+_IPV4 = struct.Struct('!BxH4xBB2xII') #ver/ihl, total length, ttl, protocol, src, dst
+_PORTS = struct.Struct('!HH')
+
+class FrameView(object):
+    __slots__ = ('raw', 'pkt', 'buf', 'ethertype', 'ihl', 'length', 'ttl', 'protocol',
+                 'srcip', 'dstip', '_ports')
+
+    def __init__(self, frame):
+        if isinstance(frame, (str, bytearray)): #Net object handed us bytes
+            self.raw = frame
+            self.pkt = None
+        else: #Already a pox ethernet, read its bytes rather than its objects
+            self.pkt = frame
+            self.raw = getattr(frame, 'raw', None) or frame.pack()
+
+        self.buf = memoryview(self.raw)
+        self.ethertype = _ETHERTYPE.unpack_from(self.buf, 12)[0] if len(self.raw) >= ETH_LEN else None
+        self.ihl = None #IPv4 fields, filled in by ip()
+        self._ports = None
+
+    def packet(self):
+        '''
+        The pox ethernet object for this frame, parsed on first use
+        '''
+        if self.pkt is None:
+            self.pkt = ethernet(raw=bytes(self.raw))
+        return self.pkt
+
+    def ip(self):
+        '''
+        Decodes the IPv4 header fields (addresses as unsigned ints).
+        Returns False if the bytes aren't a sane IPv4 header, options included.
+        '''
+        if self.ihl is None:
+            if len(self.raw) < ETH_LEN + 20:
+                return False
+            ver_ihl, self.length, self.ttl, self.protocol, self.srcip, self.dstip = \
+                _IPV4.unpack_from(self.buf, ETH_LEN)
+            if ver_ihl >> 4 != 4 or ver_ihl & 0xF < 5 or len(self.raw) < ETH_LEN + (ver_ihl & 0xF) * 4:
+                return False
+            self.ihl = (ver_ihl & 0xF) * 4
+        return True
+
+    def ports(self):
+        '''
+        (srcport, dstport) for TCP/UDP, (-1, -1) for anything else
+        '''
+        if self._ports is None:
+            self._ports = (-1, -1)
+            if self.ip() and self.protocol in (6, 17) and len(self.raw) >= ETH_LEN + self.ihl + 4:
+                self._ports = _PORTS.unpack_from(self.buf, ETH_LEN + self.ihl)
+        return self._ports
+
+def tests():
+    from topology import udp_frame, ip_value
+    frame = udp_frame(53, 100)
+    view = FrameView(frame)
+    assert view.ethertype == IP_TYPE and view.ip()
+    assert (view.ihl, view.length, view.ttl, view.protocol) == (20, 86, 64, 17)
+    assert (view.srcip, view.dstip) == (ip_value("172.16.42.1"), ip_value("192.168.42.5"))
+    assert view.ports() == (5000, 53) and view.pkt is None
+    assert FrameView(bytearray(frame)).ports() == (5000, 53)
+
+    #Options: the ports are after IHL words, not 20 bytes
+    options = frame[:14] + '\x47' + frame[15:34] + '\x01' * 8 + frame[34:]
+    view = FrameView(options)
+    assert view.ip() and view.ihl == 28 and view.ports() == (5000, 53)
+    assert FrameView(frame[:14] + '\x4f' + frame[15:]).ip() #60 byte header fits in 100 bytes
+    assert not FrameView(frame[:14] + '\x4f' + frame[15:60]).ip() #but not in 60
+    assert FrameView(options[:14 + 28 + 3]).ports() == (-1, -1) #Ports cut off
+
+    #Not an IPv4 header: wrong version, IHL under 5, too short, not TCP/UDP
+    assert not FrameView(frame[:14] + '\x65' + frame[15:]).ip()
+    assert not FrameView(frame[:14] + '\x44' + frame[15:]).ip()
+    assert not FrameView(frame[:33]).ip()
+    assert FrameView(frame[:23] + '\x01' + frame[24:]).ports() == (-1, -1)
+
+    #Other ethertypes are left alone, VLAN tagged ones included (as pox leaves them)
+    vlan = frame[:12] + '\x81\x00\x00\x05' + frame[12:]
+    assert FrameView(vlan).ethertype == 0x8100
+    assert FrameView(frame[:12] + '\x86\xdd' + frame[14:]).ethertype == 0x86dd
+    assert FrameView(frame[:12] + '\x08\x06' + frame[14:]).ethertype == ARP_TYPE
+
+    #Runts: no ethertype at all, nothing that reads past the end
+    for size in range(14):
+        view = FrameView(frame[:size])
+        assert view.ethertype is None and not view.ip() and view.ports() == (-1, -1)
+    assert FrameView(frame[:14]).ethertype == IP_TYPE and not FrameView(frame[:14]).ip()
+
+    #A pox ethernet: its own bytes are read and it's what packet() hands back
+    pkt = ethernet(raw=frame)
+    view = FrameView(pkt)
+    assert view.packet() is pkt and view.ip() and view.ports() == (5000, 53)
+    view = FrameView(frame)
+    pkt = view.packet()
+    assert pkt.type == IP_TYPE and view.packet() is pkt
+    print "ingress: ok"
+
+if __name__ == '__main__':
+    tests()
@@ -0,0 +1,273 @@
+'''
+Longest-prefix-match table for the router.
+
+Path-compressed binary (Patricia) trie over unsigned 32-bit prefix keys, the
+same keys buildMappings() computes with toUnsigned().  Lookups walk at most
+one node per bit of the address, so they are O(32) no matter how many routes
+are loaded, and routes can be added/removed without rebuilding anything.
+
+Only this stage's router uses it.  Project 4's myrouter2.py and Project 5's
+myrouter3.py keep their linear matchPrefix scan: those are the handed-in
+versions of the earlier stages and stay as they were submitted.
+'''
+
+_EMPTY = object() #Marks glue nodes that exist only to branch, not to route
+
+def prefix_mask(length):
+    '''
+    Unsigned netmask for a prefix length (0..32)
+    '''
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+def common_length(a, b, limit):
+    '''
+    Number of leading bits a and b share, capped at limit
+    '''
+    diff = (a ^ b) & 0xFFFFFFFF
+    if diff == 0:
+        return limit
+    return min(32 - diff.bit_length(), limit)
+
+class _Node(object):
+    __slots__ = ('key', 'length', 'value', 'children')
+
+    def __init__(self, key, length, value):
+        self.key = key
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+class PrefixTrie(object):
+    '''
+    Maps (prefix, prefix length) -> value and answers longest-prefix matches.
+
+    Values are whatever the caller stores; the router stores the same
+    (netmask, nexthop, interface name) tuples it always has.
+    '''
+
+    def __init__(self):
+        self.root = _Node(0, 0, _EMPTY) #Holds the default route, if any
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, key, length, value):
+        '''
+        Add or replace the route for key/length
+        '''
+        key &= prefix_mask(length)
+        node = self.root
+
+        while True:
+            if node.length == length: #Only reachable when node.key == key
+                if node.value is _EMPTY:
+                    self.count += 1
+                node.value = value
+                return
+
+            bit = (key >> (31 - node.length)) & 1
+            child = node.children[bit]
+            if child is None: #Empty branch, just hang the new leaf here
+                node.children[bit] = _Node(key, length, value)
+                self.count += 1
+                return
+
+            common = common_length(child.key, key, min(child.length, length))
+            if common == child.length: #child is an ancestor of key, keep going
+                node = child
+                continue
+
+            if common == length: #New route sits between node and child
+                new = _Node(key, length, value)
+                new.children[(child.key >> (31 - length)) & 1] = child
+            else: #Diverge below both, need a glue node to branch
+                new = _Node(key & prefix_mask(common), common, _EMPTY)
+                new.children[(child.key >> (31 - common)) & 1] = child
+                new.children[(key >> (31 - common)) & 1] = _Node(key, length, value)
+
+            node.children[bit] = new
+            self.count += 1
+            return
+
+    def delete(self, key, length):
+        '''
+        Remove the route for key/length.  Returns True if it existed.
+        Glue nodes left with a single child are spliced out so the trie
+        stays path-compressed.
+        '''
+        key &= prefix_mask(length)
+        path = [] #(parent, bit) pairs leading to node
+        node = self.root
+
+        while node is not None and node.length < length:
+            if (key ^ node.key) >> (32 - node.length):
+                return False
+            bit = (key >> (31 - node.length)) & 1
+            path.append((node, bit))
+            node = node.children[bit]
+
+        if node is None or node.length != length or node.key != key or node.value is _EMPTY:
+            return False
+
+        node.value = _EMPTY
+        self.count -= 1
+
+        while path and node.value is _EMPTY:
+            parent, bit = path.pop()
+            left, right = node.children
+            if left is not None and right is not None:
+                break #Still a useful branch point
+            parent.children[bit] = left if left is not None else right
+            node = parent
+            if node is self.root:
+                break
+
+        return True
+
+    def lookup(self, addr):
+        '''
+        Longest-prefix match for an unsigned address, None if nothing matches
+        '''
+        node = self.root
+        best = None
+
+        while node is not None:
+            length = node.length
+            if (addr ^ node.key) >> (32 - length): #Diverged from this branch
+                break
+            if node.value is not _EMPTY:
+                best = node.value
+            if length == 32:
+                break
+            node = node.children[(addr >> (31 - length)) & 1]
+
+        return best
+
+    def match(self, addr):
+        '''
+        lookup, but returns (prefix length, value) so the caller can compare
+        against another table, None if nothing matches
+        '''
+        node = self.root
+        best = None
+
+        while node is not None:
+            length = node.length
+            if (addr ^ node.key) >> (32 - length):
+                break
+            if node.value is not _EMPTY:
+                best = (length, node.value)
+            if length == 32:
+                break
+            node = node.children[(addr >> (31 - length)) & 1]
+
+        return best
+
+    def covering(self, key, length):
+        '''
+        Longest route strictly shorter than length that covers key/length.
+        Returns (length, value) or None.
+        '''
+        key &= prefix_mask(length)
+        node = self.root
+        best = None
+
+        while node is not None and node.length < length:
+            if (key ^ node.key) >> (32 - node.length):
+                break
+            if node.value is not _EMPTY:
+                best = (node.length, node.value)
+            node = node.children[(key >> (31 - node.length)) & 1]
+
+        return best
+
+    def within(self, key, length):
+        '''
+        Yields (key, length, value) for every route at or inside key/length
+        '''
+        key &= prefix_mask(length)
+        node = self.root
+        while node is not None and node.length < length:
+            if (key ^ node.key) >> (32 - node.length):
+                return
+            node = node.children[(key >> (31 - node.length)) & 1]
+        if node is None or (key ^ node.key) >> (32 - length):
+            return
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.value is not _EMPTY:
+                yield node.key, node.length, node.value
+            for child in node.children:
+                if child is not None:
+                    stack.append(child)
+
+    def items(self):
+        '''
+        Yields (key, length, value) for every route, shortest prefixes first
+        along each branch
+        '''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.value is not _EMPTY:
+                yield node.key, node.length, node.value
+            for child in node.children:
+                if child is not None:
+                    stack.append(child)
+
+def tests():
+    '''
+    Random inserts/deletes checked against a brute-force longest-prefix match
+    '''
+    import random
+    rng = random.Random(0)
+    routes = {} #(key, length) -> value
+    trie = PrefixTrie()
+
+    def brute(addr):
+        best = None
+        for (key, length), value in routes.items():
+            if addr & prefix_mask(length) == key and (best is None or length > best[0]):
+                best = (length, value)
+        return best
+
+    def address():
+        if routes and rng.random() < 0.7: #Near a route, so matches actually happen
+            key, length = rng.choice(list(routes))
+            return key | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF)
+        return rng.getrandbits(32)
+
+    for step in range(3000):
+        if routes and rng.random() < 0.3:
+            key, length = rng.choice(list(routes))
+            del routes[(key, length)]
+            assert trie.delete(key, length)
+            assert not trie.delete(key, length)
+        else:
+            length = rng.choice((0, 1, 7, 8, 12, 16, 16, 20, 24, 24, 25, 30, 32))
+            key = (rng.choice((0x0A000000, 0xC0A80000, 0)) | rng.getrandbits(16)) & prefix_mask(length)
+            routes[(key, length)] = step
+            trie.insert(key, length, step)
+        assert len(trie) == len(routes)
+
+        for i in range(5):
+            addr = address()
+            expected = brute(addr)
+            assert trie.match(addr) == expected
+            assert trie.lookup(addr) == (expected[1] if expected else None)
+
+    assert sorted((key, length) for key, length, value in trie.items()) == sorted(routes)
+    key, length = rng.choice([route for route in routes if route[1] >= 16])
+    inside = sorted((k, l) for k, l, v in trie.within(key, length))
+    assert inside == sorted(route for route in routes if route[1] >= length and
+                            route[0] & prefix_mask(length) == key)
+    cover = trie.covering(key, length)
+    shorter = [(l, v) for (k, l), v in routes.items() if l < length and key & prefix_mask(l) == k]
+    assert cover == (max(shorter) if shorter else None)
+    print("lpm: ok")
+
+if __name__ == '__main__':
+    tests()
@@ -0,0 +1,307 @@
+'''
+Counters and per-stage latency histograms for the router, on when metrics
+is 1 in router_config.txt.
+
+Nothing here is called on the per-packet path unless metrics is on: the
+router swaps in timed versions of its packet handlers and wraps its net in
+MeteredNet at startup, so with metrics off the only cost is a check on the
+rare paths (ARP timeouts, ICMP errors, route misses).
+
+Histograms are HDR-style: values (nanoseconds) are exact up to 64, above
+that each power of two is split into 32 buckets, so whatever is recorded is
+reported to within ~3% and recording is a few integer operations.
+
+Residence time (from the recv_packet timestamp to the send) is kept per
+path a packet took: "fast" (fast path), "forward" (object path),
+"arp" (waited on ARP), "icmp" (an error or echo reply we made for it) and
+"ratelimited" (went through a firewall rule with a rate limit).  The router
+tags each frame it sends with where it came from; MeteredNet records it.
+
+The report goes to the log on SIGUSR1, and to anything that connects to the
+metrics_socket UNIX socket (e.g. "nc -U router.metrics").  That is read from
+another thread, so everything recorded into Metrics happens under its lock;
+the router takes it once per packet (or batch) for all of that packet's updates.
+'''
+
+import os
+import struct
+import signal
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from rawframe import RawFrame
+
+SUB_BITS = 5
+SUB = 1 << SUB_BITS #Buckets per power of two
+MAX_BITS = 40 #Largest value kept is ~18 minutes, longer ones count as that
+STAGES = ("parse", "firewall", "route", "arp_wait", "send")
+PERCENTILES = (0.5, 0.9, 0.99, 0.999)
+PER_INTERFACE = ("rx_packets", "rx_bytes", "tx_packets", "tx_bytes")
+PATHS = ("fast", "forward", "arp", "icmp", "ratelimited")
+
+LINEAR = 2 * SUB #Values below this get a bucket each
+LARGEST = (1 << MAX_BITS) - 1
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * ((MAX_BITS - SUB_BITS + 1) * SUB)
+        self.sum = 0
+        self.max = 0
+
+    def record(self, seconds, count=1):
+        value = int(seconds * 1e9 + 0.5) #Rounded, 15e-9 * 1e9 is 14.999...
+        if value < LINEAR:
+            if value < 0: #Clock stepped back
+                value = 0
+            self.counts[value] += count
+        else:
+            if value > LARGEST:
+                value = LARGEST
+            shift = value.bit_length() - SUB_BITS - 1
+            self.counts[(shift << SUB_BITS) + (value >> shift)] += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+
+    def summary(self):
+        '''
+        {"count", "mean", "max", "p50", ...} with times in seconds
+        '''
+        counts = list(self.counts) #Copy first, the router may be recording while we read
+        total = sum(counts)
+        summary = {"count": total, "mean": self.sum / 1e9 / total if total else 0.0, "max": self.max / 1e9}
+        wanted = [(fraction, max(int(fraction * total + 0.999999), 1)) for fraction in PERCENTILES]
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            while wanted and seen >= wanted[0][1]:
+                summary["p%g" % (wanted.pop(0)[0] * 100)] = min(bucket_top(index), self.max) / 1e9
+            if not wanted:
+                break
+        for fraction, rank in wanted: #Nothing recorded
+            summary["p%g" % (fraction * 100)] = 0.0
+        return summary
+
+def bucket_top(index):
+    '''
+    Largest value that lands in bucket index
+    '''
+    if index < LINEAR:
+        return index
+    shift = (index >> SUB_BITS) - 1
+    return ((index - (shift << SUB_BITS) + 1) << shift) - 1
+
+class Metrics(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.counters = defaultdict(int) #name -> count
+        self.rx_packets = defaultdict(int) #Per interface name, kept apart so the hot path
+        self.rx_bytes = defaultdict(int) #doesn't have to build "name.interface" keys
+        self.tx_packets = defaultdict(int)
+        self.tx_bytes = defaultdict(int)
+        self.stages = dict((stage, Histogram()) for stage in STAGES)
+        self.residence = dict((path, Histogram()) for path in PATHS) #Receive to send, per path
+        self.nested = 0.0 #Time spent sending since the route stage started, so route doesn't count it
+        self.lock = threading.Lock() #Held for every update and while a snapshot is taken
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, stage, seconds, count=1):
+        with self.lock:
+            self.stages[stage].record(seconds, count)
+
+    def snapshot(self, wait=True):
+        '''
+        Everything recorded so far, copied under the lock.  wait=False is for
+        signal handlers: the thread they interrupted may be the one holding
+        it, and then nothing else can be updating anyway.
+        '''
+        locked = self.lock.acquire(wait)
+        try:
+            counters = dict(self.counters)
+            for kind in PER_INTERFACE:
+                for intf, value in getattr(self, kind).items():
+                    counters["%s.%s" % (kind, intf)] = value
+            return {"uptime": self.clock() - self.started, "counters": counters,
+                    "stages": dict((stage, self.stages[stage].summary()) for stage in STAGES),
+                    "residence": dict((path, self.residence[path].summary()) for path in PATHS)}
+        finally:
+            if locked:
+                self.lock.release()
+
+    def report(self, wait=True):
+        '''
+        The snapshot as text, one line per counter, interface and stage
+        '''
+        snapshot = self.snapshot(wait)
+        uptime = max(snapshot["uptime"], 1e-9)
+        counters = snapshot["counters"]
+        lines = ["uptime %.1f s" % uptime]
+        for name in sorted(counters):
+            lines.append("%s %d" % (name, counters[name]))
+
+        interfaces = sorted(set(name.split('.', 1)[1] for name in counters if name.startswith(("rx_", "tx_"))))
+        for intf in interfaces:
+            lines.append("rate %s rx %.1f pps %.0f bps tx %.1f pps %.0f bps" % (intf,
+                         counters.get("rx_packets." + intf, 0) / uptime,
+                         counters.get("rx_bytes." + intf, 0) * 8 / uptime,
+                         counters.get("tx_packets." + intf, 0) / uptime,
+                         counters.get("tx_bytes." + intf, 0) * 8 / uptime))
+
+        for kind, names in (("stage", STAGES), ("residence", PATHS)):
+            for name in names:
+                lines.append(summary_line(kind, name, snapshot[kind if kind == "residence" else "stages"][name]))
+        return "\n".join(lines) + "\n"
+
+def summary_line(kind, name, summary):
+    return ("%s %s count %d mean %.1f us " % (kind, name, summary["count"], summary["mean"] * 1e6) +
+            " ".join("p%g %.1f us" % (fraction * 100, summary["p%g" % (fraction * 100)] * 1e6)
+                     for fraction in PERCENTILES) +
+            " max %.1f us" % (summary["max"] * 1e6))
+
+def ethertype(pkt):
+    '''
+    Ethernet type of a frame about to be sent, a RawFrame or a pox ethernet
+    '''
+    if isinstance(pkt, RawFrame):
+        return struct.unpack_from('!H', pkt.buf, 12)[0]
+    return pkt.type
+
+class MeteredNet(object):
+    '''
+    The router's net with every send timed (the send stage) and counted per
+    interface, and the residence time of frames the router tagged recorded.
+    Everything else goes straight to the real net.
+    '''
+    def __init__(self, net, metrics):
+        self.net = net
+        self.metrics = metrics
+        self.send = metrics.stages["send"]
+
+    def send_packet(self, name, pkt):
+        metrics = self.metrics
+        start = metrics.clock()
+        self.net.send_packet(name, pkt)
+        sent = metrics.clock()
+        elapsed = sent - start
+        received = getattr(pkt, "received", None)
+        size = len(pkt) if isinstance(pkt, RawFrame) else len(pkt.pack())
+        with metrics.lock:
+            metrics.nested += elapsed
+            self.send.record(elapsed)
+            if received is not None:
+                metrics.residence[pkt.path].record(sent - received)
+            metrics.tx_packets[name] += 1
+            metrics.tx_bytes[name] += size
+
+    def __getattr__(self, name):
+        return getattr(self.net, name)
+
+class MetricsServer(object):
+    '''
+    Writes a report to each client that connects to a UNIX socket at path,
+    from a daemon thread
+    '''
+    def __init__(self, metrics, path):
+        self.metrics = metrics
+        self.path = path
+        if os.path.exists(path): #Left over from an earlier run
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except socket.error: #Closed
+                return
+            try:
+                client.sendall(self.metrics.report())
+            except socket.error:
+                pass
+            client.close()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def dump_on_signal(metrics, log, signum=signal.SIGUSR1):
+    '''
+    log(report) whenever signum arrives.  Only works from the main thread,
+    returns False if that's not where we are.
+    '''
+    try:
+        signal.signal(signum, lambda number, frame: log(metrics.report(wait=False)))
+    except ValueError:
+        return False
+    return True
+
+def tests():
+    import random
+
+    def check(values, histogram=None):
+        '''
+        Records values (ns) and compares every percentile with the exact
+        nearest-rank one: never below it, at most one bucket (1/SUB) above
+        '''
+        if histogram is None:
+            histogram = Histogram()
+            for value in values:
+                histogram.record(value / 1e9)
+        ordered = sorted(values)
+        summary = histogram.summary()
+        assert summary["count"] == len(values) and summary["max"] == ordered[-1] / 1e9
+        assert abs(summary["mean"] - sum(values) / 1e9 / len(values)) < 1e-12
+        for fraction in PERCENTILES:
+            exact = ordered[max(int(fraction * len(values) + 0.999999), 1) - 1]
+            reported = summary["p%g" % (fraction * 100)] * 1e9
+            assert exact - 1e-6 <= reported <= exact * (1 + 1.0 / SUB) + 1e-6, (fraction, exact, reported)
+        return summary
+
+    #Exact below LINEAR, including values that don't survive a round trip through float seconds
+    summary = check(range(LINEAR))
+    assert abs(summary["p50"] * 1e9 - (LINEAR / 2 - 1)) < 1e-6
+    check([29] * 10)
+
+    #Uniform, exponential and long-tailed samples
+    state = random.getstate()
+    random.seed(465)
+    check(range(1000, 1000000, 7))
+    check([int(random.expovariate(1 / 50000.0)) for i in range(50000)])
+    check([int(1000 * random.paretovariate(1.5)) for i in range(50000)])
+    random.setstate(state)
+
+    #99% at 10 us and 1% at 5 ms: the tail only shows from p99.9
+    summary = check([10000] * 990 + [5000000] * 10)
+    assert summary["p50"] == summary["p99"] and abs(summary["p99"] - 10e-6) < 10e-6 / SUB
+    assert abs(summary["p99.9"] - 5e-3) < 5e-3 / SUB
+
+    #record(count=n) is n records; out of range values are clamped
+    bulk, single = Histogram(), Histogram()
+    bulk.record(123e-6, 5)
+    for i in range(5):
+        single.record(123e-6)
+    assert bulk.counts == single.counts and bulk.sum == single.sum
+    clamped = Histogram()
+    clamped.record(-1.0)
+    clamped.record(1e6)
+    assert clamped.counts[0] == 1 and clamped.max == LARGEST and bucket_top(len(clamped.counts) - 1) >= LARGEST
+
+    empty = Histogram().summary()
+    assert empty["count"] == 0 and empty["mean"] == 0.0 and empty["p50"] == 0.0
+    print "metrics: ok"
+
+if __name__ == '__main__':
+    tests()
@@ -19,103 +19,143 @@ from pox.lib.packet import arp
 from pox.lib.addresses import EthAddr,IPAddr,netmask_to_cidr
 from srpy_common import log_info, log_debug, log_warn, SrpyShutdown, SrpyNoPackets, debugger
 import time
+import struct
 
 from firewall import Firewall
+from lpm import PrefixTrie
+from dir248 import Dir248Table, available_memory
+from routerconfig import RouterConfig
+from flowcache import FlowCache
+from scheduler import EventScheduler
+from neighbor import NeighborCache
+from rawframe import RawFrame, forward_raw
+from ingress import FrameView, IP_TYPE, ARP_TYPE
+from arptemplates import ArpTemplates
+from icmpfast import IcmpErrors
+from icmplimit import IcmpLimiter
+from rss import RssDispatcher
+from pipeline import Pipeline
+from eventloop import run_event_loop
+from qos import QosPolicy, EgressScheduler
+from aqm import aqm_factory
+from metrics import Metrics, MeteredNet, MetricsServer, dump_on_signal, ethertype
+from profiling import Profiler, PacketTracer
+from snapshot import TableSnapshot
 
 class Router(object):
-    def __init__(self, net):
+    def __init__(self, net, config=None, clock=time.time):
         self.net = net
+        self.config = config or RouterConfig() #Settings from router_config.txt
+        self.clock = clock #What every timer, timeout and rate limit goes by (simulate.VirtualClock in simulations)
         
-        self.ip_to_ether = {} #Empty dict to store mappings
+        self.neighbors = NeighborCache(self.config["arp_cache_size"], self.config["arp_reachable_time"],
+                                       self.config["arp_stale_time"], self.config["arp_probe_interval"],
+                                       self.config["arp_probes"], self.neighborRemoved, clock) #ip -> eth mappings
         self.my_interfaces = Set() #Set of ip's for this router's interfaces
-        self.forwardingTable = {}
+        self.my_addrs = Set() #Same, as unsigned ints for FrameView lookups
+        self.forwardingTable = PrefixTrie() #Longest-prefix-match table of (mask, nexthop, name)
         self.nameMap = {} #Maps from intf names to ip and eth addresses
+        self.intfMasks = {} #Maps from intf names to netmasks
+        self.arpTemplates = ArpTemplates() #Pre-packed ARP frames per interface
+        self.icmpErrors = IcmpErrors() #ICMP error headers with per-interface checksums
+        self.icmpLimiter = IcmpLimiter(self.config["icmp_rate"], self.config["icmp_burst"],
+                                       self.config["icmp_source_rate"], self.config["icmp_source_burst"],
+                                       self.config["icmp_sources"], clock) #Caps on ICMP we generate
+        self.flowCache = FlowCache(self.config["flow_cache_size"], clock) #dst ip -> resolved egress
+        self.scheduler = EventScheduler(clock) #ARP retry/timeout timers
+        self.outbox = None #Frames held per egress interface while a batch is processed
+        self.firewall = None #Made in router_main unless set up beforehand
+        self.agingTimer = None #Next neighbor cache sweep, None while there's nothing to age
+        self.interfaceTimer = None #Next check for address changes on our interfaces
+        self.interfacesIdle = False #Checks stopped while there's no traffic, the next packet runs one
+        self.egress = None #Class queues per interface, if egress_qos is on
+        self.egressTimer = None #Next time a paced interface can send
+        self.metrics = None #Counters and stage histograms, if metrics is on
+        self.metricsServer = None
+        self.received = None #With metrics on: when the packet being handled came in,
+        self.sendPath = None #and the residence path its sends are put down to
+        self.profiler = None #cProfile/sampling windows on SIGUSR2
+        self.tracer = None #1-in-N packet tracing, if trace_every is set
+        self.handleUntraced = None #handlePacket as it was before tracing wrapped it
+        self.snapshot = None #Mapped table_snapshot the routes (and firewall rules) come from, if any
+        if self.config["egress_qos"]:
+            self.egress = EgressScheduler(QosPolicy.load(), [intf.name for intf in net.interfaces()],
+                                          aqm_factory(self.config))
+        
+        self.arp_ip = {} #Empty dict for IP's we're waiting for ARPs on
+        #Dict because it's faster than queue and we don't care about order
+        self.pending = PendingQueues(self.config["pending_packets"], self.config["pending_bytes"],
+                                     self.config["pending_total_packets"], self.config["pending_total_bytes"],
+                                     self.config["pending_drop_policy"],
+                                     aqm_factory(self.config, "pending_aqm"),
+                                     clock, self.pendingDropped) #Caps on packets held in arp_ip
         
         self.buildMappings()        
     
     def makeReply(self, dst_ip, src_ip, hwdst, src_eth):
         '''
         Creates an ARP reply packet given IP source and destination, Ethernet source and destination
+        -Patched out of the pre-packed template for the interface being asked about
         '''
+        return self.arpTemplates.reply(dst_ip, src_ip, hwdst, src_eth)
 
-        arp_rep = arp() #Build up packet
+    def makeRequest(self, dst_ip, src_ip, src_eth, unicast=None):
+        '''
+        Creates an ARP request packet (broadcast, or to the unicast MAC if given)
+        -Patched out of the pre-packed template for the sending interface, so
+            retries of the same request send the exact same bytes
+        '''
+        return self.arpTemplates.request(dst_ip, src_ip, src_eth, unicast)
         
-        arp_rep.opcode = arp.REPLY
-        arp_rep.protosrc = dst_ip
-        arp_rep.protodst = src_ip
-        arp_rep.hwsrc = hwdst #Matching ethernet asked for in initial request
-        arp_rep.hwdst = src_eth
-            
-        ether = ethernet() #wrap in ether
-        ether.type = ether.ARP_TYPE
-        ether.set_payload(arp_rep)
-        ether.src = hwdst
-        ether.dst = src_eth
-
-        return ether
-
-    def makeRequest(self, dst_ip, src_ip, src_eth):
+    def sendIcmpError(self, errorType, codeType, original, dev):
         '''
-        Creates an ARP request packet
-        -Of same structure as makeReply, but distinct enough that it's worth having
-            different functions that lay it all out
+        Sends ICMP errorType/codeType about original (the offending IP packet's
+        bytes) back to its source, from dev's address
+        -Built from the header bytes, and sent straight out if the flow cache
+            already has the way back to the source
         '''
+        src = struct.unpack('!I', original[12:16])[0]
+        if not self.icmpLimiter.allow(src, errorType): #Over the ICMP rate limit
+            return
+        if self.metrics is not None:
+            self.metrics.count("icmp_errors.type%d" % errorType)
+            self.sendPath = "icmp"
+        self.sendIcmp(src, self.icmpErrors.build(errorType, codeType, self.nameMap[dev][1], original), dev)
 
-        arp_req = arp()
+    def sendIcmp(self, src, ip_reply, dev):
+        '''
+        Sends ip_reply (an ICMP packet's bytes we built) back to src, the raw
+        address of the packet it answers, which came in on dev
+        '''
+        flow = self.flowCache.probe(src)
+        if flow is not None: #Reverse path already resolved
+            self.sendFrame(flow[0], RawFrame(flow[3] + '\x08\x00' + ip_reply))
+            return
+        if self.forwardingTable.lookup(src) is None: #No way back either, drop it
+            if self.metrics is not None:
+                self.metrics.count("route_misses")
+            return
 
-        arp_req.opcode = arp.REQUEST
-        arp_req.protosrc = src_ip
-        arp_req.protodst = dst_ip
-        arp_req.hwsrc = src_eth
-        arp_req.hwdst = ETHER_BROADCAST
+        ether = ethernet() #Resolve the way back like any other packet
+        ether.type = ether.IP_TYPE
+        ether.set_payload(pktlib.ipv4(raw=ip_reply))
+        self.forward_packet(ether, dev)
 
-        ether = ethernet() #wrap in ether
-        ether.type = ether.ARP_TYPE
-        ether.set_payload(arp_req)
-        ether.src = src_eth
-        ether.dst = ETHER_BROADCAST
-        
-        return ether
-        
-    def makeEcho(self, request):
-        icmppkt = pktlib.icmp()
-        icmppkt.type = pktlib.TYPE_ECHO_REPLY
-
-        reply = pktlib.echo()
-        reply.id = request.id
-        reply.seq = request.seq
-        reply.payload = request.payload
-
-        icmppkt.payload = reply
-        return icmppkt
-
-    def makeICMP(self, errorType, codeType, ippkt):
-        icmppkt = pktlib.icmp()
-        icmppkt.type = errorType
-        icmppkt.code = codeType
-        icmppkt.payload = pktlib.unreach()
-        
-        icmppkt.payload.payload = ippkt.dump()[:28]
-        return icmppkt
-
-    def makeIP(self, icmppkt, ipsrc, ipdest):
-        ippkt = pktlib.ipv4()
-        ippkt.srcip = ipdest
-        ippkt.dstip = ipsrc
-        ippkt.ttl = 64 # a reasonable initial TTL value
-        ippkt.protocol = ippkt.ICMP_PROTOCOL
-        ippkt.payload = icmppkt
-        return ippkt
-        
     def buildMappings(self):
         '''
         Creates a Forwarding Table for the router, as well as establishing mappings from
         names to eth and ip, storing a list of ip's associated with my interfaces, and
         initializing the table of mappings from ip to eth addresses
         
-        Addresses in forwarding table are stored in binary for easy bitwise operations
+        Addresses in forwarding table are stored in binary for easy bitwise operations,
+        keyed by prefix and prefix length
         '''
         
+        snapshot = self.snapshot = self.loadSnapshot()
+        mapped = snapshot is not None and self.config["lookup"] == "dir248"
+        if mapped: #The file's arrays are a DIR-24-8 table, look up straight out of them
+            self.forwardingTable = snapshot.routes()
+
         #Obtain routes from net.interfaces
         for intf in self.net.interfaces():
             prefix = intf.ipaddr.toUnsigned() & intf.netmask.toUnsigned() # network prefix
@@ -123,48 +163,209 @@ class Router(object):
             nexthop = None # next hop
             name = intf.name # interface name
 
-            self.forwardingTable[prefix] = tuple([mask, nexthop, name])
+            self.forwardingTable.insert(prefix, netmask_to_cidr(mask), tuple([mask, nexthop, name]))
             
             self.nameMap[name] = (intf.ethaddr, intf.ipaddr)
+            self.intfMasks[name] = mask
             self.my_interfaces.add(intf.ipaddr)
-            self.ip_to_ether[intf.ipaddr] = intf.ethaddr
+            self.my_addrs.add(intf.ipaddr.toUnsigned())
+            self.neighbors.addPermanent(intf.ipaddr, intf.ethaddr)
+            self.arpTemplates.addInterface(intf.ethaddr, intf.ipaddr)
+            self.icmpErrors.addSource(intf.ipaddr)
+
+        if mapped: #Already compiled, interface routes sit on top
+            return
+        if snapshot is not None: #Trie lookup: build it from the packed routes instead of the text
+            for prefix, length, route in snapshot.items():
+                self.forwardingTable.insert(prefix, length, route)
+            return
 
         #Obtain routes from forwarding_table.txt
-        forTable = open("forwarding_table.txt", "r")
-        for line in forTable:
-            parsedLine = line.split(" ")
-            prefix = IPAddr(parsedLine[0]).toUnsigned() # network prefix
-            mask = IPAddr(parsedLine[1]) # network mask
-            nexthop = IPAddr(parsedLine[2]) # next hop
-            name = parsedLine[3][0:-1] # interface name
-                       
-            self.forwardingTable[prefix] = tuple([mask, nexthop, name])
+        for prefix, length, route in read_forwarding_table("forwarding_table.txt"):
+            self.forwardingTable.insert(prefix, length, route)
+
+        if self.config["lookup"] == "dir248":
+            self.compileForwardingTable()
+
+    def loadSnapshot(self):
+        '''
+        The table_snapshot file if there is one and it was compiled from the
+        forwarding table and firewall rules as they are now, else None
+        '''
+        path = self.config["table_snapshot"]
+        if path == "none" or not os.path.exists(path):
+            return None
+        try:
+            snapshot = TableSnapshot(path)
+        except ValueError as e:
+            log_warn("Ignoring %s: %s" % (path, e))
+            return None
+        if not snapshot.fresh("forwarding_table.txt", "firewall_rules.txt"):
+            log_warn("%s is out of date, loading the text files (recompile with snapshot.py)" % path)
+            snapshot.close()
+            return None
+        log_info("tables from %s: %d routes (%s lookup), %d rules" % (path, snapshot.route_count,
+                 "mapped dir248" if self.config["lookup"] == "dir248" else self.config["lookup"], snapshot.rule_count))
+        return snapshot
+
+    def compileForwardingTable(self):
+        '''
+        Swaps the trie for DIR-24-8 array tables if we can afford the memory,
+        otherwise stays on the trie
+        '''
+        routes = list(self.forwardingTable.items())
+        needed = Dir248Table.estimateFootprint(routes)
+
+        budget = self.config["dir248_max_memory"]
+        free = available_memory()
+        if (budget and needed > budget) or (free is not None and needed > free / 2):
+            log_warn("Not enough memory for dir248 lookup (%d bytes needed), using trie" % needed)
+            return
+
+        self.forwardingTable = Dir248Table.fromRoutes(routes)
+        log_info("dir248 forwarding table: %d routes, %d bytes" %
+                 (len(self.forwardingTable), self.forwardingTable.memoryFootprint()))
        
+    def addRoute(self, prefix, mask, nexthop, name):
+        '''
+        Installs (or replaces) a route at runtime, no rebuild needed
+        -prefix and mask are IPAddr's, nexthop is an IPAddr or None for directly connected
+        '''
+        key = prefix.toUnsigned() & mask.toUnsigned()
+        self.forwardingTable.insert(key, netmask_to_cidr(mask), tuple([mask, nexthop, name]))
+        self.flowCache.invalidatePrefix(key, netmask_to_cidr(mask))
+
+    def removeRoute(self, prefix, mask):
+        '''
+        Withdraws a route, returns False if there was no such route
+        '''
+        key = prefix.toUnsigned() & mask.toUnsigned()
+        self.flowCache.invalidatePrefix(key, netmask_to_cidr(mask))
+        return self.forwardingTable.delete(key, netmask_to_cidr(mask))
+
+    def learnArp(self, ip, eth, dev):
+        '''
+        Records ip->eth (heard on dev), dropping any cached flows that went through the old mapping
+        '''
+        if self.neighbors.confirm(ip, eth, dev):
+            self.flowCache.invalidateNexthop(ip)
+        self.startAging()
+
+        if ip in self.arp_ip: #Someone's been waiting on this one, send right away
+            self.releaseWaiter(ip)
+
+    def refreshInterfaces(self):
+        '''
+        Picks up address changes on our interfaces: connected routes, nameMap
+        and cached flows out of any interface that changed are all redone
+        '''
+        for intf in self.net.interfaces():
+            old = self.nameMap.get(intf.name)
+            if old == (intf.ethaddr, intf.ipaddr) and self.intfMasks.get(intf.name) == intf.netmask:
+                continue
+
+            if old is not None:
+                self.my_interfaces.discard(old[1])
+                self.my_addrs.discard(old[1].toUnsigned())
+                self.neighbors.removePermanent(old[1])
+                self.arpTemplates.removeInterface(old[1])
+            for key, length, route in list(self.forwardingTable.items()):
+                if route[1] is None and route[2] == intf.name: #Old connected route
+                    self.forwardingTable.delete(key, length)
+                    self.flowCache.invalidatePrefix(key, length)
+
+            self.addRoute(intf.ipaddr, intf.netmask, None, intf.name)
+            self.nameMap[intf.name] = (intf.ethaddr, intf.ipaddr)
+            self.intfMasks[intf.name] = intf.netmask
+            self.my_interfaces.add(intf.ipaddr)
+            self.my_addrs.add(intf.ipaddr.toUnsigned())
+            self.neighbors.addPermanent(intf.ipaddr, intf.ethaddr)
+            self.arpTemplates.addInterface(intf.ethaddr, intf.ipaddr)
+            self.icmpErrors.addSource(intf.ipaddr)
+            self.flowCache.invalidateInterface(intf.name)
+
+    def startInterfaceChecks(self):
+        if self.interfaceTimer is None and self.config["interface_check_interval"] > 0:
+            self.interfaceTimer = self.scheduler.schedule(self.clock() + self.config["interface_check_interval"],
+                                                          self.checkInterfaces)
+
+    def checkInterfaces(self):
+        '''
+        Periodic refreshInterfaces, so address changes reach the routes and caches.
+        Stops while the neighbor cache is empty, so an idle router isn't woken for
+        it; resumeInterfaceChecks picks it up again when a packet comes in.
+        '''
+        self.interfaceTimer = None
+        self.refreshInterfaces()
+        if len(self.neighbors):
+            self.startInterfaceChecks()
+        else:
+            self.interfacesIdle = True
+
+    def resumeInterfaceChecks(self):
+        '''
+        First packet since the interface checks stopped: catch up on any
+        address change before handling it, and check periodically again
+        '''
+        self.interfacesIdle = False
+        self.refreshInterfaces()
+        self.startInterfaceChecks()
+
+    def neighborRemoved(self, ip):
+        '''
+        Neighbor cache dropped ip (evicted, expired or stopped answering probes)
+        '''
+        self.flowCache.invalidateNexthop(ip)
+
+    def startAging(self):
+        if self.agingTimer is None:
+            self.agingTimer = self.scheduler.schedule(self.clock() + self.config["arp_age_interval"],
+                                                      self.ageNeighbors)
+
+    def ageNeighbors(self):
+        '''
+        Periodic neighbor cache sweep, next hops with cached flows hit within
+        arp_reachable_time count as hot.  Stops once the cache is empty,
+        learnArp starts it again.
+        '''
+        self.agingTimer = None
+        since = self.clock() - self.config["arp_reachable_time"]
+        self.neighbors.age(self.sendProbe, lambda ip: self.flowCache.usedSince(ip, since))
+        if len(self.neighbors):
+            self.startAging()
+
+    def sendProbe(self, ip, eth, name):
+        '''
+        Unicast ARP request to re-confirm a neighbor we already have a MAC for
+        '''
+        src_eth, src_ip = self.nameMap[name]
+        if self.metrics is not None:
+            self.metrics.count("arp_requests_sent")
+        self.sendFrame(name, self.makeRequest(ip, src_ip, src_eth, eth))
+
     def matchPrefix(self, dstip):
-        best_prefix = None
-        best_match = -1
-        for prefix in self.forwardingTable:
-            netmask = self.forwardingTable[prefix][0] # 0 is the netmask
-            if prefix == (dstip.toUnsigned() & netmask.toUnsigned()):
-                if best_match ==-1 or best_match < netmask_to_cidr(netmask):
-                    best_prefix = prefix
-                    best_match = netmask_to_cidr(netmask)
-                    
-        if best_prefix == None: #No matches at all
-            return None
-            
-        return self.forwardingTable[best_prefix] #Index 1 is the nexthop
+        '''
+        Longest prefix match, returns (mask, nexthop, name) or None if no matches at all
+        '''
+        return self.forwardingTable.lookup(dstip.toUnsigned())
         
     def forward_packet(self, pkt, dev):
         payload = pkt.payload
         
+        flow = self.flowCache.get(payload.dstip.toUnsigned())
+        if flow is not None: #Already resolved this destination, reuse the frame we got
+            name, src_eth, dst_eth, macs = flow
+            pkt.src = src_eth
+            pkt.dst = dst_eth
+            self.sendFrame(name, pkt)
+            return
+
         match = self.matchPrefix(payload.dstip)
         if match == None: #No entry on table matched
-            icmp_error = self.makeICMP(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_NET, payload) # make ICMP error
-            ip_reply = self.makeIP(icmp_error, payload.srcip, self.nameMap[dev][1]) # wrap it in IP
-            pkt.payload = ip_reply # send it off
-            payload = pkt.payload
-            match = self.matchPrefix(payload.dstip)
+            if self.metrics is not None:
+                self.metrics.count("route_misses")
+            self.sendIcmpError(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_NET, ip_bytes(payload), dev)
+            return
         
         next_hop = match[1] #Ease of use
         name = match[2]
@@ -181,113 +382,507 @@ class Router(object):
         ether.type = ether.IP_TYPE
         ether.set_payload(payload)
         ether.src = src_eth
-        if nxt_ip in self.ip_to_ether: #We have the mapping nxt_ip->eth
-            ether.dst = self.ip_to_ether[nxt_ip]
-            self.net.send_packet(name, ether) #Send packet on its way
+        dst_eth = self.neighbors.lookup(nxt_ip)
+        if dst_eth is not None: #We have the mapping nxt_ip->eth
+            ether.dst = dst_eth
+            self.flowCache.put(payload.dstip.toUnsigned(), nxt_ip,
+                               (name, src_eth, dst_eth, dst_eth.toRaw() + src_eth.toRaw()))
+            self.sendFrame(name, ether) #Send packet on its way
         else:                    
+            if self.metrics is not None: #Keeps its receive time while it waits
+                ether.received = self.received
+                ether.path = "arp"
             if nxt_ip in self.arp_ip: #Already waiting on ARP for this
-                self.arp_ip[nxt_ip].addPacket(ether)
+                self.pending.admit(self.arp_ip[nxt_ip], ether)
             else: #New IP to ARP at
                 request = self.makeRequest(nxt_ip, src_ip, src_eth) #create ARP req
-                waiter = arpWaiter(name, request, ether, dev)
-                self.arp_ip[nxt_ip] = waiter
-                self.net.send_packet(name, request) #Send ARP request
+                waiter = arpWaiter(name, request, dev, self.clock())
+                self.arp_ip[nxt_ip] = waiter #Before admit, a drop's ICMP error may be headed the same way
+                waiter.timer = self.scheduler.schedule(waiter.start_time + 1, self.retryArp, nxt_ip)
+                self.pending.admit(waiter, ether)
+                if self.metrics is not None:
+                    self.metrics.count("arp_requests_sent")
+                self.sendFrame(name, request) #Send ARP request
 
 
     def examineStalled(self):
-        keys = self.arp_ip.keys() #Can/will lose keys during iteration
-        for dst in keys:
-            stalled = self.arp_ip.pop(dst)
-            
-            if dst in self.ip_to_ether: #We've since figured this one out
-                dst_eth = self.ip_to_ether[dst]
+        '''
+        Fires the ARP retries/timeouts that are due.  Waiters whose reply shows
+        up are released right away by learnArp, so nothing else needs a look.
+        '''
+        self.scheduler.runDue()
+
+    def releaseWaiter(self, dst):
+        '''
+        We've since figured this one out, send all the waiting packets
+        '''
+        stalled = self.arp_ip.pop(dst)
+        self.scheduler.cancel(stalled.timer)
+        waiting = self.pending.release(stalled)
+        self.pending.forget(stalled)
+        if self.metrics is not None:
+            now = self.clock()
+            for queued in stalled.queued_at:
+                self.metrics.observe("arp_wait", now - queued)
+        dst_eth = self.neighbors.peek(dst)
+        
+        for ether_pkt in waiting: #Send out all the waiting packets
+            ether_pkt.dst = dst_eth
+            self.sendFrame(stalled.intf_name, ether_pkt)
+
+    def pendingDropped(self, waiter, dropped):
+        '''
+        The pending caps dropped one of the packets waiting on ARP: tell its
+        source the host is unreachable, as the ARP timeout would have (the ICMP
+        limiter keeps a flood from turning into one error per packet).  Errors
+        we built ourselves and got dropped while waiting get nothing.
+        '''
+        if dropped.payload.srcip in self.my_interfaces:
+            return
+        received = self.received
+        if self.metrics is not None:
+            self.received = getattr(dropped, "received", None)
+        self.sendIcmpError(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_HOST,
+                           ip_bytes(dropped.payload), waiter.dev)
+        self.received = received
+
+    def retryArp(self, dst):
+        '''
+        Timer for dst went off: ARP again (once a second), or after 5 tries give
+        up and send ICMP host unreachable to everyone whose packets we're dropping
+        '''
+        stalled = self.arp_ip.get(dst)
+        if stalled is None: #Resolved in the meantime
+            return
+
+        if stalled.tries >= 5: #Timeout, send ICMP timeout
+            del self.arp_ip[dst]
+            self.pending.forget(stalled)
+            if self.metrics is not None:
+                self.metrics.count("arp_timeouts")
+
+            sources = Set()
+            for dropped in stalled.getList():
+                if dropped.payload.srcip in sources: #One error per source is all we need
+                    continue
+                sources.add(dropped.payload.srcip)
+                if self.metrics is not None:
+                    self.received = getattr(dropped, "received", None)
+                self.sendIcmpError(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_HOST,
+                                   ip_bytes(dropped.payload), stalled.dev)
+            self.received = None
+        else:
+            if self.metrics is not None:
+                self.metrics.count("arp_requests_sent")
+            self.sendFrame(stalled.intf_name, stalled.arp_req) #Send ARP again
+            stalled.tries += 1
+            stalled.timer = self.scheduler.schedule(stalled.start_time + stalled.tries, self.retryArp, dst)
                 
-                for ether_pkt in stalled.getList(): #Send out all the waiting packets
-                    ether_pkt.dst = dst_eth
-                    self.net.send_packet(stalled.intf_name, ether_pkt)
+    def sendFrame(self, name, pkt):
+        '''
+        Every frame the router sends goes through here.  While a batch is being
+        processed frames are held per egress interface and sent together.
+        With egress_qos the class queues decide what goes out when.
+        '''
+        if self.egress is not None:
+            self.egress.enqueue(name, pkt, self.clock())
+            if self.outbox is None:
+                self.serviceEgress()
+        elif self.outbox is None:
+            self.net.send_packet(name, pkt)
+        else:
+            self.outbox.setdefault(name, []).append(pkt)
+
+    def flushOutbox(self):
+        outbox = self.outbox
+        self.outbox = None
+        for name in outbox:
+            for pkt in outbox[name]:
+                self.net.send_packet(name, pkt)
+        if self.egress is not None:
+            self.serviceEgress()
+
+    def serviceEgress(self):
+        '''
+        Sends what the egress queues let out now, and sets a timer for when
+        a paced interface with a backlog can send again
+        '''
+        wake = self.egress.service(self.clock(), self.net.send_packet)
+        if wake is None:
+            return
+        if self.egressTimer is not None:
+            if self.egressTimer.when <= wake:
+                return
+            self.scheduler.cancel(self.egressTimer)
+        self.egressTimer = self.scheduler.schedule(wake, self.egressDue)
+
+    def egressDue(self):
+        self.egressTimer = None
+        self.serviceEgress()
+
+    def handleArp(self, dev, pkt):
+        payload = pkt.payload
+        src_ip = payload.protosrc
+        dst_ip = payload.protodst
+        src_eth = payload.hwsrc
+        #no dst
+        
+        self.learnArp(src_ip, src_eth, dev) #Add to map from IP's to eth
+        
+        if payload.opcode == arp.REQUEST:                    
+            hwdst = self.neighbors.peek(dst_ip)
+            if hwdst is not None:
+                reply = self.makeReply(dst_ip, src_ip, hwdst, src_eth)
+                if self.metrics is not None:
+                    self.metrics.count("arp_requests_answered")
+                self.sendFrame(dev, reply) #send it off
+            #Do nothing otherwise
+        #ARP_REPLY: mapping learned above, waiting packets sent by learnArp(.)
+
+    def fastForward(self, view):
+        '''
+        Zero-copy path for plain transit packets to destinations in the flow cache:
+        patch the received bytes and send them.  Returns False if the packet needs
+        the regular path (TTL running out, not cached yet).
+        Addresses of ours are never flow cache keys, so local delivery can't land here.
+        '''
+        if view.ttl <= 1 or not self.config["fast_path"]:
+            return False
+        flow = self.flowCache.probe(view.dstip)
+        if flow is None:
+            return False
+
+        self.sendFrame(flow[0], forward_raw(view.raw, flow[3]))
+        return True
+
+    def expireView(self, dev, view):
+        '''
+        TTL-expiry check straight off the received bytes, so traceroutes and
+        looping packets get their time exceeded without pox parsing anything.
+        Returns True if view was expired (and answered).
+        '''
+        if view.ttl > 1 or view.dstip in self.my_addrs:
+            return False
+        self.sendIcmpError(pktlib.TYPE_TIME_EXCEED, 0, view.raw[14:14 + view.ihl + 8], dev)
+        return True
+
+    def prepareIP(self, dev, pkt):
+        '''
+        Local delivery and TTL stage for a packet the firewall let through.
+        Answers pings to us and sends ICMP errors, returning False if pkt goes
+        no further.
+        '''
+        payload = pkt.payload
+        if payload.dstip in self.my_interfaces: #Sent to us
+            inner = payload.payload
+            if inner.find("icmp") and inner.type == pktlib.TYPE_ECHO_REQUEST:
+                src = payload.srcip.toUnsigned()
+                if self.icmpLimiter.allow(src, pktlib.TYPE_ECHO_REPLY):
+                    self.sendIcmp(src, self.icmpErrors.echoReply(self.nameMap[dev][1], ip_bytes(payload)), dev)
             else:
-                difference = time.time() - stalled.start_time
-            
-                sentICMP = False
-                if difference/stalled.tries > 1:
-                    if stalled.tries >=5: #Timeout, send ICMP timeout
-                        ether = stalled.packet_list[0] # one of the ethernet packets that are queued up is all we need to get IP info
-                        icmp_error = self.makeICMP(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_HOST, ether.payload)
-                        ip_reply = self.makeIP(icmp_error, ether.payload.srcip, self.nameMap[stalled.dev][1])
-                        ether = ethernet() #wrap ip in ether because forward_packet uses ethernet packets
-                        ether.type = ether.IP_TYPE
-                        ether.set_payload(ip_reply)
-                        self.forward_packet(ether, stalled.intf_name) 
-                        sentICMP = True
-                    else:
-                        self.net.send_packet(stalled.intf_name, stalled.arp_req) #Send ARP again
-                        stalled.tries += 1
-                    
-                if not sentICMP:
-                    self.arp_ip[dst] = stalled #Add stalled back to the dict
+                self.sendIcmpError(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_PORT, ip_bytes(payload), dev)
+            return False
                 
+        if payload.ttl <= 1:
+            self.sendIcmpError(pktlib.TYPE_TIME_EXCEED, 0, ip_bytes(payload), dev)
+            return False
+        payload.ttl -= 1
+        return True
+
+    def handlePacket(self, dev, frame, ts=None):
+        '''
+        frame is whatever recv_packet gave us, a pox ethernet or the raw bytes.
+        Only the header fields are read until a packet needs the object path.
+        ts (when it was received) is only used by handlePacketTimed.
+        '''
+        view = FrameView(frame)
+        if view.ethertype == ARP_TYPE: #Is an ARP
+            self.handleArp(dev, view.packet())
+        elif view.ethertype == IP_TYPE and view.ip():
+            if self.firewall.allowView(view): #Change for Firewall 
+                if not self.fastForward(view) and not self.expireView(dev, view):
+                    pkt = view.packet()
+                    if self.prepareIP(dev, pkt):
+                        self.forward_packet(pkt, dev)
+            #Drop elsewise
+
+    def receiveBatch(self, timeout):
+        '''
+        Blocks up to timeout for one packet, then takes up to batch_size - 1 more,
+        waiting at most batch_wait seconds past the first for them
+        '''
+        batch = [self.net.recv_packet(timeout=timeout)]
+        deadline = self.clock() + self.config["batch_wait"]
+        while len(batch) < self.config["batch_size"]:
+            try:
+                batch.append(self.net.recv_packet(timeout=max(0.0, deadline - self.clock())))
+            except SrpyNoPackets:
+                break
+        return batch
+
+    def processBatch(self, batch):
+        '''
+        Runs each stage over the whole batch: ARP, then firewall, then local
+        delivery/TTL, then routing.  Sends are grouped by egress interface.
+        '''
+        self.outbox = {}
+
+        ip_batch = []
+        for dev, ts, frame in batch:
+            view = FrameView(frame)
+            if view.ethertype == ARP_TYPE:
+                self.handleArp(dev, view.packet())
+            elif view.ethertype == IP_TYPE and view.ip():
+                ip_batch.append((dev, view))
+
+        allowed = [(dev, view) for dev, view in ip_batch if self.firewall.allowView(view)]
+        slow = [(dev, view.packet()) for dev, view in allowed
+                if not self.fastForward(view) and not self.expireView(dev, view)]
+        slow = [(dev, pkt) for dev, pkt in slow if self.prepareIP(dev, pkt)]
+        for dev, pkt in slow:
+            self.forward_packet(pkt, dev)
+
+        self.flushOutbox()
+
+    def routeTagged(self, dev, view, limited):
+        '''
+        Everything after the firewall for one packet, with sendPath set to the
+        residence path its sends count under (metrics on only).  Returns the
+        time pox took to parse it into objects, which is parse, not route.
+        '''
+        self.sendPath = "ratelimited" if limited else "fast"
+        if self.fastForward(view):
+            return 0.0
+        if not limited:
+            self.sendPath = "forward"
+        if self.expireView(dev, view):
+            return 0.0
+        if view.dstip in self.my_addrs: #Echo reply or port unreachable
+            self.sendPath = "icmp"
+        before = time.time()
+        pkt = view.packet()
+        unpacked = time.time() - before
+        if self.prepareIP(dev, pkt):
+            self.forward_packet(pkt, dev)
+        return unpacked
+
+    def handlePacketTimed(self, dev, frame, ts=None):
+        '''
+        handlePacket with each stage timed and counted, used in its place when metrics is on.
+        Sends are timed by MeteredNet, the route stage is what's left once they're taken out.
+        '''
+        metrics = self.metrics
+        stages = metrics.stages
+        start = time.time()
+        view = FrameView(frame)
+        checked = routed = None #Firewall and route stage times, if the packet got that far
+        if view.ethertype == ARP_TYPE:
+            pkt = view.packet()
+            parse = time.time() - start
+            self.handleArp(dev, pkt)
+        elif view.ethertype == IP_TYPE and view.ip():
+            parsed = time.time()
+            allowed, limited = self.firewall.checkView(view)
+            routing = time.time()
+            checked = routing - parsed
+            parse = parsed - start
+            if allowed:
+                metrics.nested = 0.0
+                self.received = ts if ts is not None else start
+                unpacked = self.routeTagged(dev, view, limited)
+                self.received = None
+                routed = time.time() - routing - unpacked - metrics.nested
+                parse += unpacked
+        else:
+            parse = time.time() - start
+
+        with metrics.lock: #Recorded in one go, handling the packet may count things too
+            metrics.rx_packets[dev] += 1
+            metrics.rx_bytes[dev] += len(view.raw)
+            stages["parse"].record(parse)
+            if checked is not None:
+                stages["firewall"].record(checked)
+                metrics.counters["firewall_permits" if routed is not None else "firewall_denies"] += 1
+            if routed is not None:
+                stages["route"].record(routed)
+
+    def processBatchTimed(self, batch):
+        '''
+        processBatch with each stage timed over the whole batch; every packet
+        that went through a stage is recorded at the stage's time per packet.
+        Local delivery/TTL and routing run as one stage, packet by packet.
+        '''
+        metrics = self.metrics
+        stages = metrics.stages
+        self.outbox = {}
+
+        start = time.time()
+        ip_batch = []
+        sizes = []
+        for dev, ts, frame in batch:
+            view = FrameView(frame)
+            sizes.append((dev, len(view.raw)))
+            if view.ethertype == ARP_TYPE:
+                self.handleArp(dev, view.packet())
+            elif view.ethertype == IP_TYPE and view.ip():
+                ip_batch.append((dev, ts, view))
+        parsed = time.time()
+
+        allowed = []
+        for dev, ts, view in ip_batch:
+            ok, limited = self.firewall.checkView(view)
+            if ok:
+                allowed.append((dev, ts, view, limited))
+        routing = time.time()
+
+        unpacked = 0.0
+        for dev, ts, view, limited in allowed:
+            self.received = ts
+            unpacked += self.routeTagged(dev, view, limited)
+        self.received = None
+        routed = time.time() - routing - unpacked
+
+        with metrics.lock:
+            for dev, size in sizes:
+                metrics.rx_packets[dev] += 1
+                metrics.rx_bytes[dev] += size
+            if ip_batch:
+                stages["firewall"].record((routing - parsed) / len(ip_batch), len(ip_batch))
+            metrics.counters["firewall_permits"] += len(allowed)
+            metrics.counters["firewall_denies"] += len(ip_batch) - len(allowed)
+            stages["parse"].record((parsed - start + unpacked) / len(batch), len(batch))
+            if allowed:
+                stages["route"].record(routed / len(allowed), len(allowed))
+
+        self.flushOutbox()
+
+    def sendFrameTagged(self, name, pkt):
+        '''
+        sendFrame that first tags IPv4 frames sent on behalf of a received
+        packet with its receive time and path, for MeteredNet (metrics on only).
+        Frames tagged before (parked for ARP) keep what they have.
+        '''
+        if self.received is not None and getattr(pkt, "received", None) is None and ethertype(pkt) == IP_TYPE:
+            pkt.received = self.received
+            pkt.path = self.sendPath
+        Router.sendFrame(self, name, pkt)
+
+    def instrument(self):
+        '''
+        Turns metrics on: timed packet handlers in place of the plain ones, sends
+        tagged for residence times, the net wrapped so sends are counted, and
+        the report on SIGUSR1 and the socket
+        '''
+        self.metrics = Metrics()
+        self.handlePacket = self.handlePacketTimed
+        self.processBatch = self.processBatchTimed
+        self.sendFrame = self.sendFrameTagged
+        self.net = MeteredNet(self.net, self.metrics)
+        if not dump_on_signal(self.metrics, log_info):
+            log_warn("metrics: not on the main thread, no report on SIGUSR1")
+
+        path = self.config["metrics_socket"]
+        if path != "none":
+            if self.config["rss_workers"] > 1: #One socket per worker process
+                path = "%s.%d" % (path, os.getpid())
+            self.metricsServer = MetricsServer(self.metrics, path)
+
+    def handlePacketTraced(self, dev, frame, ts=None):
+        trace = self.tracer.begin(dev, frame)
+        self.handleUntraced(dev, frame, ts)
+        if trace is not None:
+            self.tracer.end(trace)
+
+    def startTracing(self):
+        '''
+        Wraps the steps a packet can go through so every trace_every-th one
+        gets logged with its timings (profiling.py)
+        '''
+        tracer = self.tracer = PacketTracer(self.config["trace_every"], log_info)
+        if self.config["batch_size"] > 1:
+            log_warn("tracing: batched packets aren't traced, only packet-at-a-time handling is")
+        self.handleUntraced = self.handlePacket
+        self.handlePacket = self.handlePacketTraced
+
+        verdict = lambda allowed: "allowed" if allowed else "denied"
+        self.firewall.allowView = tracer.wrap("Firewall.allow", self.firewall.allowView, verdict)
+        self.firewall.checkView = tracer.wrap("Firewall.allow", self.firewall.checkView,
+                                              lambda result: verdict(result[0]))
+        self.fastForward = tracer.wrap("fastForward", self.fastForward, lambda sent: "sent" if sent else "missed")
+        self.expireView = tracer.wrap("expireView", self.expireView, lambda expired: "expired" if expired else "")
+        self.prepareIP = tracer.wrap("prepareIP", self.prepareIP)
+        self.forward_packet = tracer.wrap("forward_packet", self.forward_packet)
+        self.sendIcmpError = tracer.wrap("sendIcmpError", self.sendIcmpError)
+        self.sendFrame = tracer.wrap("sendFrame", self.sendFrame)
+        self.pending.admit = tracer.wrapAdmit(self.pending.admit)
+        self.retryArp = tracer.wrapWaiter("examineStalled/retryArp", self.retryArp, self.arp_ip)
+        self.releaseWaiter = tracer.wrapWaiter("releaseWaiter", self.releaseWaiter, self.arp_ip)
+
+    def startLoop(self):
+        '''
+        Setup shared by router_main and the event loop
+        '''
+        if self.firewall is None:
+            rules = self.snapshot.rules(self.clock) if self.snapshot is not None else None
+            self.firewall = Firewall(self.clock, rules) #New line
+        if self.config["metrics"] and self.metrics is None:
+            self.instrument()
+        if self.config["trace_every"] and self.tracer is None:
+            self.startTracing()
+        if self.profiler is None:
+            self.profiler = Profiler(self.scheduler, self.config["profile_mode"], self.config["profile_seconds"],
+                                     self.config["profile_interval"], self.config["profile_output"], log_info)
+            if not self.profiler.installSignal():
+                log_warn("profiling: not on the main thread, no SIGUSR2 toggle")
+        self.startAging()
+        self.startInterfaceChecks()
+
+    def stopLoop(self):
+        '''
+        Teardown shared by router_main and the event loop: final stats, and
+        the metrics socket goes so the next run can bind it
+        '''
+        self.logStats()
+        if self.metricsServer is not None:
+            self.metricsServer.close()
+            self.metricsServer = None
+
+    def logStats(self):
+        log_info("flow cache: %s" % self.flowCache.stats())
+        log_info("neighbor cache: %s" % self.neighbors.stats())
+        log_info("pending queues: %s" % self.pending.stats())
+        log_info("icmp: %s" % self.icmpLimiter.stats())
+        if self.egress is not None:
+            log_info("egress queues: %s" % self.egress.stats())
+        if self.metrics is not None:
+            log_info("metrics:\n%s" % self.metrics.report())
+
     def router_main(self):
-        self.arp_ip = {} #Empty dict for IP's we're waiting for ARPs on
-        #Dict because it's faster than queue and we don't care about order
-        
-        self.firewall = Firewall() #New line
+        self.startLoop()
+        batching = self.config["batch_size"] > 1
         
         while True:
             try:
                 self.examineStalled() #deal with stalled that are waiting on ARPs
                 
-                dev,ts,pkt = self.net.recv_packet(timeout=0.5) #Chnged/new lines for Firewall
-                self.firewall.update_token_buckets()
-                
-                payload = pkt.payload
-                if pkt.type == pkt.ARP_TYPE: #Is an ARP
-                    src_ip = payload.protosrc
-                    dst_ip = payload.protodst
-                    src_eth = payload.hwsrc
-                    #no dst
-                    
-                    self.ip_to_ether[src_ip] = src_eth #Add to map from IP's to eth
-                    
-                    if payload.opcode == arp.REQUEST:                    
-                        if dst_ip in self.ip_to_ether:
-                            hwdst = self.ip_to_ether[dst_ip]
-                            reply = self.makeReply(dst_ip, src_ip, hwdst, src_eth)
-                            self.net.send_packet(dev, reply) #send it off
-                        #Do nothing otherwise
-                    else: #ARP_REPLY
-                        self.ip_to_ether[src_ip] = src_eth
-                        #Sending dealt with in examineStalled(.) 
-                
-                elif pkt.type == pkt.IP_TYPE:
-                	if self.firewall.allow(payload): #Change for Firewall 
-		                if payload.dstip in self.my_interfaces: #Sent to us
-		                    inner = payload.payload
-		                    if inner.find("icmp") and inner.type == pktlib.TYPE_ECHO_REQUEST:
-		                        icmp_reply = self.makeEcho(inner.payload) # make ICMP header
-		                        ip_reply = self.makeIP(icmp_reply, payload.srcip, self.nameMap[dev][1]) # make IP header
-		                        pkt.payload = ip_reply # put it in the packet to be sent forward
-		                        payload = pkt.payload
-		                    else:
-		                        icmp_error = self.makeICMP(pktlib.TYPE_DEST_UNREACH, pktlib.CODE_UNREACH_PORT, payload) # make ICMP error
-		                        ip_reply = self.makeIP(icmp_error, payload.srcip, self.nameMap[dev][1]) # make IP header
-		                        pkt.payload = ip_reply # put it in the packet to be sent forward
-		                        payload = pkt.payload
-		                        
-		                                
-			            payload.ttl -= 1
-			            if payload.ttl == 0:
-			                icmp_error = self.makeICMP(pktlib.TYPE_TIME_EXCEED, 0, payload) # make ICMP error
-			                ip_reply = self.makeIP(icmp_error, payload.srcip, self.nameMap[dev][1]) # wrap it in IP
-			                pkt.payload = ip_reply # send it off
-			                payload = pkt.payload
-			            
-			            self.forward_packet(pkt, dev)
-		            #Drop elsewise
+                timeout = self.scheduler.timeUntilNext(0.5) #Wake up in time for the next ARP timer
+                if batching:
+                    batch = self.receiveBatch(timeout)
+                    if self.interfacesIdle:
+                        self.resumeInterfaceChecks()
+                    self.processBatch(batch)
+                    continue
+
+                dev,ts,frame = self.net.recv_packet(timeout=timeout) #Chnged/new lines for Firewall
+                if self.interfacesIdle:
+                    self.resumeInterfaceChecks()
+                self.handlePacket(dev, frame, ts) #Firewall buckets top themselves up by the clock as they're used
 
             except SrpyNoPackets:
                 # log_debug("Timeout waiting for packets")
                 continue
             except SrpyShutdown:
+                self.stopLoop()
                 return
                 
 class arpWaiter(object):
@@ -296,29 +891,266 @@ class arpWaiter(object):
     
     Stores time it was made, number of ARPs sent, information necessary to send mor ARPs
     and a list of ethernet-coated packets to send off once we get an ARP reply
+    (PendingQueues decides what gets onto that list)
     '''
-    def __init__(self, intf_name, arp_request, ether_pkt, dev):
-        self.start_time = time.time()
+    def __init__(self, intf_name, arp_request, dev, start_time):
+        self.start_time = start_time
         self.tries = 1
         self.dev = dev
         
         self.intf_name = intf_name
         self.arp_req = arp_request
+        self.timer = None #Pending retry in the router's scheduler
         
-        self.packet_list = [ether_pkt]
+        self.packet_list = []
+        self.queued_at = [] #When each packet in packet_list got here
+        self.bytes = 0 #Size of everything in packet_list
+        self.aqm = None #Set by PendingQueues
         
-    def addPacket(self, ether_pkt):
+    def addPacket(self, ether_pkt, size, now):
         self.packet_list.append(ether_pkt)
+        self.queued_at.append(now)
+        self.bytes += size
     
     def getList(self):
         return self.packet_list
 
+def read_forwarding_table(path):
+    '''
+    (prefix, prefix length, (mask, nexthop, name)) for each line of a forwarding
+    table file (every line ends in a newline, which gets cut off the name)
+    '''
+    forTable = open(path, "r")
+    for line in forTable:
+        parsedLine = line.split(" ")
+        prefix = IPAddr(parsedLine[0]).toUnsigned() # network prefix
+        mask = IPAddr(parsedLine[1]) # network mask
+        nexthop = IPAddr(parsedLine[2]) # next hop
+        name = parsedLine[3][0:-1] # interface name
+        yield prefix, netmask_to_cidr(mask), tuple([mask, nexthop, name])
+    forTable.close()
+
+def ip_bytes(ippkt):
+    '''
+    An ipv4 object's bytes, as received if pox kept them
+    '''
+    return getattr(ippkt, 'raw', None) or ippkt.pack()
+
+def frame_len(ether_pkt):
+    '''
+    Bytes a parked frame takes up, using the raw bytes we received if pox kept them
+    '''
+    raw = getattr(ether_pkt.payload, 'raw', None)
+    if raw:
+        return 14 + len(raw)
+    return len(ether_pkt.pack())
+
+class PendingQueues(object):
+    '''
+    Memory accounting for packets parked in arpWaiters, with per-waiter and global
+    caps.  Over a cap, "tail" drops the arriving packet and "oldest" drops the
+    waiter's oldest packets to make room; either way on_drop(waiter, packet)
+    hears about each one once admit is done with the queue.  Each waiter also
+    gets an AQM from the aqm factory, which can drop (or ECN mark) packets as
+    they arrive or as they're released.
+    '''
+    def __init__(self, max_packets, max_bytes, total_packets, total_bytes, policy, aqm, clock=time.time,
+                 on_drop=None):
+        if policy not in ("tail", "oldest"):
+            raise ValueError("Unknown pending drop policy '%s'" % policy)
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self.total_packets = total_packets
+        self.total_bytes = total_bytes
+        self.policy = policy
+        self.aqm = aqm
+        self.clock = clock
+        self.on_drop = on_drop
+        
+        self.packets = 0 #Gauges for everything currently parked
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.tail_drops = 0
+        self.oldest_drops = 0
+        self.aqm_drops = 0 #Totals from waiters that are done
+        self.aqm_marks = 0
+        
+    def full(self, waiter, size):
+        return (len(waiter.packet_list) + 1 > self.max_packets or waiter.bytes + size > self.max_bytes or
+                self.packets + 1 > self.total_packets or self.bytes + size > self.total_bytes)
+        
+    def admit(self, waiter, ether_pkt):
+        '''
+        Parks ether_pkt on waiter if the caps allow it.  Returns False if it was dropped.
+        '''
+        if waiter.aqm is None:
+            waiter.aqm = self.aqm()
+        now = self.clock()
+        if waiter.aqm.admit(len(waiter.packet_list), now) and not waiter.aqm.markObject(ether_pkt):
+            return False
+        #ARP can take seconds, so CoDel also looks at the head while packets keep arriving
+        if waiter.packet_list and waiter.aqm.drop(now - waiter.queued_at[0], waiter.bytes, now):
+            if not waiter.aqm.markObject(waiter.packet_list[0]):
+                self.dropHead(waiter)
+
+        size = frame_len(ether_pkt)
+        dropped = []
+        admitted = True
+        while self.full(waiter, size):
+            if self.policy == "oldest" and waiter.packet_list:
+                dropped.append(self.dropHead(waiter))
+                self.oldest_drops += 1
+            else:
+                dropped.append(ether_pkt)
+                self.tail_drops += 1
+                admitted = False
+                break
+            
+        if admitted:
+            waiter.addPacket(ether_pkt, size, now)
+            self.packets += 1
+            self.bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+        if self.on_drop is not None: #Only now, the callback may well park packets itself
+            for packet in dropped:
+                self.on_drop(waiter, packet)
+        return admitted
+        
+    def dropHead(self, waiter):
+        oldest = waiter.packet_list.pop(0)
+        waiter.queued_at.pop(0)
+        oldest_size = frame_len(oldest)
+        waiter.bytes -= oldest_size
+        self.packets -= 1
+        self.bytes -= oldest_size
+        return oldest
+
+    def release(self, waiter):
+        '''
+        waiter's packets that its AQM lets through now that the ARP is answered
+        '''
+        now = self.clock()
+        backlog = waiter.bytes
+        released = []
+        for ether_pkt, queued in zip(waiter.packet_list, waiter.queued_at):
+            backlog -= frame_len(ether_pkt)
+            if waiter.aqm.drop(now - queued, backlog, now) and not waiter.aqm.markObject(ether_pkt):
+                continue
+            released.append(ether_pkt)
+        return released
+        
+    def forget(self, waiter):
+        '''
+        waiter is done (resolved or timed out), its packets no longer count
+        '''
+        self.packets -= len(waiter.packet_list)
+        self.bytes -= waiter.bytes
+        if waiter.aqm is not None:
+            self.aqm_drops += waiter.aqm.drops
+            self.aqm_marks += waiter.aqm.marks
+        
+    def stats(self):
+        return {"packets": self.packets, "bytes": self.bytes, "peak_bytes": self.peak_bytes,
+                "tail_drops": self.tail_drops, "oldest_drops": self.oldest_drops,
+                "aqm_drops": self.aqm_drops, "aqm_marks": self.aqm_marks}
+
+def tests():
+    '''
+    PendingQueues caps and drop policies, with stand-in frames of a given size
+    '''
+    from aqm import Aqm, Red
+
+    class Payload(object):
+        def __init__(self, size):
+            self.raw = 'x' * size
+
+    class Parked(object):
+        def __init__(self, size):
+            self.payload = Payload(size - 14)
+
+    def queues(max_packets=3, max_bytes=10000, total_packets=100, total_bytes=100000, policy="tail"):
+        return PendingQueues(max_packets, max_bytes, total_packets, total_bytes, policy, lambda: Aqm(False),
+                             lambda: 0.0, lambda waiter, packet: drops.append((waiter, packet, pending.packets)))
+
+    def waiter():
+        return arpWaiter(None, None, None, 0.0)
+
+    #tail: the packet that doesn't fit is the one dropped, and on_drop hears about it
+    drops = []
+    pending = queues()
+    w = waiter()
+    frames = [Parked(100) for i in range(4)]
+    assert [pending.admit(w, frame) for frame in frames] == [True, True, True, False]
+    assert w.packet_list == frames[:3] and pending.tail_drops == 1
+    assert pending.packets == 3 and pending.bytes == 300 and pending.peak_bytes == 300
+    assert drops == [(w, frames[3], 3)]
+
+    #oldest: the arriving packet always goes in, the head makes room; on_drop
+    #only runs once the arriving packet is parked
+    drops = []
+    pending = queues(policy="oldest")
+    w = waiter()
+    assert [pending.admit(w, frame) for frame in frames] == [True, True, True, True]
+    assert w.packet_list == frames[1:] and w.queued_at == [0.0] * 3 and w.bytes == 300
+    assert pending.oldest_drops == 1 and pending.packets == 3 and pending.bytes == 300
+    assert drops == [(w, frames[0], 3)]
+
+    #Byte cap per waiter
+    pending = queues(max_packets=10, max_bytes=250)
+    w = waiter()
+    assert [pending.admit(w, Parked(100)) for i in range(3)] == [True, True, False]
+    assert pending.bytes == 200 and pending.tail_drops == 1
+
+    #Global caps count every waiter's packets, a waiter that's done gives its share back
+    pending = queues(max_packets=10, total_packets=4)
+    first, second = waiter(), waiter()
+    assert [pending.admit(first, Parked(100)) for i in range(3)] == [True, True, True]
+    assert [pending.admit(second, Parked(100)) for i in range(2)] == [True, False]
+    pending.forget(first)
+    assert pending.packets == 1 and pending.bytes == 100
+    assert pending.admit(second, Parked(100))
+    stats = pending.stats()
+    assert stats["packets"] == 2 and stats["bytes"] == 200 and stats["peak_bytes"] == 400
+    assert stats["tail_drops"] == 1 and stats["oldest_drops"] == 0
+
+    pending = queues(max_packets=10, total_bytes=350, policy="oldest")
+    first, second = waiter(), waiter()
+    assert [pending.admit(first, Parked(100)) for i in range(3)] == [True, True, True]
+    assert not pending.admit(second, Parked(100)) #Nothing of its own to drop
+    assert pending.tail_drops == 1 and pending.oldest_drops == 0
+    assert drops[-1][0] is second and drops[-1][2] == 3
+
+    #AQM drops aren't the caps', they're not reported
+    drops = []
+    pending = PendingQueues(3, 10000, 100, 100000, "tail", lambda: Red(0, 0, 1.0, 1.0, False), lambda: 0.0,
+                            lambda w, packet: drops.append(packet))
+    assert not pending.admit(waiter(), Parked(100)) and drops == []
+
+    try:
+        queues(policy="random")
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown policy accepted"
+    print("pending queues: ok")
+
 def srpy_main(net):
     '''
     Main entry point for router.  Just create Router
     object and get it going.
     '''
-    r = Router(net)
-    r.router_main()
+    config = RouterConfig()
+    if config["rss_workers"] > 1: #Spread flows over several router processes
+        RssDispatcher(net, Router, config).run()
+    elif config["pipeline"]: #Receive and transmit on their own threads
+        Pipeline(net, Router, config).run()
+    elif config["event_loop"]: #Sleep until a packet or a timer is due
+        run_event_loop(Router(net, config))
+    else:
+        r = Router(net, config)
+        r.router_main()
     net.shutdown()
     
+
+if __name__ == '__main__':
+    tests()
@@ -0,0 +1,271 @@
+'''
+ARP neighbor cache for the router.
+
+Replaces the old grow-forever ip_to_ether dict.  Learned entries age through
+REACHABLE -> STALE, are re-confirmed in the background with unicast probes
+(PROBE) while they keep forwarding on the MAC we already have, and are dropped
+when probing fails, when they sit unused for too long, or when the cache is
+full and they are the least recently used.  The router's own interface
+addresses are permanent and don't count against the size limit.
+'''
+
+from collections import OrderedDict
+import time
+
+REACHABLE = "reachable"
+STALE = "stale"
+PROBE = "probe"
+
+class Neighbor(object):
+    __slots__ = ('eth', 'intf', 'state', 'confirmed', 'used', 'forwarded', 'probes', 'next_probe')
+
+    def __init__(self, eth, intf, now):
+        self.eth = eth
+        self.intf = intf #Interface we heard it on, probes go back out there
+        self.state = REACHABLE
+        self.confirmed = now
+        self.used = now #Learning counts as a use, so an unused entry still gets stale_time
+        self.forwarded = False #Only entries we've actually forwarded to get probed
+        self.probes = 0
+        self.next_probe = 0
+
+class NeighborCache(object):
+    def __init__(self, capacity, reachable_time, stale_time, probe_interval, max_probes,
+                 on_remove=None, clock=time.time):
+        self.capacity = capacity
+        self.reachable_time = reachable_time #Seconds a confirmation is trusted
+        self.stale_time = stale_time #Seconds an unused stale entry is kept around
+        self.probe_interval = probe_interval
+        self.max_probes = max_probes
+        self.on_remove = on_remove #Called with the ip of every learned entry dropped
+        self.clock = clock
+
+        self.entries = OrderedDict() #ip -> Neighbor, least recently used first
+        self.permanent = {} #ip -> eth for our own interfaces
+        self.shared = None #Table other router processes learn into, see share()
+
+        self.evictions = 0
+        self.expirations = 0
+        self.probes_sent = 0
+        self.probe_failures = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return ip in self.permanent or ip in self.entries
+
+    def addPermanent(self, ip, eth):
+        self.permanent[ip] = eth
+
+    def removePermanent(self, ip):
+        self.permanent.pop(ip, None)
+
+    def share(self, table):
+        '''
+        Publish everything we learn to table (put(ip, eth, intf, when) /
+        get(ip) -> (eth, intf, when) or None) and fall back to it on misses,
+        so several router processes don't each have to ARP for the same hosts
+        '''
+        self.shared = table
+
+    def _fromShared(self, ip):
+        '''
+        Takes ip over from the shared table if another process confirmed it recently enough
+        '''
+        if self.shared is None:
+            return None
+        found = self.shared.get(ip)
+        if found is None or self.clock() - found[2] > self.reachable_time:
+            return None
+        self._confirm(ip, found[0], found[1], found[2])
+        return self.entries[ip]
+
+    def refreshShared(self, ip):
+        '''
+        Another process changed ip in the shared table: takes its MAC over if
+        we have ip with a different one.  Returns True if ours changed.
+        '''
+        entry = self.entries.get(ip)
+        found = self.shared.get(ip) if self.shared is not None else None
+        if entry is None or found is None or entry.eth == found[0]:
+            return False
+        self._confirm(ip, found[0], found[1], found[2])
+        return True
+
+    def peek(self, ip):
+        '''
+        MAC for ip without counting it as a use, None if unknown
+        '''
+        eth = self.permanent.get(ip)
+        if eth is None:
+            entry = self.entries.get(ip) or self._fromShared(ip)
+            if entry is not None:
+                eth = entry.eth
+        return eth
+
+    def lookup(self, ip):
+        '''
+        MAC for ip on the forwarding path, None if unknown.  Stale entries are
+        still returned; age() refreshes them in the background.
+        '''
+        eth = self.permanent.get(ip)
+        if eth is not None:
+            return eth
+
+        entry = self.entries.pop(ip, None) or self._fromShared(ip)
+        if entry is None:
+            return None
+        self.entries[ip] = entry #Back to most recently used
+        entry.used = self.clock()
+        entry.forwarded = True
+        return entry.eth
+
+    def confirm(self, ip, eth, intf):
+        '''
+        We heard from ip (any ARP it sent).  Returns True if its MAC is new or changed.
+        '''
+        if ip in self.permanent:
+            return False
+
+        now = self.clock()
+        if self.shared is not None:
+            self.shared.put(ip, eth, intf, now)
+        return self._confirm(ip, eth, intf, now)
+
+    def _confirm(self, ip, eth, intf, now):
+        entry = self.entries.pop(ip, None)
+        if entry is None:
+            if len(self.entries) >= self.capacity:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+            entry = Neighbor(eth, intf, now)
+            changed = True
+        else:
+            changed = entry.eth != eth
+            entry.eth = eth
+            entry.intf = intf
+            entry.state = REACHABLE
+            entry.confirmed = now
+            entry.probes = 0
+
+        self.entries[ip] = entry
+        return changed
+
+    def _drop(self, ip):
+        del self.entries[ip]
+        if self.on_remove is not None:
+            self.on_remove(ip)
+
+    def age(self, send_probe, is_hot):
+        '''
+        Periodic sweep.  send_probe(ip, eth, intf) re-ARPs a neighbor;
+        is_hot(ip) says whether traffic is still going to it.
+        Hot entries get probed before they go stale so they never stall.
+        '''
+        now = self.clock()
+        for ip, entry in list(self.entries.items()):
+            if entry.state == PROBE:
+                if now < entry.next_probe:
+                    continue
+                if entry.probes >= self.max_probes: #Nobody answered, it's gone
+                    self._drop(ip)
+                    self.probe_failures += 1
+                    continue
+            else:
+                age = now - entry.confirmed
+                if age > self.reachable_time:
+                    entry.state = STALE
+
+                hot = (entry.forwarded and now - entry.used < self.reachable_time) or is_hot(ip)
+                if entry.state == STALE and not hot and now - entry.used > self.stale_time:
+                    self._drop(ip)
+                    self.expirations += 1
+                    continue
+                if not hot or age < self.reachable_time - self.probe_interval * self.max_probes:
+                    continue
+                entry.state = PROBE #Start refreshing while the old MAC keeps working
+                entry.probes = 0
+
+            entry.probes += 1
+            entry.next_probe = now + self.probe_interval
+            self.probes_sent += 1
+            send_probe(ip, entry.eth, entry.intf)
+
+    def stats(self):
+        states = {REACHABLE: 0, STALE: 0, PROBE: 0}
+        for entry in self.entries.values():
+            states[entry.state] += 1
+        return {"size": len(self.entries), "capacity": self.capacity, "states": states,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "probes": self.probes_sent, "probe_failures": self.probe_failures}
+
+def tests():
+    now = [0.0]
+    removed = []
+    cache = NeighborCache(2, 30.0, 120.0, 1.0, 3, removed.append, lambda: now[0])
+    probes = []
+
+    def age_to(when, hot=()):
+        while now[0] < when:
+            now[0] += 1.0
+            cache.age(lambda ip, eth, intf: probes.append((now[0], ip)), lambda ip: ip in hot)
+
+    #Learned and never used: goes STALE after reachable_time, kept for stale_time, never probed
+    assert cache.confirm("idle", "e1", "eth0")
+    age_to(31.0)
+    assert cache.entries["idle"].state == STALE
+    assert cache.peek("idle") == "e1" #Stale entries still forward
+    age_to(120.0)
+    assert "idle" in cache and not probes
+    age_to(121.0)
+    assert "idle" not in cache and removed == ["idle"] and cache.expirations == 1
+
+    #Forwarded to: probed just before reachable_time runs out, dropped when nobody answers
+    now[0] = 0.0
+    cache.confirm("busy", "e2", "eth1")
+    now[0] = 10.0
+    assert cache.lookup("busy") == "e2"
+    age_to(26.0)
+    assert cache.entries["busy"].state == REACHABLE and not probes
+    age_to(29.0)
+    assert cache.entries["busy"].state == PROBE and [ip for when, ip in probes] == ["busy"] * 3
+    age_to(30.0)
+    assert "busy" not in cache and cache.probe_failures == 1
+
+    #An answer to a probe makes it REACHABLE again
+    now[0] = 0.0
+    del probes[:]
+    cache.confirm("busy", "e2", "eth1")
+    cache.lookup("busy")
+    age_to(27.0)
+    assert cache.entries["busy"].state == PROBE
+    assert not cache.confirm("busy", "e2", "eth1") #Same MAC, not a change
+    assert cache.entries["busy"].state == REACHABLE and cache.entries["busy"].probes == 0
+
+    #Full cache evicts the least recently used; permanent entries don't count
+    cache.addPermanent("me", "e0")
+    cache.confirm("other", "e3", "eth0")
+    cache.confirm("third", "e4", "eth0")
+    assert "busy" not in cache and "me" in cache and cache.evictions == 1
+    assert cache.lookup("me") == "e0" and not cache.confirm("me", "e9", "eth0")
+
+    #Shared with another process: it changing a MAC we have is picked up, other entries aren't pulled in
+    shared = {}
+    class Table(object):
+        def put(self, ip, eth, intf, when):
+            shared[ip] = (eth, intf, when)
+        def get(self, ip):
+            return shared.get(ip)
+    cache.share(Table())
+    now[0] = 50.0
+    cache.confirm("other", "e3", "eth0")
+    assert not cache.refreshShared("other") and not cache.refreshShared("me")
+    shared["other"] = ("e5", "eth1", 51.0)
+    shared["elsewhere"] = ("e6", "eth1", 51.0)
+    assert cache.refreshShared("other") and not cache.refreshShared("elsewhere")
+    assert cache.peek("other") == "e5" and cache.entries["other"].intf == "eth1" and "elsewhere" not in cache.entries
+    print("neighbor: ok")
+
+if __name__ == '__main__':
+    tests()
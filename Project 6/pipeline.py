@@ -0,0 +1,264 @@
+'''
+Threaded RX -> forward -> TX pipeline around a Router.
+
+A receive thread pulls frames off the net into a bounded queue, the Router
+runs its usual router_main on that queue (so all router state stays on one
+thread), and everything it sends goes into a bounded queue per egress
+interface drained by that interface's own transmit thread.  A slow or
+blocking interface then only backs up its own queue.
+
+When a queue is full the policy decides: "drop" throws the new packet away
+(and counts it), "block" makes the stage feeding the queue wait, which
+pushes back on ingress.  Every queue also has its own AQM (aqm in
+router_config.txt), which sees packets as they join and leave it.  Depths,
+drops, time spent waiting in each queue and time spent in each stage are
+kept in StageStats.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+from srpy_common import log_info, SrpyShutdown, SrpyNoPackets
+from aqm import aqm_factory, MTU
+from rawframe import RawFrame
+import threading
+import time
+import Queue
+
+_SHUTDOWN = object() #Put on a queue to stop whoever reads it
+
+class StageStats(object):
+    '''
+    Counters for one queue and the stage that drains it, and the queue's AQM
+    '''
+    def __init__(self, queue, aqm):
+        self.queue = queue
+        self.aqm = aqm
+        self.packets = 0
+        self.drops = 0
+        self.peak_depth = 0
+        self.wait = 0.0 #Seconds packets sat in the queue, summed
+        self.max_wait = 0.0
+        self.busy = 0.0 #Seconds the stage spent working on them, summed
+        self.max_busy = 0.0
+
+    def queued(self):
+        self.peak_depth = max(self.peak_depth, self.queue.qsize())
+
+    def dequeued(self, waited):
+        self.packets += 1
+        self.wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def worked(self, busy):
+        self.busy += busy
+        self.max_busy = max(self.max_busy, busy)
+
+    def stats(self):
+        count = max(self.packets, 1)
+        return {"depth": self.queue.qsize(), "peak_depth": self.peak_depth, "packets": self.packets,
+                "drops": self.drops, "aqm_drops": self.aqm.drops, "aqm_marks": self.aqm.marks,
+                "avg_wait_us": self.wait / count * 1e6, "max_wait_us": self.max_wait * 1e6,
+                "avg_busy_us": self.busy / count * 1e6, "max_busy_us": self.max_busy * 1e6}
+
+class PipelineNet(object):
+    '''
+    The net the Router sees: recv_packet reads the RX queue, send_packet
+    fills the TX queue of the egress interface
+    '''
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.started = None #When the packet being forwarded was handed out
+
+    def interfaces(self):
+        return self.pipeline.net.interfaces()
+
+    def recv_packet(self, timeout=None):
+        pipeline = self.pipeline
+        if self.started is not None: #Everything since the last hand-out was forwarding work
+            pipeline.forward.worked(time.time() - self.started)
+            self.started = None
+        while True:
+            try:
+                item = pipeline.rx.get(timeout=timeout)
+            except Queue.Empty:
+                raise SrpyNoPackets()
+            if item is _SHUTDOWN:
+                raise SrpyShutdown()
+
+            queued_at, (dev, ts, frame) = item
+            now = time.time()
+            pipeline.forward.dequeued(now - queued_at)
+            frame = pipeline.forward.aqm.leave(frame, now - queued_at, pipeline.rx.qsize() * MTU, now)
+            if frame is not None:
+                self.started = now
+                return dev, ts, frame
+
+    def send_packet(self, name, pkt):
+        pipeline = self.pipeline
+        stats = pipeline.transmit[name]
+        queued = stats.aqm.arrive(pkt, pipeline.tx[name].qsize(), time.time())
+        if queued is None:
+            return
+        if queued is not pkt: #ECN marked, the AQM handed back bytes
+            queued = RawFrame(queued)
+        pipeline.put(pipeline.tx[name], stats, (time.time(), queued))
+
+    def shutdown(self):
+        pass
+
+class Pipeline(object):
+    def __init__(self, net, router_class, config):
+        if config["pipeline_full_policy"] not in ("drop", "block"):
+            raise ValueError("Unknown pipeline full policy '%s'" % config["pipeline_full_policy"])
+        self.net = net
+        self.block = config["pipeline_full_policy"] == "block"
+        self.report = config["pipeline_report"]
+        aqm = aqm_factory(config)
+
+        self.rx = Queue.Queue(config["pipeline_rx_depth"])
+        self.forward = StageStats(self.rx, aqm())
+        self.tx = {} #intf name -> its transmit queue
+        self.transmit = {} #intf name -> StageStats for that queue/thread
+        for intf in net.interfaces():
+            self.tx[intf.name] = Queue.Queue(config["pipeline_tx_depth"])
+            self.transmit[intf.name] = StageStats(self.tx[intf.name], aqm())
+
+        self.router = router_class(PipelineNet(self), config)
+
+    def put(self, queue, stats, item):
+        '''
+        Queues item according to the full policy, False if it was dropped
+        '''
+        if self.block:
+            queue.put(item)
+        else:
+            try:
+                queue.put_nowait(item)
+            except Queue.Full:
+                stats.drops += 1
+                return False
+        stats.queued()
+        return True
+
+    def receiver(self):
+        while True:
+            try:
+                packet = self.net.recv_packet(timeout=0.5)
+            except SrpyNoPackets:
+                continue
+            except SrpyShutdown:
+                self.rx.put(_SHUTDOWN)
+                return
+            dev, ts, frame = packet
+            frame = self.forward.aqm.arrive(frame, self.rx.qsize(), time.time())
+            if frame is not None:
+                self.put(self.rx, self.forward, (time.time(), (dev, ts, frame)))
+
+    def transmitter(self, name):
+        queue = self.tx[name]
+        stats = self.transmit[name]
+        while True:
+            item = queue.get()
+            if item is _SHUTDOWN:
+                return
+            queued_at, pkt = item
+            start = time.time()
+            stats.dequeued(start - queued_at)
+            sent = stats.aqm.leave(pkt, start - queued_at, queue.qsize() * MTU, start)
+            if sent is not None:
+                self.net.send_packet(name, sent if sent is pkt else RawFrame(sent))
+            stats.worked(time.time() - start)
+
+    def stats(self):
+        transmit = dict((name, stats.stats()) for name, stats in self.transmit.items())
+        return {"forward": self.forward.stats(), "transmit": transmit}
+
+    def reportStats(self):
+        log_info("pipeline: %s" % self.stats())
+        self.router.scheduler.schedule(self.router.clock() + self.report, self.reportStats)
+
+    def run(self):
+        threads = [threading.Thread(target=self.transmitter, args=(name,)) for name in self.tx]
+        threads.append(threading.Thread(target=self.receiver))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        if self.report:
+            self.router.scheduler.schedule(self.router.clock() + self.report, self.reportStats)
+
+        self.router.router_main() #Forwarding stage, returns when the receiver sees shutdown
+
+        for queue in self.tx.values(): #Let the transmitters finish what's queued
+            queue.put(_SHUTDOWN)
+        for thread in threads:
+            thread.join()
+        log_info("pipeline: %s" % self.stats())
+
+def tests():
+    from myrouter4 import Router
+    from routerconfig import RouterConfig
+    from arptemplates import arp_frame
+    from icmpfast import fold, word_sum
+    from topology import INTERFACES, udp_frame
+    from pox.lib.addresses import EthAddr, IPAddr
+    import struct
+
+    nexthop_eth = EthAddr("02:00:00:00:00:01")
+    def numbered(seq):
+        frame = udp_frame(53, 100)
+        header = frame[14:18] + struct.pack('!H', seq) + frame[20:24] + '\x00\x00' + frame[26:34]
+        header = header[:10] + struct.pack('!H', fold(word_sum(header))) + header[10 + 2:]
+        return frame[:14] + header + frame[34:]
+
+    class ListNet(object):
+        def __init__(self, frames):
+            self.frames = list(reversed(frames))
+            self.sent = []
+            self.lock = threading.Lock()
+        def interfaces(self):
+            return INTERFACES
+        def recv_packet(self, timeout=None):
+            with self.lock:
+                if not self.frames:
+                    raise SrpyShutdown()
+                dev, frame = self.frames.pop()
+                return dev, None, frame
+        def send_packet(self, name, pkt):
+            with self.lock:
+                self.sent.append((name, pkt.pack()))
+
+    count = 500
+    arp_reply = arp_frame(2, INTERFACES[1].ethaddr.toRaw(), nexthop_eth.toRaw(), nexthop_eth.toRaw(),
+                          IPAddr("192.168.100.2").toRaw(), INTERFACES[1].ethaddr.toRaw(), INTERFACES[1].ipaddr.toRaw())
+    frames = [("router-eth1", arp_reply)] + [("router-eth0", numbered(seq)) for seq in range(count)]
+    for policy, rx_depth, tx_depth in (("block", 4, 2), ("drop", count + 1, count)):
+        config = RouterConfig()
+        config["lookup"] = "trie"
+        config["table_snapshot"] = "none"
+        config["aqm"] = "none"
+        config["pipeline_full_policy"] = policy
+        config["pipeline_rx_depth"] = rx_depth
+        config["pipeline_tx_depth"] = tx_depth
+        net = ListNet(frames)
+        pipeline = Pipeline(net, Router, config)
+        running = threading.Thread(target=pipeline.run)
+        running.start()
+        running.join(30)
+        assert not running.is_alive(), "pipeline didn't shut down"
+
+        #Every packet out the right way, in the order it came in, nothing left behind
+        assert [name for name, raw in net.sent] == ["router-eth1"] * count, policy
+        assert [struct.unpack('!H', raw[18:20])[0] for name, raw in net.sent] == range(count), policy
+        assert all(raw[:6] == nexthop_eth.toRaw() for name, raw in net.sent)
+        stats = pipeline.stats()
+        assert stats["forward"]["packets"] == count + 1 and stats["forward"]["drops"] == 0
+        assert stats["transmit"]["router-eth1"]["packets"] == count
+        assert all(queue.empty() for queue in pipeline.tx.values()) and pipeline.rx.empty()
+        assert not [thread for thread in threading.enumerate() if thread is not threading.current_thread()]
+    print "pipeline: ok"
+
+if __name__ == '__main__':
+    tests()
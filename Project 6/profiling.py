@@ -0,0 +1,234 @@
+'''
+Profiling and packet tracing for a running router.
+
+Profiler: kill -USR2 the router to profile it for profile_seconds, with
+either cProfile (writes a .pstats file, read it with pstats or snakeviz) or
+a sampling profiler (SIGPROF every profile_interval seconds of CPU, stacks
+of every thread written as a .folded file, one "frame;frame;frame count"
+line per stack, which flamegraph.pl and speedscope take as is).  A second
+USR2 stops a window early.  Starting and stopping happen on the router's
+own thread through its scheduler, since cProfile only sees the thread that
+turned it on.
+
+PacketTracer: with trace_every N, every Nth packet gets a line in the log
+with each step it went through (Firewall.allow, the fast path,
+forward_packet, ICMP errors, sends, and for packets parked on ARP the
+retries examineStalled fires and the release or timeout) and how long each
+took.  The router only wraps those methods when tracing is on, and only
+packets handled one at a time (batch_size 1) are picked.
+'''
+
+import os
+import sys
+import time
+import signal
+import cProfile
+import threading
+from collections import defaultdict
+
+from ingress import FrameView
+
+class Profiler(object):
+    def __init__(self, scheduler, mode, seconds, interval, output, log):
+        if mode not in ("cprofile", "sample"):
+            raise ValueError("Unknown profile mode '%s'" % mode)
+        self.scheduler = scheduler
+        self.mode = mode
+        self.seconds = seconds
+        self.interval = interval
+        self.output = output
+        self.log = log
+
+        self.profile = None #cProfile.Profile while a cprofile window is open
+        self.stacks = None #folded stack -> samples while a sample window is open
+        self.timer = None #End of the current window
+        self.windows = 0
+
+    def installSignal(self, signum=signal.SIGUSR2):
+        '''
+        signum toggles a window.  False if we're not on the main thread.
+        '''
+        try:
+            signal.signal(signum, self.onSignal)
+        except ValueError:
+            return False
+        return True
+
+    def onSignal(self, signum, frame):
+        #Only a timer is set here, the window opens on the router's thread
+        self.scheduler.schedule(self.scheduler.clock(), self.toggle)
+
+    def running(self):
+        return self.profile is not None or self.stacks is not None
+
+    def toggle(self):
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        self.windows += 1
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.stacks = defaultdict(int)
+            signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.timer = self.scheduler.schedule(self.scheduler.clock() + self.seconds, self.stop)
+        self.log("profiling: %s for %.1f s" % (self.mode, self.seconds))
+
+    def stop(self):
+        self.scheduler.cancel(self.timer)
+        self.timer = None
+        path = "%s.%d.%d" % (self.output, os.getpid(), self.windows)
+        if self.profile is not None:
+            self.profile.disable()
+            path += ".pstats"
+            self.profile.dump_stats(path)
+            self.profile = None
+        elif self.stacks is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_IGN)
+            stacks = self.stacks
+            self.stacks = None
+            path += ".folded"
+            f = open(path, "w")
+            for stack in sorted(stacks):
+                f.write("%s %d\n" % (stack, stacks[stack]))
+            f.close()
+        else:
+            return
+        self.log("profiling: wrote %s" % path)
+
+    def sample(self, signum, frame):
+        stacks = self.stacks
+        if stacks is None: #Window closed while this signal was on its way
+            return
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, top in sys._current_frames().items():
+            if ident == threading.current_thread().ident:
+                top = frame #Skip this handler
+            stack = []
+            while top is not None:
+                code = top.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                top = top.f_back
+            stack.append(names.get(ident, "thread"))
+            stacks[";".join(reversed(stack))] += 1
+
+class Trace(object):
+    '''
+    One traced packet: what it is and the steps it has been through so far
+    '''
+    def __init__(self, number, dev, frame, start):
+        view = FrameView(frame)
+        self.number = number
+        self.start = start
+        self.steps = [] #(name, offset from start, seconds it took, note)
+        self.waiter = None #arpWaiter it's parked on
+        if view.ip():
+            src_port, dst_port = view.ports()
+            self.what = "%s %s->%s proto %d" % (dev, ip_text(view.srcip), ip_text(view.dstip), view.protocol)
+            if src_port != -1:
+                self.what += " ports %d->%d" % (src_port, dst_port)
+        else:
+            self.what = "%s ethertype 0x%04x" % (dev, view.ethertype)
+
+    def step(self, name, started, seconds, note=""):
+        self.steps.append((name, started - self.start, seconds, note))
+
+    def text(self, now):
+        steps = ", ".join("%s +%.1fus %.1fus%s" % (name, offset * 1e6, seconds * 1e6, " " + note if note else "")
+                          for name, offset, seconds, note in sorted(self.steps, key=lambda step: step[1]))
+        return "trace #%d %s: %s; total %.1fus" % (self.number, self.what, steps or "nothing", (now - self.start) * 1e6)
+
+def ip_text(addr):
+    return "%d.%d.%d.%d" % (addr >> 24, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF)
+
+class PacketTracer(object):
+    def __init__(self, every, log, clock=time.time):
+        self.every = every
+        self.log = log
+        self.clock = clock
+        self.seen = 0
+        self.traced = 0
+        self.current = None #Trace of the packet being handled, if it's one we picked
+        self.waiting = [] #Traces parked on ARP
+
+    def begin(self, dev, frame):
+        '''
+        Trace for this packet if it's the Nth one, else None
+        '''
+        self.seen += 1
+        if self.seen % self.every:
+            return None
+        self.traced += 1
+        self.current = Trace(self.traced, dev, frame, self.clock())
+        return self.current
+
+    def end(self, trace):
+        '''
+        The router is done with the packet for now; logged unless it's waiting on ARP
+        '''
+        self.current = None
+        if trace.waiter is not None:
+            self.waiting.append(trace)
+        else:
+            self.log(trace.text(self.clock()))
+
+    def finish(self, trace):
+        self.waiting.remove(trace)
+        self.log(trace.text(self.clock()))
+
+    def parkedOn(self, waiter):
+        return [trace for trace in self.waiting if trace.waiter is waiter]
+
+    def wrapAdmit(self, admit):
+        '''
+        PendingQueues.admit, noting the waiter a traced packet is parked on
+        '''
+        def traced(waiter, ether_pkt):
+            parked = admit(waiter, ether_pkt)
+            trace = self.current
+            if parked and trace is not None:
+                trace.waiter = waiter
+                trace.step("parked for ARP", self.clock(), 0.0)
+            return parked
+        return traced
+
+    def wrapWaiter(self, name, method, arp_ip):
+        '''
+        method(dst) is retryArp or releaseWaiter: a step for each trace parked
+        on dst's waiter, and the trace is logged if the waiter's done after it
+        '''
+        def traced(dst):
+            waiter = arp_ip.get(dst)
+            traces = self.parkedOn(waiter) if waiter is not None else []
+            if not traces:
+                return method(dst)
+            start = self.clock()
+            result = method(dst)
+            done = arp_ip.get(dst) is not waiter
+            for trace in traces:
+                trace.step(name, start, self.clock() - start, "done" if done else "try %d" % waiter.tries)
+                if done:
+                    self.finish(trace)
+            return result
+        return traced
+
+    def wrap(self, name, method, note=None):
+        '''
+        method, timed as a step of the current trace when there is one.
+        note(result) adds to the step's line.
+        '''
+        def traced(*args):
+            trace = self.current
+            if trace is None:
+                return method(*args)
+            start = self.clock()
+            result = method(*args)
+            trace.step(name, start, self.clock() - start, note(result) if note else "")
+            return result
+        return traced
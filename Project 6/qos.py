@@ -0,0 +1,323 @@
+'''
+Per-interface egress queues with strict priority and deficit round robin.
+
+Frames the router sends are classified from their header bytes (rules in
+qos_config.txt) and queued per egress interface and class.  Sending picks
+from the lowest priority number that has anything queued; classes sharing a
+priority take turns by DRR, quantum bytes each per round.  An interface with
+a rate is paced to it, so with more offered than the link takes the backlog
+sits in these queues, in class order, instead of in one FIFO further down.
+Each class queue has its own AQM (aqm.py) to keep that backlog short.
+'''
+
+import struct
+from collections import deque
+
+from aqm import Aqm
+from rawframe import RawFrame
+
+_ETH_LEN = 14
+_PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17}
+
+class QosClass(object):
+    def __init__(self, name, priority, quantum, limit):
+        self.name = name
+        self.priority = priority
+        self.quantum = quantum
+        self.limit = limit
+
+class QosPolicy(object):
+    '''
+    Classes, match rules and interface rates, in qos_config.txt's format
+    '''
+    def __init__(self, lines):
+        self.classes = [] #QosClass, in file order
+        self.rules = [] #(kind, value, class index), first match wins
+        self.default = None
+        self.rates = {} #intf name -> bits/sec
+
+        index = {}
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#': #Skip comments and empty lines
+                continue
+            words = line.split()
+            if words[0] == "class":
+                index[words[1]] = len(self.classes)
+                self.classes.append(QosClass(words[1], int(words[2]), int(words[3]), int(words[4])))
+            elif words[0] == "match":
+                target = index[words[1]]
+                if words[2] == "arp":
+                    self.rules.append(("arp", None, target))
+                elif words[2] == "protocol":
+                    self.rules.append(("protocol", _PROTOCOLS.get(words[3]) or int(words[3]), target))
+                elif words[2] == "dscp":
+                    self.rules.append(("dscp", int(words[3]), target))
+                elif words[2] in ("tcp", "udp") and words[3] == "port":
+                    self.rules.append((words[2], int(words[4]), target))
+                else:
+                    raise ValueError("Unknown qos match '%s'" % line)
+            elif words[0] == "default":
+                self.default = index[words[1]]
+            elif words[0] == "rate":
+                self.rates[words[1]] = float(words[2])
+            else:
+                raise ValueError("Unknown qos setting '%s'" % line)
+
+        if self.default is None:
+            raise ValueError("qos policy needs a default class")
+
+    @classmethod
+    def load(cls, filename="qos_config.txt"):
+        f = open(filename, "r")
+        policy = cls(f)
+        f.close()
+        return policy
+
+    def classify(self, raw):
+        '''
+        Class index for a frame's bytes
+        '''
+        ethertype = struct.unpack_from('!H', raw, 12)[0]
+        tos = protocol = None
+        ports = ()
+        if ethertype == 0x0800 and len(raw) >= _ETH_LEN + 20:
+            tos, protocol = struct.unpack_from('!B7xB', raw, _ETH_LEN + 1)
+            ihl = (ord(raw[_ETH_LEN]) & 0xF) * 4
+            if protocol in (6, 17) and len(raw) >= _ETH_LEN + ihl + 4:
+                ports = struct.unpack_from('!HH', raw, _ETH_LEN + ihl)
+
+        for kind, value, target in self.rules:
+            if kind == "arp":
+                if ethertype == 0x0806:
+                    return target
+            elif kind == "protocol":
+                if protocol == value:
+                    return target
+            elif kind == "dscp":
+                if tos is not None and tos >> 2 == value:
+                    return target
+            elif protocol == _PROTOCOLS[kind] and value in ports:
+                return target
+        return self.default
+
+class ClassQueue(object):
+    '''
+    One class's packets on one interface: (frame, size, time queued)
+    '''
+    def __init__(self, qclass, aqm):
+        self.qclass = qclass
+        self.aqm = aqm
+        self.packets = deque()
+        self.bytes = 0
+        self.deficit = 0
+        self.fresh = True #Gets its quantum next time DRR comes round to it
+
+        self.sent = 0
+        self.drops = 0
+
+    def __len__(self):
+        return len(self.packets)
+
+    def push(self, pkt, raw, now):
+        if len(self.packets) >= self.qclass.limit:
+            self.drops += 1
+            return False
+        if self.aqm.admit(len(self.packets), now): #Early drop, or mark if it's ECN-capable
+            marked = self.aqm.mark(raw)
+            if marked is None:
+                return False
+            pkt = RawFrame(marked)
+        self.packets.append((pkt, len(raw), now))
+        self.bytes += len(raw)
+        return True
+
+    def pop(self, now):
+        '''
+        (frame, size) of the next packet the AQM lets through, None if it dropped the lot
+        '''
+        while self.packets:
+            pkt, size, queued = self.packets.popleft()
+            self.bytes -= size
+            if self.aqm.drop(now - queued, self.bytes, now):
+                marked = self.aqm.mark(pkt.pack())
+                if marked is None:
+                    continue
+                pkt = RawFrame(marked)
+            self.sent += 1
+            return pkt, size
+        return None
+
+class EgressQueue(object):
+    '''
+    All the class queues of one interface, plus its pacing
+    '''
+    def __init__(self, policy, rate, aqm):
+        self.queues = [ClassQueue(qclass, aqm()) for qclass in policy.classes]
+        self.levels = [] #[queues, DRR position] per priority, most urgent first
+        for priority in sorted(set(qclass.priority for qclass in policy.classes)):
+            self.levels.append([[queue for queue in self.queues if queue.qclass.priority == priority], 0])
+        self.rate = rate #bits/sec, 0 for unpaced
+        self.next_free = 0.0 #When the link is done with what we last sent
+
+    def backlog(self):
+        return any(self.queues)
+
+    def dequeue(self, now):
+        for level in self.levels:
+            packet = self._drr(level, now)
+            if packet is not None:
+                return packet
+        return None
+
+    def _drr(self, level, now):
+        queues = level[0]
+        while any(queues):
+            queue = queues[level[1]]
+            packet = None
+            if queue.packets:
+                if queue.fresh:
+                    queue.deficit += queue.qclass.quantum
+                    queue.fresh = False
+                size = queue.packets[0][1]
+                if size <= queue.deficit:
+                    queue.deficit -= size
+                    packet = queue.pop(now)
+                    if queue.packets and packet is not None:
+                        return packet
+                    queue.deficit = 0 #Idle queues don't bank credit
+            else:
+                queue.deficit = 0
+            queue.fresh = True
+            level[1] = (level[1] + 1) % len(queues)
+            if packet is not None:
+                return packet
+        return None
+
+class EgressScheduler(object):
+    def __init__(self, policy, names, aqm=None):
+        aqm = aqm or (lambda: Aqm(False)) #Makes each class queue's AQM
+        self.policy = policy
+        self.interfaces = dict((name, EgressQueue(policy, policy.rates.get(name, 0.0), aqm)) for name in names)
+
+    def enqueue(self, name, pkt, now):
+        '''
+        Queues pkt (anything with pack()) for name.  False if its class was full.
+        '''
+        raw = pkt.pack()
+        intf = self.interfaces[name]
+        return intf.queues[self.policy.classify(raw)].push(pkt, raw, now)
+
+    def service(self, now, send):
+        '''
+        send(name, pkt)s everything the queues and pacing let out by now.
+        Returns when a paced interface can send again, None if nothing's waiting.
+        '''
+        wake = None
+        for name, intf in self.interfaces.items():
+            while intf.backlog() and intf.next_free <= now:
+                packet = intf.dequeue(now)
+                if packet is None:
+                    break
+                pkt, size = packet
+                send(name, pkt)
+                if intf.rate:
+                    intf.next_free = max(intf.next_free, now) + size * 8.0 / intf.rate
+            if intf.backlog() and (wake is None or intf.next_free < wake):
+                wake = intf.next_free
+        return wake
+
+    def stats(self):
+        stats = {}
+        for name, intf in self.interfaces.items():
+            stats[name] = dict((queue.qclass.name, {"queued": len(queue), "sent": queue.sent, "drops": queue.drops,
+                                                    "aqm_drops": queue.aqm.drops, "aqm_marks": queue.aqm.marks})
+                               for queue in intf.queues)
+        return stats
+
+def tests():
+    '''
+    classify() with qos_config.txt, DRR shares and deficits, strict priority,
+    class limits and pacing
+    '''
+    from topology import udp_frame
+
+    def patched(frame, offset, data):
+        return frame[:offset] + data + frame[offset + len(data):]
+
+    def frame(dst_port=5001, size=1000):
+        return RawFrame(udp_frame(dst_port, size))
+
+    policy = QosPolicy.load()
+    names = dict((qclass.name, i) for i, qclass in enumerate(policy.classes))
+    udp = udp_frame(5001, 200)
+    with_options = udp[:14] + '\x46' + udp[15:34] + '\x01' * 4 + udp[34:36] + struct.pack('!H', 53) + udp[38:]
+    for raw, name in [('\x00' * 12 + '\x08\x06' + '\x00' * 28, "control"), #ARP
+                      (patched(udp, 23, '\x01'), "control"), #ICMP
+                      (patched(udp, 15, chr(46 << 2)), "latency"), #EF
+                      (patched(udp, 15, chr(46 << 2 | 1)), "latency"), #EF with ECN bits
+                      (patched(udp, 15, chr(10 << 2)), "bulk"),
+                      (udp_frame(53, 80), "latency"), #To port 53...
+                      (patched(udp, 34, struct.pack('!H', 53)), "latency"), #...or from it
+                      (patched(udp_frame(53, 80), 23, '\x06'), "latency"), #TCP port 53
+                      (patched(udp_frame(53, 80), 23, '\x2f'), "bulk"), #Port 53 of a protocol without ports
+                      (with_options, "latency"), #Ports after 4 bytes of IP options
+                      (udp, "bulk"),
+                      (udp[:14 + 22], "bulk"), #Cut off before the ports
+                      ('\x00' * 12 + '\x86\xdd' + '\x00' * 60, "bulk")]: #IPv6
+        assert policy.classify(raw) == names[name], name
+
+    #DRR: backlogged classes sharing a priority get their quanta's ratio of the bytes
+    policy = QosPolicy(["class big 1 3000 1000", "class small 1 1000 1000", "match small udp port 53", "default big"])
+    scheduler = EgressScheduler(policy, ["eth0"])
+    for i in range(400):
+        assert scheduler.enqueue("eth0", frame(5001), 0.0)
+        assert scheduler.enqueue("eth0", frame(53), 0.0)
+    intf = scheduler.interfaces["eth0"]
+    served = [policy.classify(intf.dequeue(0.0)[0].pack()) for i in range(400)]
+    assert served.count(0) == 300 and served.count(1) == 100
+    assert served[:8] == [0, 0, 0, 1, 0, 0, 0, 1]
+
+    #A queue that runs dry gives up its deficit instead of banking it
+    scheduler = EgressScheduler(policy, ["eth0"])
+    intf = scheduler.interfaces["eth0"]
+    big, small = intf.queues
+    scheduler.enqueue("eth0", frame(53, 100), 0.0)
+    for i in range(20):
+        scheduler.enqueue("eth0", frame(5001), 0.0)
+    served = [policy.classify(intf.dequeue(0.0)[0].pack()) for i in range(10)]
+    assert served.count(1) == 1 and small.deficit == 0
+    for i in range(3): #small comes back after sitting out several rounds: one quantum, not a backlog of them
+        scheduler.enqueue("eth0", frame(53), 0.0)
+    served = [policy.classify(intf.dequeue(0.0)[0].pack()) for i in range(8)]
+    assert served.count(1) == 2, served
+
+    #Strict priority: anything more urgent goes first, even in the middle of a DRR round
+    policy = QosPolicy.load()
+    scheduler = EgressScheduler(policy, ["eth0"])
+    intf = scheduler.interfaces["eth0"]
+    for i in range(5):
+        scheduler.enqueue("eth0", frame(5001), 0.0)
+    assert policy.classify(intf.dequeue(0.0)[0].pack()) == names["bulk"]
+    scheduler.enqueue("eth0", frame(53, 80), 0.0)
+    scheduler.enqueue("eth0", RawFrame(patched(udp, 23, '\x01')), 0.0)
+    assert [policy.classify(intf.dequeue(0.0)[0].pack()) for i in range(6)] == \
+        [names["control"], names["latency"]] + [names["bulk"]] * 4
+    assert intf.dequeue(0.0) is None and not intf.backlog()
+
+    #Class limit and pacing
+    policy = QosPolicy(["class all 0 1514 3", "default all", "rate eth0 8000"])
+    scheduler = EgressScheduler(policy, ["eth0"])
+    assert [scheduler.enqueue("eth0", frame(size=100), 0.0) for i in range(4)] == [True, True, True, False]
+    sent = []
+    assert scheduler.service(0.0, lambda name, pkt: sent.append(pkt)) == 0.1 #100 bytes at 1000 bytes/s
+    assert len(sent) == 1
+    assert scheduler.service(0.05, lambda name, pkt: sent.append(pkt)) == 0.1 and len(sent) == 1
+    assert scheduler.service(0.1, lambda name, pkt: sent.append(pkt)) == 0.2 and len(sent) == 2
+    assert scheduler.service(0.2, lambda name, pkt: sent.append(pkt)) is None and len(sent) == 3
+    assert scheduler.stats()["eth0"]["all"] == {"queued": 0, "sent": 3, "drops": 1, "aqm_drops": 0,
+                                                "aqm_marks": 0}
+    print("qos: ok")
+
+if __name__ == '__main__':
+    tests()
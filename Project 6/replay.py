@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+'''
+Offline replay of pcap files through a router, no Mininet needed
+
+Usage: python replay.py ROUTER.py IFACE=FILE.pcap [IFACE=FILE.pcap ...]
+                        [--timing fast|recorded] [--speed X] [--out DIR]
+                        [--answer-arp] [--linger SECONDS] [--interfaces FILE]
+                        [--tables DIR]
+
+ReplayNet stands in for srpy's net: interfaces(), recv_packet() and
+send_packet() as the router expects them, so myrouter2.py (Project 4),
+myrouter3.py (Project 5) and myrouter4.py run unmodified.  ROUTER.py is
+imported from its own directory, which becomes the working directory, so
+it finds its forwarding table, firewall rules and router_config.txt as it
+would under srpy.  --tables runs it in DIR instead, e.g. on gen_scale.py's
+output.
+
+Each IFACE=FILE.pcap feeds that capture in on that interface; the files are
+read a record at a time and merged by timestamp.  With --timing fast frames
+go in as fast as the router asks for them, with recorded they go in at the
+gaps in the capture (divided by --speed).  Whatever the router sends is
+written to DIR/IFACE.pcap with --out.
+
+A sent frame is matched to the frame that caused it by its IP addresses, ID,
+protocol and first 8 bytes past the IP header (the header quoted in an ICMP
+error for those, the echo ID and sequence for echo replies), and its latency
+is the time from recv_packet handing that frame over to send_packet.  Frames
+that never come back out (dropped, or still waiting after 10 s) aren't
+counted.  --answer-arp answers the router's ARP requests itself, for
+captures that don't have the replies in them.
+
+Peak RSS is the whole process, this harness included.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+sys.path.append(os.path.join(os.environ['HOME'],'srpy'))
+sys.path.append(os.path.join(os.getcwd(),'srpy'))
+import time
+import heapq
+import struct
+import resource
+import argparse
+from collections import deque
+
+from pox.lib.packet import ethernet
+from srpy_common import SrpyShutdown, SrpyNoPackets
+
+from metrics import Histogram, summary_line
+from topology import Interface, INTERFACES
+
+LINKTYPE_ETHERNET = 1
+HORIZON = 10.0 #Frames not seen coming out by then are taken as dropped
+ETH_LEN = 14
+
+def read_interfaces(path):
+    '''
+    "name mac ip netmask" per line, # for comments
+    '''
+    interfaces = []
+    f = open(path, 'r')
+    for line in f:
+        line = line.strip()
+        if len(line) == 0 or line[0] == '#':
+            continue
+        name, eth, ip, mask = line.split()
+        interfaces.append(Interface(name, eth, ip, mask))
+    f.close()
+    return interfaces
+
+class PcapReader(object):
+    '''
+    (timestamp, frame bytes) for each record of a classic pcap file, read
+    as it's iterated
+    '''
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        header = self.f.read(24)
+        if len(header) < 24:
+            raise ValueError("%s: too short for a pcap file" % path)
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            self.order = '<'
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            self.order = '>'
+        else:
+            raise ValueError("%s: not a pcap file (pcapng has to be converted first)" % path)
+        self.scale = 1e-9 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1e-6
+        linktype = struct.unpack(self.order + 'I', header[20:24])[0]
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError("%s: link type %d, only Ethernet captures can be replayed" % (path, linktype))
+        self.record = struct.Struct(self.order + 'IIII')
+
+    def __iter__(self):
+        f = self.f
+        record = self.record
+        while True:
+            header = f.read(16)
+            if len(header) < 16:
+                break
+            seconds, fraction, captured, length = record.unpack(header)
+            data = f.read(captured)
+            if len(data) < captured: #Capture cut off mid-record
+                break
+            yield seconds + fraction * self.scale, data
+        f.close()
+
+class PcapWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        self.record = struct.Struct('<IIII')
+
+    def write(self, ts, data):
+        seconds = int(ts)
+        self.f.write(self.record.pack(seconds, int((ts - seconds) * 1e6), len(data), len(data)))
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+def merged(inputs):
+    '''
+    (timestamp, name, frame bytes) from every (name, path) in inputs, in
+    timestamp order
+    '''
+    def tagged(order, name, path):
+        for ts, data in PcapReader(path):
+            yield ts, order, name, data
+    streams = [tagged(order, name, path) for order, (name, path) in enumerate(inputs)]
+    for ts, order, name, data in heapq.merge(*streams):
+        yield ts, name, data
+
+def flow_key(data, offset):
+    '''
+    What identifies the IP packet at offset in data whatever the router does
+    to it on the way through: addresses, ID, protocol and 8 bytes of payload
+    (TTL and checksum change).  None if it isn't a whole enough IP header.
+    '''
+    if len(data) < offset + 20 or ord(data[offset]) >> 4 != 4:
+        return None
+    payload = offset + (ord(data[offset]) & 0x0F) * 4
+    return data[offset + 12:offset + 20] + data[offset + 4:offset + 6] + data[offset + 9] + data[payload:payload + 8]
+
+def echo_key(data, offset, reply):
+    '''
+    Key an echo request and the router's reply to it share: the request's
+    addresses (the reply's swapped), ICMP ID and sequence.  None for
+    anything else.
+    '''
+    if len(data) < offset + 20 or ord(data[offset]) >> 4 != 4 or ord(data[offset + 9]) != 1:
+        return None
+    payload = offset + (ord(data[offset]) & 0x0F) * 4
+    if len(data) < payload + 8 or ord(data[payload]) != (0 if reply else 8):
+        return None
+    src, dst = data[offset + 12:offset + 16], data[offset + 16:offset + 20]
+    if reply:
+        src, dst = dst, src
+    return "echo" + src + dst + data[payload + 4:payload + 8]
+
+class ReplayNet(object):
+    def __init__(self, inputs, interfaces=INTERFACES, recorded=False, speed=1.0, out=None,
+                 answer_arp=False, linger=0.0):
+        self.frames = merged(inputs)
+        self.next = next(self.frames, None)
+        self.intfs = interfaces
+        self.recorded = recorded
+        self.speed = speed
+        self.answer_arp = answer_arp
+        self.linger = linger
+        self.writers = {}
+        if out is not None:
+            if not os.path.isdir(out):
+                os.makedirs(out)
+            for intf in interfaces:
+                self.writers[intf.name] = PcapWriter(os.path.join(out, intf.name + ".pcap"))
+
+        self.injected = deque() #ARP replies we made up, handed over before the next captured frame
+        self.pending = {} #key -> deque of hand-over times of frames not yet seen coming out
+        self.expiry = deque() #(hand-over time, key), oldest first
+        self.forwarded = Histogram()
+        self.icmp = Histogram()
+
+        self.first_capture = self.next[0] if self.next is not None else 0.0
+        self.started = None #When the router first asked for a frame
+        self.finished = None #When it asked after the last one
+        self.received = 0
+        self.sent = 0
+        self.matched = 0
+
+    def interfaces(self):
+        return self.intfs
+
+    def recv_packet(self, timeout=None):
+        now = time.time()
+        if self.started is None:
+            self.started = now
+        if self.injected:
+            return self.injected.popleft()
+        if self.next is None:
+            self.drain(now, timeout)
+
+        if self.recorded:
+            wait = self.started + (self.next[0] - self.first_capture) / self.speed - now
+            if wait > 0:
+                if timeout is not None and wait > timeout:
+                    time.sleep(timeout)
+                    raise SrpyNoPackets()
+                time.sleep(wait)
+
+        ts, name, data = self.next
+        self.next = next(self.frames, None)
+        frame = ethernet(raw=data)
+        now = time.time()
+        self.received += 1
+        self.expect(flow_key(data, ETH_LEN), now)
+        if data[12:14] == '\x08\x00':
+            self.expect(echo_key(data, ETH_LEN, False), now)
+        if self.next is None:
+            self.finished = now
+        return name, now, frame
+
+    def drain(self, now, timeout):
+        '''
+        Out of frames: idle for linger seconds so timers can fire, then shut down
+        '''
+        if self.finished is None:
+            self.finished = now
+        left = self.finished + self.linger - now
+        if left <= 0:
+            raise SrpyShutdown()
+        time.sleep(left if timeout is None else min(left, timeout))
+        raise SrpyNoPackets()
+
+    def expect(self, key, now):
+        if key is None:
+            return
+        self.pending.setdefault(key, deque()).append(now)
+        self.expiry.append((now, key))
+        while self.expiry[0][0] < now - HORIZON:
+            handed, old = self.expiry.popleft()
+            waiting = self.pending.get(old)
+            if waiting and waiting[0] == handed:
+                waiting.popleft()
+                if not waiting:
+                    del self.pending[old]
+
+    def match(self, key):
+        waiting = self.pending.get(key) if key is not None else None
+        if not waiting:
+            return None
+        handed = waiting.popleft()
+        if not waiting:
+            del self.pending[key]
+        return handed
+
+    def send_packet(self, name, pkt):
+        now = time.time()
+        data = pkt.pack()
+        self.sent += 1
+        writer = self.writers.get(name)
+        if writer is not None:
+            writer.write(now, data)
+
+        ethertype = data[12:14]
+        if ethertype == '\x08\x06':
+            if self.answer_arp and data[20:22] == '\x00\x01':
+                self.injected.append((name, now, ethernet(raw=arp_answer(data))))
+            return
+        if ethertype != '\x08\x00':
+            return
+        handed = self.match(flow_key(data, ETH_LEN))
+        histogram = self.forwarded
+        if handed is None and len(data) >= 34 and data[23] == '\x01':
+            histogram = self.icmp
+            quoted = ETH_LEN + (ord(data[ETH_LEN]) & 0x0F) * 4 + 8 #Header of the packet an error is about
+            handed = self.match(flow_key(data, quoted))
+            if handed is None:
+                handed = self.match(echo_key(data, ETH_LEN, True))
+        if handed is not None:
+            self.matched += 1
+            histogram.record(now - handed)
+
+    def shutdown(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def report(self):
+        elapsed = max((self.finished or time.time()) - (self.started or time.time()), 1e-9)
+        lines = ["replayed %d frames in %.3f s: %.0f pps" % (self.received, elapsed, self.received / elapsed),
+                 "sent %d frames, %d matched to the frame that caused them" % (self.sent, self.matched),
+                 summary_line("latency", "forwarded", self.forwarded.summary()),
+                 summary_line("latency", "icmp", self.icmp.summary()),
+                 "peak RSS %d KB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]
+        return "\n".join(lines)
+
+def arp_answer(request):
+    '''
+    Reply to an ARP request frame from a made-up host 02:00:<its IP>
+    '''
+    requester_eth = request[22:28]
+    requester_ip = request[28:32]
+    target_ip = request[38:42]
+    eth = '\x02\x00' + target_ip
+    return (requester_eth + eth + '\x08\x06' + struct.pack('!HHBBH', 1, 0x0800, 6, 4, 2) +
+            eth + target_ip + requester_eth + requester_ip)
+
+def load_router(path, tables=None):
+    '''
+    Imports the router at path from its own directory, as srpy would run it.
+    It runs in that directory too, unless tables names another one.
+    '''
+    path = os.path.abspath(path)
+    directory, filename = os.path.split(path)
+    os.chdir(tables or directory)
+    sys.path.insert(0, directory)
+    return __import__(os.path.splitext(filename)[0])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay pcap files through a router")
+    parser.add_argument('router', help="router module, e.g. myrouter4.py")
+    parser.add_argument('inputs', nargs='+', metavar='IFACE=FILE', help="capture to feed in on an interface")
+    parser.add_argument('--timing', choices=("fast", "recorded"), default="fast")
+    parser.add_argument('--speed', type=float, default=1.0, help="speed-up for recorded timing")
+    parser.add_argument('--out', help="directory to write IFACE.pcap captures of what's sent to")
+    parser.add_argument('--answer-arp', action='store_true', help="reply to the router's ARP requests")
+    parser.add_argument('--linger', type=float, default=0.0, help="seconds to keep running after the last frame")
+    parser.add_argument('--interfaces', help="file of 'name mac ip netmask' lines, default is start_mininet's")
+    parser.add_argument('--tables', help="directory to run the router in, for its tables and config")
+    args = parser.parse_args()
+
+    inputs = []
+    for spec in args.inputs:
+        if '=' not in spec:
+            parser.error("inputs are IFACE=FILE.pcap, got '%s'" % spec)
+        name, path = spec.split('=', 1)
+        inputs.append((name, os.path.abspath(path)))
+    interfaces = read_interfaces(args.interfaces) if args.interfaces else INTERFACES
+    out = os.path.abspath(args.out) if args.out else None
+    tables = os.path.abspath(args.tables) if args.tables else None
+
+    net = ReplayNet(inputs, interfaces, args.timing == "recorded", args.speed, out, args.answer_arp, args.linger)
+    router = load_router(args.router, tables)
+    router.srpy_main(net)
+    print(net.report())
@@ -0,0 +1,90 @@
+'''
+Startup settings for the router, read from router_config.txt
+(one "name value" pair per line, # comments, same layout as firewall_rules.txt).
+Anything not in the file keeps the default below.
+'''
+
+import os.path
+
+class RouterConfig(object):
+    defaults = {
+        "lookup": "trie", #trie or dir248
+        "dir248_max_memory": 0, #Bytes the compiled table may use, 0 for no limit besides free memory
+        "flow_cache_size": 4096, #Destinations kept in the flow cache, 0 turns it off
+        "arp_cache_size": 1024, #Learned neighbors kept, least recently used go first
+        "arp_reachable_time": 30.0, #Seconds a neighbor is trusted after we hear from it
+        "arp_stale_time": 120.0, #Seconds an unused stale neighbor is kept
+        "arp_probe_interval": 1.0, #Seconds between background re-ARPs
+        "arp_probes": 3, #Unanswered re-ARPs before a neighbor is dropped
+        "arp_age_interval": 1.0, #Seconds between neighbor cache sweeps
+        "interface_check_interval": 5.0, #Seconds between checks for address changes on our interfaces, 0 for never
+        "pending_packets": 64, #Packets held per unresolved next hop
+        "pending_bytes": 98304, #Bytes held per unresolved next hop
+        "pending_total_packets": 4096, #Packets held across all unresolved next hops
+        "pending_total_bytes": 4194304, #Bytes held across all unresolved next hops
+        "pending_drop_policy": "tail", #tail (drop arriving packet) or oldest (drop oldest queued)
+        "batch_size": 1, #Packets handled per wakeup, 1 is packet-at-a-time
+        "batch_wait": 0.0, #Seconds to wait for a batch to fill after its first packet
+        "fast_path": 1, #1 forwards cached transit packets as raw bytes, 0 always uses pox objects
+        "icmp_rate": 100.0, #ICMP errors/echo replies per second overall, 0 for no limit
+        "icmp_burst": 50, #Messages the overall limit lets through back to back
+        "icmp_source_rate": 10.0, #ICMP messages per second to any one source, 0 for no limit
+        "icmp_source_burst": 10, #Messages one source can get back to back
+        "icmp_sources": 1024, #Sources tracked for the per-source limit
+        "rss_workers": 1, #Router processes flows are spread over, 1 runs everything in one process
+        "rss_queue_depth": 1024, #Packets queued per worker before the dispatcher drops
+        "rss_neighbor_slots": 4096, #Entries in the neighbor table the workers share
+        "pipeline": 0, #1 runs receive, forwarding and per-interface transmit on separate threads
+        "pipeline_rx_depth": 1024, #Received packets queued for forwarding
+        "pipeline_tx_depth": 256, #Packets queued per egress interface
+        "pipeline_full_policy": "drop", #drop (new packet) or block (the stage feeding a full queue waits)
+        "pipeline_report": 0.0, #Seconds between pipeline stats in the log, 0 for only at shutdown
+        "event_loop": 0, #1 sleeps until a packet or timer is due instead of polling every 0.5s
+        "egress_qos": 0, #1 queues sends per interface and class as set up in qos_config.txt
+        "aqm": "codel", #codel, red or none, for the egress, pipeline and rss queues
+        "aqm_target": 0.005, #CoDel: seconds of standing queue delay it aims for
+        "aqm_interval": 0.1, #CoDel: seconds delay may sit above target before it drops
+        "pending_aqm": "codel", #Same choices for packets waiting on ARP
+        "pending_aqm_target": 1.0, #CoDel on them: an ARP retry's wait, a normal resolution stays under it
+        "pending_aqm_interval": 2.0, #So drops start only after three unanswered requests
+        "red_min": 32, #RED: average queue length (packets) where early drops start
+        "red_max": 128, #RED: average queue length where everything is dropped
+        "red_max_p": 0.1, #RED: drop probability as the average reaches red_max
+        "red_weight": 0.002, #RED: weight of each new sample in the average
+        "aqm_ecn": 1, #1 marks ECN-capable packets instead of dropping them
+        "metrics": 0, #1 keeps counters and per-stage latency histograms (dumped on SIGUSR1)
+        "metrics_socket": "router.metrics", #UNIX socket a report can be read from when metrics is on, none for no socket
+        "profile_mode": "cprofile", #What SIGUSR2 turns on: cprofile or sample
+        "profile_seconds": 10.0, #How long a profiling window lasts
+        "profile_interval": 0.001, #Seconds of CPU between samples in sample mode
+        "profile_output": "router_profile", #Windows are written to <this>.<pid>.<n>.pstats or .folded
+        "trace_every": 0, #Logs the journey of one packet in this many, 0 for no tracing
+        "table_snapshot": "router_tables.snap", #Compiled tables (snapshot.py) loaded instead of the text files when fresh, none to always parse
+    }
+
+    def __init__(self, filename="router_config.txt"):
+        self.settings = dict(self.defaults)
+
+        if not os.path.exists(filename): #No file, run on defaults
+            return
+
+        f = open(filename, "r")
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#': #Skip comments and empty lines
+                continue
+
+            name, value = line.split(None, 1)
+            value = value.split('#')[0].strip()
+            if name not in self.defaults:
+                raise ValueError("Unknown router setting '%s' in %s" % (name, filename))
+
+            kind = type(self.defaults[name]) #Convert to whatever type the default is
+            self.settings[name] = kind(value)
+        f.close()
+
+    def __getitem__(self, name):
+        return self.settings[name]
+
+    def __setitem__(self, name, value):
+        self.settings[name] = value
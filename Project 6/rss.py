@@ -0,0 +1,502 @@
+'''
+Receive-side scaling: one dispatcher process spreading flows over N router
+worker processes.
+
+The dispatcher owns the net object.  It hashes each IPv4 packet's 5-tuple to
+a worker, so a flow always lands on the same worker and stays in order, and
+sends whatever the workers hand back out on the wire.  ARP requests are
+hashed by sender, ARP replies go to every worker so any of them waiting on
+the answer can send its parked packets.
+
+State the workers have to agree on lives in shared memory (multiprocessing
+sharedctypes, set up before the fork):
+-SharedNeighborTable: every worker publishes what it learns by ARP and
+    falls back to it on a miss (NeighborCache.share).  MAC changes are also
+    logged there, and each worker checks the log before taking its next
+    packet, so flows cached through the old MAC are dropped everywhere.
+-SharedBuckets: the firewall's rate-limit token counts and when each was
+    last topped up, drawn down and topped up by all workers
+The forwarding table is built once in the dispatcher before forking and is
+shared copy-on-write.  Changes to it go through the dispatcher (addRoute,
+removeRoute, and the interface checks it does in place of the workers),
+which queues them to every worker as a Control in between the packets.
+
+Each worker's queue has an AQM (aqm in router_config.txt): the dispatcher
+runs its arrival side, the worker the side that sees how long packets waited.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+from pox.lib.addresses import EthAddr, IPAddr
+from srpy_common import log_info, log_warn, SrpyShutdown, SrpyNoPackets
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+import threading
+import struct
+import time
+import Queue
+
+from aqm import aqm_factory, MTU
+from firewall import Firewall, TokenBucket
+from ingress import FrameView, IP_TYPE, ARP_TYPE, ETH_LEN
+from rawframe import RawFrame
+from topology import Interface
+
+_ARP_SENDER = struct.Struct('!H6sI') #opcode, sender MAC, sender ip
+
+ARP_REPLY = 2
+
+class SharedNeighborTable(object):
+    '''
+    Fixed-size open-addressing ip -> (eth, intf, confirmed) table in shared
+    memory.  Nothing is ever deleted; when all PROBES slots for an address are
+    taken the longest unconfirmed one is overwritten.  Every put that isn't
+    just a re-confirmation goes into a ring of the last LOG addresses
+    changed, read with changes().
+    '''
+    PROBES = 8
+    LOG = 1024
+
+    def __init__(self, slots, names):
+        size = 1
+        while size < slots:
+            size <<= 1
+        self.mask = size - 1
+        self.names = list(names) #Interface names, stored by index
+
+        self.used = RawArray('b', size)
+        self.keys = RawArray('I', size)
+        self.eths = RawArray('c', size * 6)
+        self.intfs = RawArray('b', size)
+        self.confirmed = RawArray('d', size)
+        self.log = RawArray('I', self.LOG)
+        self.logged = RawValue('L', 0) #Changes ever logged, log[logged % LOG] is the next slot
+        self.lock = multiprocessing.Lock()
+
+    def _slots(self, key):
+        start = (key * 2654435761) & self.mask
+        return [(start + i) & self.mask for i in range(self.PROBES)]
+
+    def put(self, ip, eth, intf, when):
+        key = ip.toUnsigned()
+        raw = eth.toRaw()
+        with self.lock:
+            victim = None
+            for slot in self._slots(key):
+                if not self.used[slot] or self.keys[slot] == key:
+                    victim = slot
+                    break
+                if victim is None or self.confirmed[slot] < self.confirmed[victim]:
+                    victim = slot
+
+            if not (self.used[victim] and self.keys[victim] == key and self.eths[victim * 6:victim * 6 + 6] == raw):
+                self.log[self.logged.value % self.LOG] = key
+                self.logged.value += 1
+            self.used[victim] = 1
+            self.keys[victim] = key
+            self.eths[victim * 6:victim * 6 + 6] = raw
+            self.intfs[victim] = self.names.index(intf)
+            self.confirmed[victim] = when
+
+    def get(self, ip):
+        key = ip.toUnsigned()
+        with self.lock:
+            for slot in self._slots(key):
+                if not self.used[slot]:
+                    return None
+                if self.keys[slot] == key:
+                    return (EthAddr(self.eths[slot * 6:slot * 6 + 6]), self.names[self.intfs[slot]],
+                            self.confirmed[slot])
+        return None
+
+    def changes(self, since):
+        '''
+        (position, addresses) for what was put since position since (0 at
+        the start): the addresses as unsigned ints, None if more changed
+        than the log holds
+        '''
+        with self.lock:
+            logged = self.logged.value
+            if logged - since > self.LOG:
+                return logged, None
+            return logged, [self.log[i % self.LOG] for i in range(since, logged)]
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    A firewall TokenBucket whose token count and last top-up time live in
+    shared arrays
+    '''
+    def __init__(self, bucket, tokens, lasts, index, lock):
+        self.rate = bucket.rate
+        self.max_tokens = bucket.max_tokens
+        self.clock = bucket.clock
+        self.tokens = tokens
+        self.lasts = lasts
+        self.index = index
+        self.lock = lock
+
+    def _get(self):
+        return self.tokens[self.index]
+
+    def _set(self, value):
+        self.tokens[self.index] = value
+
+    num_tokens = property(_get, _set)
+
+    def _get_last(self):
+        return self.lasts[self.index]
+
+    def _set_last(self, value):
+        self.lasts[self.index] = value
+
+    last = property(_get_last, _set_last)
+
+    def increment(self):
+        with self.lock:
+            TokenBucket.increment(self)
+
+    def decrement(self, num_bytes):
+        with self.lock:
+            return TokenBucket.decrement(self, num_bytes)
+
+class SharedBuckets(object):
+    '''
+    Moves every rate-limit bucket of firewall into shared memory.  Buckets
+    top themselves up by the clock as they're drawn down, so it doesn't
+    matter which process does it, and the firewall's own list is emptied so
+    no worker tops them up on a timer.
+    '''
+    def __init__(self, firewall):
+        rules = [rule for rule in firewall.rule_set if rule.bucket is not None]
+        self.tokens = RawArray('d', len(rules))
+        self.lasts = RawArray('d', len(rules))
+        self.lock = multiprocessing.Lock()
+        self.buckets = []
+        for index, rule in enumerate(rules):
+            self.tokens[index] = rule.bucket.num_tokens
+            self.lasts[index] = rule.bucket.last
+            rule.bucket = SharedTokenBucket(rule.bucket, self.tokens, self.lasts, index, self.lock)
+            self.buckets.append(rule.bucket)
+        firewall.buckets = set()
+
+class Control(object):
+    '''
+    A change every worker makes to its router: the WorkerNet method to call
+    and its arguments
+    '''
+    def __init__(self, method, *args):
+        self.method = method
+        self.args = args
+
+class WorkerNet(object):
+    '''
+    What a worker's Router sees as its net: frames come in on its own queue
+    (as (dev, ts, bytes, time queued), or a Control), everything it sends
+    goes back to the dispatcher as (name, bytes)
+    '''
+    def __init__(self, interfaces, outq, aqm, neighbors):
+        self.intfs = interfaces
+        self.outq = outq
+        self.aqm = aqm #Each worker ends up with its own copy
+        self.neighbors = neighbors #The SharedNeighborTable
+        self.seen = 0 #How far into its change log this worker has caught up
+        self.router = None #The Router on top, which Controls and MAC changes are applied to
+        self.inq = None #Set in the worker after the fork
+
+    def interfaces(self):
+        return self.intfs
+
+    def addRoute(self, prefix, mask, nexthop, name):
+        self.router.addRoute(prefix, mask, nexthop, name)
+
+    def removeRoute(self, prefix, mask):
+        self.router.removeRoute(prefix, mask)
+
+    def setInterfaces(self, interfaces):
+        self.intfs = interfaces
+        self.router.refreshInterfaces()
+
+    def catchUp(self):
+        '''
+        Takes over MACs other workers changed in the shared neighbor table,
+        dropping cached flows that went through the old ones
+        '''
+        if self.neighbors.logged.value == self.seen:
+            return
+        self.seen, changed = self.neighbors.changes(self.seen)
+        neighbors = self.router.neighbors
+        if changed is None: #Fell too far behind, check everything we have
+            changed = [ip.toUnsigned() for ip in neighbors.entries]
+        for ip in changed:
+            ip = IPAddr(ip)
+            if neighbors.refreshShared(ip):
+                self.router.flowCache.invalidateNexthop(ip)
+
+    def recv_packet(self, timeout=None):
+        while True:
+            try:
+                item = self.inq.get(timeout=timeout)
+            except Queue.Empty:
+                raise SrpyNoPackets()
+            if item is None: #Dispatcher is shutting down
+                raise SrpyShutdown()
+            self.catchUp()
+            if isinstance(item, Control):
+                getattr(self, item.method)(*item.args)
+                continue
+            dev, ts, raw, queued_at = item
+            now = time.time()
+            raw = self.aqm.leave(raw, now - queued_at, self.inq.qsize() * MTU, now)
+            if raw is not None:
+                return dev, ts, raw
+
+    def send_packet(self, name, pkt):
+        self.outq.put((name, pkt.pack()))
+
+    def shutdown(self):
+        pass
+
+def run_worker(router, inq):
+    router.net.inq = inq
+    router.router_main()
+    log_info("rss worker: aqm drops %d, marks %d" % (router.net.aqm.drops, router.net.aqm.marks))
+
+def flow_hash(view):
+    '''
+    Same value for every packet of a flow (protocol, addresses, ports)
+    '''
+    src_port, dst_port = view.ports()
+    return hash((view.protocol, view.srcip, view.dstip, src_port, dst_port)) & 0x7FFFFFFF
+
+class RssDispatcher(object):
+    def __init__(self, net, router_class, config):
+        self.net = net
+        self.count = config["rss_workers"]
+
+        interfaces = net.interfaces()
+        self.outq = multiprocessing.Queue()
+        self.inqs = [multiprocessing.Queue(config["rss_queue_depth"]) for i in range(self.count)]
+
+        #Interface changes are picked up here and handed to every worker
+        self.interface_check = config["interface_check_interval"]
+        self.next_check = time.time() + self.interface_check
+        self.seen_interfaces = self.describe(interfaces)
+        config["interface_check_interval"] = 0
+
+        #Each worker enforces its share of the ICMP limits
+        config["icmp_rate"] = config["icmp_rate"] / self.count
+        config["icmp_source_rate"] = config["icmp_source_rate"] / self.count
+
+        #Routes are loaded once here and inherited by every worker
+        aqm = aqm_factory(config)
+        self.aqms = [aqm() for inq in self.inqs] #Arrival side, here in the dispatcher
+        self.neighbors = SharedNeighborTable(config["rss_neighbor_slots"], [intf.name for intf in interfaces])
+        worker_net = WorkerNet(interfaces, self.outq, aqm(), self.neighbors)
+        self.router = worker_net.router = router_class(worker_net, config)
+        rules = self.router.snapshot.rules(self.router.clock) if self.router.snapshot is not None else None
+        self.router.firewall = Firewall(self.router.clock, rules)
+        self.buckets = SharedBuckets(self.router.firewall)
+        self.router.neighbors.share(self.neighbors)
+
+        self.workers = [multiprocessing.Process(target=run_worker, args=(self.router, inq)) for inq in self.inqs]
+        self.dispatched = [0] * self.count
+        self.dropped = [0] * self.count #Worker queue was full
+
+    def dispatch(self, dev, ts, frame):
+        view = FrameView(frame)
+        if view.ethertype == ARP_TYPE:
+            if len(view.raw) < ETH_LEN + 18:
+                return
+            opcode, sender_eth, sender_ip = _ARP_SENDER.unpack_from(view.buf, ETH_LEN + 6)
+            if opcode == ARP_REPLY: #Whoever is waiting on it needs to see it
+                for index in range(self.count):
+                    self.enqueue(index, dev, ts, view.raw)
+                return
+            index = sender_ip % self.count
+        elif view.ethertype == IP_TYPE and view.ip():
+            index = flow_hash(view) % self.count
+        else:
+            return
+        self.enqueue(index, dev, ts, view.raw)
+
+    def enqueue(self, index, dev, ts, raw):
+        raw = self.aqms[index].arrive(raw, self.inqs[index].qsize(), time.time())
+        if raw is None:
+            return
+        try:
+            self.inqs[index].put_nowait((dev, ts, raw, time.time()))
+            self.dispatched[index] += 1
+        except Queue.Full:
+            self.dropped[index] += 1
+
+    def broadcast(self, method, *args):
+        '''
+        Queues Control(method, args) to every worker.  Waits for room rather
+        than dropping it, so no worker misses a change.
+        '''
+        for inq in self.inqs:
+            inq.put(Control(method, *args))
+
+    def addRoute(self, prefix, mask, nexthop, name):
+        '''
+        Router.addRoute, in every worker
+        '''
+        self.broadcast("addRoute", prefix, mask, nexthop, name)
+
+    def removeRoute(self, prefix, mask):
+        '''
+        Router.removeRoute, in every worker
+        '''
+        self.broadcast("removeRoute", prefix, mask)
+
+    def describe(self, interfaces):
+        return [(intf.name, intf.ethaddr, intf.ipaddr, intf.netmask) for intf in interfaces]
+
+    def checkInterfaces(self):
+        '''
+        The workers' interface check: if any address changed, every worker
+        gets the new interfaces and refreshes its routes and caches
+        '''
+        current = self.describe(self.net.interfaces())
+        if current != self.seen_interfaces:
+            self.seen_interfaces = current
+            self.broadcast("setInterfaces", [Interface(*intf) for intf in current])
+
+    def sender(self):
+        '''
+        Sends what the workers hand back, until run() says to stop
+        '''
+        while True:
+            item = self.outq.get()
+            if item is None:
+                return
+            name, raw = item
+            self.net.send_packet(name, RawFrame(raw))
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        sending = threading.Thread(target=self.sender)
+        sending.daemon = True
+        sending.start()
+        log_info("rss: %d workers" % self.count)
+
+        while True:
+            try:
+                dev, ts, frame = self.net.recv_packet(timeout=0.5)
+                self.dispatch(dev, ts, frame)
+            except SrpyNoPackets:
+                pass
+            except SrpyShutdown:
+                break
+            if self.interface_check > 0 and time.time() >= self.next_check:
+                self.next_check = time.time() + self.interface_check
+                self.checkInterfaces()
+
+        for inq in self.inqs: #Workers finish what's queued, then stop
+            inq.put(None)
+        for worker in self.workers:
+            worker.join()
+            if worker.exitcode:
+                log_warn("rss worker exited with %d" % worker.exitcode)
+        self.outq.put(None)
+        sending.join()
+        log_info("rss: dispatched %s, dropped %s, aqm drops %s, aqm marks %s" %
+                 (self.dispatched, self.dropped, [aqm.drops for aqm in self.aqms], [aqm.marks for aqm in self.aqms]))
+
+def tests():
+    from myrouter4 import Router
+    from routerconfig import RouterConfig
+    from aqm import Aqm
+    from arptemplates import arp_frame
+    from topology import INTERFACES, udp_frame, ip_value
+
+    config = RouterConfig()
+    config["lookup"] = "trie"
+    config["table_snapshot"] = "none"
+    table = SharedNeighborTable(64, [intf.name for intf in INTERFACES])
+    workers = []
+    for i in range(2): #What the dispatcher sets up, minus the fork
+        net = WorkerNet(INTERFACES, Queue.Queue(), Aqm(False), table)
+        net.inq = Queue.Queue()
+        router = net.router = Router(net, config)
+        router.firewall = Firewall(router.clock, [])
+        router.neighbors.share(table)
+        workers.append(router)
+    a, b = workers
+
+    def handle(router, dev, frame):
+        router.net.inq.put((dev, 0.0, frame, time.time()))
+        dev, ts, raw = router.net.recv_packet(timeout=0)
+        router.handlePacket(dev, raw, ts)
+        sent = []
+        while not router.net.outq.empty():
+            sent.append(router.net.outq.get())
+        return sent
+
+    def control(*args):
+        for router in workers:
+            router.net.inq.put(Control(*args))
+        for router in workers: #Applied as the worker goes for its next packet
+            try:
+                router.net.recv_packet(timeout=0)
+                assert False
+            except SrpyNoPackets:
+                pass
+
+    nexthop = IPAddr("192.168.100.2")
+    old_eth, new_eth = EthAddr("02:00:00:00:00:01"), EthAddr("02:00:00:00:00:02")
+    def arp_from(eth):
+        return arp_frame(1, '\xff' * 6, eth.toRaw(), eth.toRaw(), nexthop.toRaw(), '\x00' * 6,
+                         INTERFACES[1].ipaddr.toRaw())
+    frame = udp_frame(53, 100) #To 192.168.42.5, routed via nexthop
+
+    #a hears the next hop's ARP, b forwards through it off the shared table and caches the flow
+    assert handle(a, "router-eth1", arp_from(old_eth))[0][0] == "router-eth1"
+    for i in range(2):
+        sent = handle(b, "router-eth0", frame)
+        assert [name for name, raw in sent] == ["router-eth1"] and sent[0][1][:6] == old_eth.toRaw()
+    assert b.flowCache.hits == 1 and nexthop in b.flowCache.by_nexthop
+
+    #The next hop's MAC changes, a hears about it: b drops the flow and follows
+    handle(a, "router-eth1", arp_from(new_eth))
+    sent = handle(b, "router-eth0", frame)
+    assert sent[0][1][:6] == new_eth.toRaw() and b.flowCache.invalidations == 1
+    assert b.neighbors.peek(nexthop) == new_eth
+    handle(a, "router-eth1", arp_from(new_eth)) #Same MAC again: nothing for b to redo
+    handle(b, "router-eth0", frame)
+    assert b.flowCache.invalidations == 1
+
+    #Route changes reach both, b's cached flow under the new route is dropped
+    control("addRoute", IPAddr("192.168.42.0"), IPAddr("255.255.255.128"), IPAddr("192.168.200.2"), "router-eth2")
+    control("removeRoute", IPAddr("192.168.0.0"), IPAddr("255.255.0.0"))
+    for router in workers:
+        assert router.forwardingTable.lookup(ip_value("192.168.42.5"))[2] == "router-eth2"
+        assert router.forwardingTable.lookup(ip_value("192.168.7.7")) is None
+    sent = handle(b, "router-eth0", frame) #Off to ARP for 192.168.200.2 now
+    assert [(name, raw[12:14]) for name, raw in sent] == [("router-eth2", '\x08\x06')]
+
+    #So do interface changes
+    moved = [Interface(intf.name, intf.ethaddr, intf.ipaddr, intf.netmask) for intf in INTERFACES]
+    moved[2] = Interface("router-eth2", "00:00:00:00:0b:03", "192.168.201.1", "255.255.255.252")
+    control("setInterfaces", moved)
+    for router in workers:
+        assert IPAddr("192.168.201.1") in router.my_interfaces and IPAddr("192.168.200.1") not in router.my_interfaces
+        assert router.forwardingTable.lookup(ip_value("192.168.201.2"))[2] == "router-eth2"
+
+    #The change log: re-confirmations aren't changes, and falling behind by more than it holds says so
+    small = SharedNeighborTable(8, ["router-eth0"])
+    small.put(nexthop, old_eth, "router-eth0", 1.0)
+    small.put(nexthop, old_eth, "router-eth0", 2.0)
+    assert small.changes(0) == (1, [nexthop.toUnsigned()])
+    for i in range(SharedNeighborTable.LOG):
+        small.put(nexthop, (new_eth, old_eth)[i % 2], "router-eth0", 3.0 + i)
+    assert small.changes(0) == (SharedNeighborTable.LOG + 1, None)
+    assert small.changes(1)[0] == SharedNeighborTable.LOG + 1 and len(small.changes(1)[1]) == SharedNeighborTable.LOG
+    print "rss: ok"
+
+if __name__ == '__main__':
+    tests()
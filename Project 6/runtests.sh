@@ -0,0 +1,8 @@
+#!/bin/bash
+set -e
+for module in scheduler lpm dir248 flowcache neighbor ingress arptemplates rawframe icmpfast icmplimit qos aqm metrics rss pipeline firewall myrouter4; do
+    python ./$module.py
+done
+python ./emulator.py test
+python ./eventloop.py test
+python ./snapshot.py test
@@ -0,0 +1,137 @@
+'''
+Timer scheduling for the router (ARP retries and anything else that has to
+happen at a given time).  A heap ordered by deadline, so each pass of the
+main loop only touches timers that are actually due.
+'''
+
+import heapq
+import itertools
+import time
+
+class Timer(object):
+    '''
+    Handle for a scheduled callback, pass to EventScheduler.cancel()
+    '''
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+class EventScheduler(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = [] #(when, seq, Timer)
+        self.seq = itertools.count() #Tie breaker so equal deadlines fire in order
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, when, callback, *args):
+        '''
+        Calls callback(*args) once the clock reaches when
+        '''
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.seq), timer))
+        return timer
+
+    def cancel(self, timer):
+        '''
+        Cancelled timers stay in the heap until they reach the top, then get thrown away
+        '''
+        if timer is not None:
+            timer.cancelled = True
+
+    def nextDeadline(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def timeUntilNext(self, limit):
+        '''
+        Seconds until the next timer is due, at most limit (for recv timeouts)
+        '''
+        deadline = self.nextDeadline()
+        if deadline is None:
+            return limit
+        return max(0.0, min(limit, deadline - self.clock()))
+
+    def runDue(self):
+        '''
+        Fires every timer whose deadline has passed.  Returns how many fired.
+        '''
+        now = self.clock()
+        fired = 0
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
+
+def tests():
+    now = [100.0]
+    scheduler = EventScheduler(lambda: now[0])
+    fired = []
+    assert scheduler.nextDeadline() is None and scheduler.timeUntilNext(1.0) == 1.0
+    assert scheduler.runDue() == 0
+
+    #Equal deadlines fire in the order they were scheduled, earlier deadlines first
+    for name in "abcde":
+        scheduler.schedule(101.0, fired.append, name)
+    scheduler.schedule(100.5, fired.append, "early")
+    assert scheduler.nextDeadline() == 100.5
+    assert scheduler.timeUntilNext(10.0) == 0.5 and scheduler.timeUntilNext(0.2) == 0.2
+    assert scheduler.runDue() == 0 and fired == []
+    now[0] = 101.0
+    assert scheduler.timeUntilNext(10.0) == 0.0
+    assert scheduler.runDue() == 6 and fired == ["early", "a", "b", "c", "d", "e"]
+    assert len(scheduler) == 0
+
+    #Cancelled before it's due: never fires, and doesn't hold up nextDeadline
+    del fired[:]
+    timer = scheduler.schedule(102.0, fired.append, "cancelled")
+    scheduler.schedule(103.0, fired.append, "kept")
+    scheduler.cancel(timer)
+    scheduler.cancel(None)
+    assert len(scheduler) == 2 and scheduler.nextDeadline() == 103.0 and len(scheduler) == 1
+    now[0] = 103.0
+    assert scheduler.runDue() == 1 and fired == ["kept"]
+    scheduler.cancel(timer) #Again, after the fact: harmless
+
+    #Cancelled by an earlier callback in the same pass: still doesn't fire
+    del fired[:]
+    later = scheduler.schedule(104.0, fired.append, "victim")
+    scheduler.schedule(103.5, lambda: (fired.append("killer"), scheduler.cancel(later)))
+    now[0] = 105.0
+    assert scheduler.runDue() == 1 and fired == ["killer"]
+
+    #Rescheduling (cancel, schedule again) the way ARP retries do
+    del fired[:]
+    retry = scheduler.schedule(106.0, fired.append, "retry 1")
+    now[0] = 105.5
+    scheduler.cancel(retry)
+    retry = scheduler.schedule(107.0, fired.append, "retry 2")
+    now[0] = 106.5
+    assert scheduler.runDue() == 0 and scheduler.nextDeadline() == 107.0
+    now[0] = 107.0
+    assert scheduler.runDue() == 1 and fired == ["retry 2"]
+
+    #A callback rescheduling itself runs once per due deadline, not in a loop
+    ticks = []
+    def tick(when):
+        ticks.append(when)
+        scheduler.schedule(when + 1.0, tick, when + 1.0)
+    scheduler.schedule(108.0, tick, 108.0)
+    now[0] = 110.5
+    assert scheduler.runDue() == 3 and ticks == [108.0, 109.0, 110.0]
+    assert scheduler.nextDeadline() == 111.0
+    print "scheduler: ok"
+
+if __name__ == '__main__':
+    tests()
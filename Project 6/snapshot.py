@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+'''
+Precompiled binary snapshot of forwarding_table.txt and firewall_rules.txt
+
+Usage: python snapshot.py [output]
+       python snapshot.py test
+
+Compiles the two text files in the current directory into output (default
+router_tables.snap, what table_snapshot in router_config.txt points at).
+The router mmaps the file at startup instead of parsing the text.  With
+lookup dir248, routes are looked up straight out of the mapped DIR-24-8
+arrays, so loading a million routes costs a few page faults rather than
+building the table, and rss workers share the pages.  With lookup trie the
+trie is still built, but from the packed route arrays rather than the text.
+Firewall rules are fixed-size records turned back into Rule objects without
+any parsing.
+
+The header keeps the size and modification time of both text files; if
+either has changed since, the snapshot is stale and the router goes back
+to the text files (rerun this to pick the changes up).
+
+Layout (native byte order, every section starts 8-byte aligned):
+    header    HEADER, with the offset of each section below
+    values    value_count VALUE records, (netmask, nexthop, interface name);
+              index 0 is "no route"
+    tbl24     2^24 int32, DIR-24-8 first level (see dir248.py)
+    tbl8      int32 second-level blocks
+    keys      route_count uint32 prefixes, sorted by (prefix, length)
+    lengths   route_count uint8 prefix lengths
+    indexes   route_count int32 value indexes
+    rules     rule_count RULE records, in firewall_rules.txt order
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import mmap
+import time
+import struct
+from array import array
+from pox.lib.addresses import IPAddr,netmask_to_cidr
+
+from lpm import PrefixTrie, prefix_mask
+from dir248 import Dir248Table, TBL24_SIZE, BLOCK_SIZE
+from firewall import Firewall, Rule, TokenBucket
+
+MAGIC = "RTRSNAP\0"
+VERSION = 1
+BYTE_ORDER = 0x01020304 #Reads back differently on a machine with the other byte order
+
+#magic, version, byte order, forwarding_table.txt size and mtime, firewall_rules.txt size and mtime,
+#value, route, rule and tbl8 entry counts, then the section offsets
+HEADER = struct.Struct('=8sIIqdqdIIII7Q')
+VALUE = struct.Struct('=IIB32s') #netmask, nexthop, has a nexthop, interface name
+RULE = struct.Struct('=bbxxIIiii') #permit, protocol, src mask, dst mask, src port, dst port, rate (-1 for none)
+ENTRY = struct.Struct('=i')
+KEY = struct.Struct('=I')
+
+def aligned(offset):
+    return (offset + 7) & ~7
+
+def file_stamp(path):
+    '''
+    (size, mtime) of path, (-1, 0.0) if it doesn't exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, 0.0
+    return st.st_size, st.st_mtime
+
+def write_snapshot(path, routes_path="forwarding_table.txt"):
+    '''
+    Compiles routes_path and firewall_rules.txt (the router's own parsers
+    read both) into a snapshot at path.  Returns (routes, rules) written.
+    '''
+    from myrouter4 import read_forwarding_table #myrouter4 imports this module
+
+    #Stamp before reading, so edits made while compiling leave the snapshot stale
+    routes_stamp = file_stamp(routes_path)
+    rules_stamp = file_stamp("firewall_rules.txt")
+
+    table = Dir248Table.fromRoutes(read_forwarding_table(routes_path)) #Last of any duplicates wins
+    rules = Firewall().rule_set
+
+    routes = sorted(table.trie.items())
+    values = table.nexthops
+
+    offsets = []
+    offset = aligned(HEADER.size)
+    for size in (len(values) * VALUE.size, TBL24_SIZE * 4, len(table.tbl8) * 4,
+                 len(routes) * 4, len(routes), len(routes) * 4, len(rules) * RULE.size):
+        offsets.append(offset)
+        offset = aligned(offset + size)
+
+    def pad(f, offset):
+        f.write('\0' * (offset - f.tell()))
+
+    temp = path + ".tmp"
+    f = open(temp, "wb")
+    f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, routes_stamp[0], routes_stamp[1], rules_stamp[0],
+                        rules_stamp[1], len(values), len(routes), len(rules), len(table.tbl8), *offsets))
+
+    pad(f, offsets[0])
+    f.write(VALUE.pack(0, 0, 0, ""))
+    for mask, nexthop, name in values[1:]:
+        f.write(VALUE.pack(mask.toUnsigned(), nexthop.toUnsigned() if nexthop is not None else 0,
+                           nexthop is not None, name))
+
+    pad(f, offsets[1])
+    table.tbl24.tofile(f)
+    pad(f, offsets[2])
+    table.tbl8.tofile(f)
+
+    pad(f, offsets[3])
+    array('I', [key for key, length, value in routes]).tofile(f)
+    pad(f, offsets[4])
+    array('B', [length for key, length, value in routes]).tofile(f)
+    pad(f, offsets[5])
+    array('i', [table.nexthop_index[value] for key, length, value in routes]).tofile(f)
+
+    pad(f, offsets[6])
+    for rule in rules:
+        f.write(RULE.pack(rule.permitted, rule.protocol, rule.src_mask, rule.dst_mask, rule.src_port,
+                          rule.dst_port, rule.bucket.rate if rule.bucket != None else -1))
+    f.close()
+    os.rename(temp, path) #A router starting meanwhile sees the old file or the new one, never half of one
+    return len(routes), len(rules)
+
+class TableSnapshot(object):
+    '''
+    A snapshot file mapped read-only.  Raises ValueError if path isn't a
+    snapshot this version can read.
+    '''
+
+    def __init__(self, path):
+        f = open(path, "rb")
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error): #Empty file
+            f.close()
+            raise ValueError("not a table snapshot")
+        f.close() #The mapping keeps its own reference
+
+        if len(self.map) < HEADER.size:
+            raise ValueError("not a table snapshot")
+        fields = HEADER.unpack_from(self.map, 0)
+        magic, version, byte_order = fields[0:3]
+        if magic != MAGIC:
+            raise ValueError("not a table snapshot")
+        if byte_order != BYTE_ORDER:
+            raise ValueError("compiled on a machine with the other byte order")
+        if version != VERSION:
+            raise ValueError("snapshot version %d, this router reads %d" % (version, VERSION))
+
+        self.routes_stamp = fields[3:5]
+        self.rules_stamp = fields[5:7]
+        self.value_count, self.route_count, self.rule_count, self.tbl8_entries = fields[7:11]
+        (self.values_offset, self.tbl24_offset, self.tbl8_offset, self.keys_offset, self.lengths_offset,
+         self.indexes_offset, self.rules_offset) = fields[11:18]
+        if self.rules_offset + self.rule_count * RULE.size > len(self.map):
+            raise ValueError("snapshot is truncated")
+
+    def fresh(self, routes_path, rules_path):
+        '''
+        True if both text files are as they were when the snapshot was compiled
+        '''
+        return file_stamp(routes_path) == self.routes_stamp and file_stamp(rules_path) == self.rules_stamp
+
+    def close(self):
+        self.map.close()
+
+    def routes(self):
+        return MappedRoutes(self)
+
+    def rules(self, clock=time.time):
+        '''
+        Rule objects as the Firewall would have parsed them, buckets full
+        '''
+        rules = []
+        for i in range(self.rule_count):
+            permit, protocol, src_mask, dst_mask, src_port, dst_port, rate = RULE.unpack_from(self.map,
+                self.rules_offset + i * RULE.size)
+            bucket = TokenBucket(rate, clock) if rate != -1 else None
+            rules.append(Rule(bool(permit), protocol, src_mask, dst_mask, src_port, dst_port, bucket))
+        return rules
+
+    def values(self):
+        '''
+        The (mask, nexthop, name) route values, index 0 None
+        '''
+        values = [None]
+        for i in range(1, self.value_count):
+            mask, nexthop, has_nexthop, name = VALUE.unpack_from(self.map, self.values_offset + i * VALUE.size)
+            values.append(tuple([IPAddr(mask), IPAddr(nexthop) if has_nexthop else None, name.rstrip('\0')]))
+        return values
+
+    def items(self, values=None):
+        '''
+        (key, length, value) for every route in the snapshot, from the packed
+        arrays (values as from values(), if the caller already has them)
+        '''
+        if values is None:
+            values = self.values()
+        keys = self.array('I', self.keys_offset, self.route_count)
+        lengths = self.array('B', self.lengths_offset, self.route_count)
+        indexes = self.array('i', self.indexes_offset, self.route_count)
+        for i in range(self.route_count):
+            yield keys[i], lengths[i], values[indexes[i]]
+
+    def array(self, typecode, offset, count):
+        '''
+        Copy of a section as an array (for walking every route, not lookups)
+        '''
+        items = array(typecode)
+        items.fromstring(self.map[offset:offset + count * items.itemsize])
+        return items
+
+class MappedRoutes(object):
+    '''
+    Same interface as PrefixTrie (insert/delete/lookup/items/len) over a
+    snapshot's routes.  Lookups read the mapped DIR-24-8 arrays; routes
+    added at runtime (the interface routes included) go in a PrefixTrie on
+    top, and win whenever their prefix is at least as long.  Deleting a
+    route that came from the snapshot moves everything into the trie, since
+    the mapped arrays can't change.
+    '''
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.map = snapshot.map
+        self.values = snapshot.values()
+        self.lengths = [0] + [netmask_to_cidr(value[0]) for value in self.values[1:]]
+        self.overlay = PrefixTrie()
+        self.added = set() #(key, length) of everything in the overlay
+        self.shadowed = 0 #Overlay routes replacing a snapshot route
+        self.mapped = True #False once everything has moved into the overlay
+
+    def __len__(self):
+        if not self.mapped:
+            return len(self.overlay)
+        return self.snapshot.route_count + len(self.overlay) - self.shadowed
+
+    def lookup(self, addr):
+        if not self.mapped:
+            return self.overlay.lookup(addr)
+        entry = ENTRY.unpack_from(self.map, self.snapshot.tbl24_offset + (addr >> 8) * 4)[0]
+        if entry < 0:
+            entry = ENTRY.unpack_from(self.map, self.snapshot.tbl8_offset +
+                                      ((-entry - 1) * BLOCK_SIZE + (addr & 0xFF)) * 4)[0]
+        found = self.overlay.match(addr)
+        if found is not None and (entry == 0 or found[0] >= self.lengths[entry]):
+            return found[1]
+        return self.values[entry]
+
+    def insert(self, key, length, value):
+        key &= prefix_mask(length)
+        if (key, length) not in self.added:
+            self.added.add((key, length))
+            if self.mapped and self.find(key, length) is not None:
+                self.shadowed += 1
+        self.overlay.insert(key, length, value)
+
+    def delete(self, key, length):
+        key &= prefix_mask(length)
+        if self.mapped and self.find(key, length) is not None:
+            self.unmap()
+        if not self.overlay.delete(key, length):
+            return False
+        self.added.discard((key, length))
+        return True
+
+    def items(self):
+        for route in self.overlay.items():
+            yield route
+        if not self.mapped:
+            return
+        for key, length, value in self.snapshot.items(self.values):
+            if (key, length) not in self.added:
+                yield key, length, value
+
+    def find(self, key, length):
+        '''
+        Position of key/length among the snapshot's routes, None if it isn't one
+        '''
+        snapshot = self.snapshot
+        low, high = 0, snapshot.route_count
+        while low < high: #First route with a prefix >= key
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.map, snapshot.keys_offset + middle * 4)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        for i in range(low, snapshot.route_count):
+            if KEY.unpack_from(self.map, snapshot.keys_offset + i * 4)[0] != key:
+                break
+            if ord(self.map[snapshot.lengths_offset + i]) == length:
+                return i
+        return None
+
+    def unmap(self):
+        '''
+        Copies the snapshot's routes under the overlay, which holds every route from then on
+        '''
+        for key, length, value in list(self.items()):
+            if (key, length) not in self.added:
+                self.overlay.insert(key, length, value)
+                self.added.add((key, length))
+        self.mapped = False
+        self.shadowed = 0
+
+def tests():
+    '''
+    Round trip through a snapshot file: lookups out of the mapped arrays
+    against a PrefixTrie of the same text table, the rules against the
+    firewall's own parse, a router picking the backend lookup asks for,
+    and files that have to be refused
+    '''
+    import random
+    import shutil
+    import tempfile
+    from myrouter4 import read_forwarding_table, Router
+    from routerconfig import RouterConfig
+    from emulator import Emulator, DEFAULT_MIX
+
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    try:
+        routes_path = os.path.join(directory, "forwarding_table.txt")
+        path = os.path.join(directory, "router_tables.snap")
+        f = open(routes_path, "w")
+        f.write("0.0.0.0 0.0.0.0 192.168.200.2 router-eth2\n")
+        for i in range(3000):
+            length = rng.choice((8, 12, 16, 20, 24, 24, 25, 28, 32))
+            prefix = (rng.choice((0x0A000000, 0xC0A80000, 0xAC100000)) | rng.getrandbits(20)) & prefix_mask(length)
+            f.write("%s %s %s router-eth%d\n" % (IPAddr(prefix), IPAddr(prefix_mask(length)),
+                                                 IPAddr(rng.getrandbits(32)), rng.randrange(3)))
+        f.close()
+        assert write_snapshot(path, routes_path)[1] == len(Firewall().rule_set)
+
+        trie = PrefixTrie()
+        for prefix, length, route in read_forwarding_table(routes_path):
+            trie.insert(prefix, length, route)
+        def addresses():
+            for key, length, value in trie.items():
+                yield key | (rng.getrandbits(32) & ~prefix_mask(length) & 0xFFFFFFFF)
+            for i in range(5000):
+                yield rng.getrandbits(32)
+        def agree(routes):
+            assert len(routes) == len(trie)
+            assert dict(((key, length), value) for key, length, value in routes.items()) == \
+                dict(((key, length), value) for key, length, value in trie.items())
+            for addr in addresses():
+                assert routes.lookup(addr) == trie.lookup(addr)
+
+        snapshot = TableSnapshot(path)
+        assert snapshot.fresh(routes_path, "firewall_rules.txt")
+        routes = snapshot.routes()
+        agree(routes)
+
+        #Runtime routes go on top, replacing or inside snapshot routes
+        key, length, value = sorted(trie.items())[len(trie) // 2]
+        extra = (IPAddr(prefix_mask(30)), IPAddr("10.9.9.9"), "router-eth1")
+        for table in (trie, routes):
+            table.insert(key, length, extra) #Same prefix as a snapshot route
+            table.insert(0x0A0A0A00, 30, extra)
+        agree(routes)
+        for table in (trie, routes):
+            assert table.delete(0x0A0A0A00, 30)
+        assert routes.mapped
+        agree(routes)
+        key, length, value = sorted(trie.items())[-1]
+        for table in (trie, routes):
+            assert table.delete(key, length) #Only a snapshot route, the arrays can't drop it
+        assert not routes.mapped
+        agree(routes)
+
+        rules = snapshot.rules()
+        expected = Firewall().rule_set
+        assert len(rules) == len(expected)
+        for rule, parsed in zip(rules, expected):
+            assert (rule.permitted, rule.protocol, rule.src_mask, rule.dst_mask, rule.src_port, rule.dst_port) == \
+                (parsed.permitted, parsed.protocol, parsed.src_mask, parsed.dst_mask, parsed.src_port, parsed.dst_port)
+            assert (rule.bucket.rate if rule.bucket else None) == (parsed.bucket.rate if parsed.bucket else None)
+        snapshot.close()
+
+        #The router maps the arrays only with lookup dir248, and builds its trie from them otherwise
+        shipped = os.path.join(directory, "shipped.snap")
+        write_snapshot(shipped)
+        for lookup, kind in (("dir248", "MappedRoutes"), ("trie", "PrefixTrie")): #By name, this may be __main__
+            config, text_config = RouterConfig(os.devnull), RouterConfig(os.devnull)
+            for settings, snapshot_path in ((config, shipped), (text_config, "none")):
+                settings["table_snapshot"] = snapshot_path
+                settings["metrics_socket"] = "none"
+                settings["lookup"] = lookup
+            router = Router(Emulator(DEFAULT_MIX, 1.0), config)
+            assert router.snapshot is not None and type(router.forwardingTable).__name__ == kind
+            text = Router(Emulator(DEFAULT_MIX, 1.0), text_config)
+            for addr in (0xC0A82A50, 0xC0A8010A, 0xAC102A01, 0xC0A86402, 0x08080808):
+                assert router.forwardingTable.lookup(addr) == text.forwardingTable.lookup(addr)
+            router.snapshot.close()
+
+        #Files the router has to ignore
+        data = open(path, "rb").read()
+        def refused(contents, reason):
+            f = open(path, "wb")
+            f.write(contents)
+            f.close()
+            try:
+                TableSnapshot(path).close()
+            except ValueError as e:
+                assert reason in str(e), str(e)
+            else:
+                assert False, "accepted a snapshot that is " + reason
+        refused("", "not a table snapshot")
+        refused(data[:HEADER.size - 1], "not a table snapshot")
+        refused(data[:len(data) // 2], "truncated")
+        refused(data[:len(data) - 1], "truncated")
+        refused("X" + data[1:], "not a table snapshot")
+        refused(data[:8] + struct.pack('=I', VERSION + 1) + data[12:], "version")
+        refused(data[:12] + struct.pack('=I', BYTE_ORDER)[::-1] + data[16:], "byte order")
+
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        f = open(routes_path, "a")
+        f.write("10.255.0.0 255.255.0.0 10.0.0.1 router-eth0\n")
+        f.close()
+        snapshot = TableSnapshot(path)
+        assert not snapshot.fresh(routes_path, "firewall_rules.txt") #Stale once the text changes
+        snapshot.close()
+    finally:
+        shutil.rmtree(directory)
+    print("snapshot: ok")
+
+if __name__ == '__main__' and sys.argv[1:] == ["test"]:
+    tests()
+elif __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else "router_tables.snap"
+    start = time.time()
+    routes, rules = write_snapshot(output)
+    print("%d routes, %d rules -> %s (%d bytes) in %.2f s" % (routes, rules, output, os.path.getsize(output),
+                                                              time.time() - start))
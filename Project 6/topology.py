@@ -0,0 +1,47 @@
+'''
+The router's side of start_mininet.py's network, and frames to push through it
+
+Interface has the attributes srpy's interface objects have; INTERFACES are
+the router's three as start_mininet.py sets them up.  The emulator, the
+pcap replay harness, the raw-socket front end, the benchmarks and the tests
+all build on these rather than each keeping a copy.
+'''
+
+import sys
+import os
+import os.path
+sys.path.append(os.path.join(os.environ['HOME'],'pox'))
+sys.path.append(os.path.join(os.getcwd(),'pox'))
+import socket
+import struct
+from pox.lib.addresses import EthAddr, IPAddr
+
+class Interface(object):
+    '''
+    Same attributes as srpy's interface objects; the addresses can be given
+    as pox objects or in any form pox parses
+    '''
+    def __init__(self, name, eth, ip, mask):
+        self.name = name
+        self.ethaddr = EthAddr(eth)
+        self.ipaddr = IPAddr(ip)
+        self.netmask = IPAddr(mask)
+
+INTERFACES = [Interface("router-eth0", "00:00:00:00:0b:01", "172.16.42.254", "255.255.255.0"),
+              Interface("router-eth1", "00:00:00:00:0b:02", "192.168.100.1", "255.255.255.252"),
+              Interface("router-eth2", "00:00:00:00:0b:03", "192.168.200.1", "255.255.255.252")]
+
+def ip_value(text):
+    '''
+    Dotted quad -> unsigned int
+    '''
+    return struct.unpack('!I', socket.inet_aton(text))[0]
+
+def udp_frame(dst_port, size):
+    '''
+    size bytes of Ethernet frame, UDP from 172.16.42.1:5000 to 192.168.42.5:dst_port
+    (zero MACs and checksums; for the queues, which only classify and count bytes)
+    '''
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, size - 14, 0, 0, 64, 17, 0, '\xac\x10\x2a\x01', '\xc0\xa8\x2a\x05')
+    return ('\x00' * 12 + '\x08\x00' + header + struct.pack('!HHHH', 5000, dst_port, size - 34, 0) +
+            '\x00' * (size - 42))